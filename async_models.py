@@ -0,0 +1,166 @@
+import asyncio
+import time
+import weakref
+from contextlib import aclosing
+from model1 import fallback_directive
+from response_cache import replay_cached_text
+from token_accounting import TokenBudgetExceeded
+
+DEFAULT_MAX_IN_FLIGHT = 32
+
+# --- In-flight Request Limiter ---
+# One asyncio.Semaphore per running event loop, so a limiter can be shared module-wide
+# even if several loops (e.g. worker threads) use it.
+class InFlightLimiter:
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self._semaphores = weakref.WeakKeyDictionary()
+        self.counters = {"in_flight": 0, "peak_in_flight": 0, "started": 0, "completed": 0, "cancelled": 0}
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        return semaphore
+
+    async def __aenter__(self):
+        await self._semaphore().acquire()
+        self.counters["started"] += 1
+        self.counters["in_flight"] += 1
+        self.counters["peak_in_flight"] = max(self.counters["peak_in_flight"], self.counters["in_flight"])
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.counters["in_flight"] -= 1
+        if exc_type is not None and issubclass(exc_type, (asyncio.CancelledError, GeneratorExit)):
+            self.counters["cancelled"] += 1
+        else:
+            self.counters["completed"] += 1
+        self._semaphore().release()
+        return False
+
+
+shared_in_flight_limiter = InFlightLimiter()
+
+
+# --- Async Specialized Streaming Model ---
+# Wraps a (shared) SpecializedStreamingModel and streams with generate_content_async.
+# Calling the wrapper returns an async generator; cancelling the consuming task or
+# calling aclose() releases the in-flight slot and skips the cache write. Traffic capture
+# follows the sync model's traffic_recorder.
+class AsyncSpecializedStreamingModel:
+    def __init__(self, sync_model, limiter=shared_in_flight_limiter):
+        self.sync_model = sync_model
+        self.limiter = limiter
+
+    def __call__(self, prompt_content_for_model):
+        recorder = self.sync_model.traffic_recorder
+        if recorder is None:
+            return self._respond(prompt_content_for_model, {})
+        return recorder.capture_stream_async(self.sync_model.__class__.__name__, prompt_content_for_model,
+                                             lambda outcome: self._respond(prompt_content_for_model, outcome))
+
+    async def _respond(self, prompt_content_for_model, outcome):
+        model = self.sync_model
+        if not model.model_instance:
+            raise RuntimeError(f"ERROR: {model.__class__.__name__} model instance not initialized.")
+        cache_key = None
+        if model.response_cache is not None:
+            cache_key, cached_text = await asyncio.to_thread(model._cached_reply, prompt_content_for_model)
+            if cached_text is not None:
+                outcome["finish_reason"] = "CACHED"
+                for chunk_text in replay_cached_text(cached_text):
+                    yield chunk_text
+                return
+
+        preflight_notice = model._preflight_notice(prompt_content_for_model)
+        if preflight_notice is not None:
+            outcome["finish_reason"] = "REJECTED"
+            yield preflight_notice
+            return
+        emitted_chunks = []
+        async with self.limiter:
+            call_state = model._begin_call(prompt_content_for_model, outcome)
+            try:
+                while True:
+                    chunks = model.resilience.astream(model.model_name, lambda attempt: self._open_stream(call_state, attempt))
+                    completed = False
+                    async with aclosing(chunks):
+                        async for chunk in chunks:
+                            chunk_texts, stream_finished = model._feed_chunk(call_state, chunk)
+                            for chunk_text in chunk_texts:
+                                emitted_chunks.append(chunk_text)
+                                yield chunk_text
+                            if stream_finished: break
+                        else:
+                            completed = True
+                    chunk_texts, continuing = model._end_segment(call_state, completed)
+                    for chunk_text in chunk_texts:
+                        emitted_chunks.append(chunk_text)
+                        yield chunk_text
+                    if not continuing: break
+                for chunk_text in model._finish_call(call_state):
+                    emitted_chunks.append(chunk_text)
+                    yield chunk_text
+            except (asyncio.CancelledError, GeneratorExit):
+                model._cancel_call(call_state)
+                raise
+            except Exception as e:
+                yield model._fail_call(call_state, e)
+            finally:
+                model._end_attempt(call_state)
+        if cache_key is not None:
+            await asyncio.to_thread(model._store_reply, cache_key, outcome, emitted_chunks)
+
+    async def _open_stream(self, call_state, attempt):
+        model = self.sync_model
+        contents = model._prepare_attempt(call_state, attempt)
+        model._attempt_admitted(call_state, await model._admit_upstream_async(model._contents_tokens(contents)), contents)
+        return await model.backend.stream_content_async(model.model_instance, contents, model._call_generation_config(call_state))
+
+
+# --- Async Orchestrator ---
+# Wraps one session's make_model1. Turns of the same conversation are serialised by a
+# lock (they share the context window); different conversations run concurrently.
+class AsyncOrchestrator:
+    def __init__(self, sync_model1, limiter=shared_in_flight_limiter):
+        self.sync_model = sync_model1
+        self.limiter = limiter
+        self._turn_lock = asyncio.Lock()
+
+    async def __call__(self, user_prompt_for_current_turn, ui_chat_history_for_context=None):
+        model = self.sync_model
+        if model.traffic_recorder is None:
+            return await self._orchestrate(user_prompt_for_current_turn, ui_chat_history_for_context)
+        started_at, model._turn_upstream_seconds = time.perf_counter(), 0.0
+        directive = await self._orchestrate(user_prompt_for_current_turn, ui_chat_history_for_context)
+        model.traffic_recorder.record_directive(model.__class__.__name__, user_prompt_for_current_turn, directive,
+                                                time.perf_counter() - started_at, model._turn_upstream_seconds)
+        return directive
+
+    async def _orchestrate(self, user_prompt_for_current_turn, ui_chat_history_for_context):
+        model = self.sync_model
+        async with self._turn_lock:
+            try:
+                directive = model._route_locally(user_prompt_for_current_turn)
+                if directive is not None:
+                    return directive
+                # Context building, the response cache and the directive log are blocking work.
+                contextual_prompt_for_model1, cache_key, raw_text = await asyncio.to_thread(model._begin_turn, user_prompt_for_current_turn, ui_chat_history_for_context)
+                if raw_text is None:
+                    try:
+                        async with self.limiter:
+                            response = await model.resilience.acall(model.model_name, lambda: model._send_turn_async(contextual_prompt_for_model1))
+                    except BaseException:
+                        model.context_manager.discard_pending_turn()
+                        raise
+                    raw_text = response.text.strip()
+                return await asyncio.to_thread(model._finish_turn, raw_text, cache_key)
+            except asyncio.CancelledError:
+                raise
+            except TokenBudgetExceeded as e:
+                return fallback_directive(str(e))
+            except Exception as e:
+                print(f'ERROR (AsyncOrchestrator) during response generation: {e}')
+                return fallback_directive(f"Sorry, an internal error occurred in Model 1: {e}")
@@ -0,0 +1,340 @@
+import argparse
+import contextlib
+import io
+import json
+import random
+import re
+import sys
+import time
+import tracemalloc
+from code_compression import DEFAULT_CODE_FIDELITY, FIDELITY_LEVELS
+from intent_router import shared_intent_router
+from llm_backends import FakeBackend, constant_latency, contents_to_text, lognormal_latency
+from model1 import make_model1, make_model3, make_model4, make_model5, make_model_ml_optimizer
+from stream_renderer import IncrementalStreamRenderer, display_ai_parts_from_string
+
+ACTION_MODEL_CLASSES = {
+    "generate_new_code_m3": make_model3,
+    "fix_and_verify_code_m4": make_model4,
+    "iteratively_perfect_code_m5": make_model5,
+    "optimize_ml_solution_m_ml": make_model_ml_optimizer,
+}
+DEFAULT_MIX = "generate_new_code_m3=0.4,fix_and_verify_code_m4=0.3,iteratively_perfect_code_m5=0.15,optimize_ml_solution_m_ml=0.15"
+STAGES = ["orchestrator", "ttft", "stream", "render", "parse", "total"]
+SIZE_BUCKETS = [(0, 4096), (4096, 16384), (16384, 65536), (65536, None)]
+_BENCH_TAG = re.compile(r"\[bench:(\w+):(\d+)\]")
+_CURRENT_REQUEST_TAG = re.compile(r'Current user request: \\?"\[bench:(\w+):(\d+)\]')
+_CURRENT_REQUEST = re.compile(r'Current user request: "(.*?)"\n\n', re.S)
+
+
+# --- Null Streamlit Container ---
+# Accepts every call the renderer/parser make, so only their own cost is measured.
+class NullContainer:
+    def empty(self): return self
+    def container(self): return self
+    def markdown(self, *args, **kwargs): pass
+    def code(self, *args, **kwargs): pass
+    def json(self, *args, **kwargs): pass
+    def warning(self, *args, **kwargs): pass
+
+
+def synthetic_answer(action, target_chars, rng):
+    lines, size = [], 0
+    while size < target_chars:
+        line = f"    result_{len(lines)} = compute_step({len(lines)}, data[{rng.randint(0, 999)}])  # stage {len(lines) % 7}"
+        lines.append(line)
+        size += len(line) + 1
+    code = "import sys\n\ndef main(data):\n" + "\n".join(lines) + "\n    return 0\n"
+    if action == "generate_new_code_m3":
+        return "# Standard Library Only - No external setup required.\n" + code
+    report = {"report": {"action": action, "issues_found": rng.randint(0, 5), "verified": True,
+                         "notes": [f"note {i}" for i in range(rng.randint(1, 6))]}}
+    return f"```json\n{json.dumps(report, indent=2)}\n```\n```python\n{code}```\n"
+
+
+# Orchestrator answers come from the [bench:action:chars] tag in the user request; the
+# specialized models answer with a synthetic response of the tagged size.
+def make_bench_responses(seed):
+    rng = random.Random(seed)
+
+    def responses(model_handle, contents):
+        text = json.dumps(contents, default=str)
+        # Earlier requests' tags can be in the history; the current request's tag wins.
+        tags = _CURRENT_REQUEST_TAG.findall(text) or _BENCH_TAG.findall(text)
+        action, target_chars = (tags[-1][0], int(tags[-1][1])) if tags else ("generate_new_code_m3", 2000)
+        if "AI Orchestrator" in model_handle.system_instruction:
+            return json.dumps({
+                "is_code_related": True, "user_facing_acknowledgement": "On it.",
+                "action_for_next_model": action,
+                "prompt_for_next_model": f"<RequestDetails>[bench:{action}:{target_chars}] benchmark request</RequestDetails>",
+                "library_constraints_for_next_model": None,
+            })
+        return synthetic_answer(action, target_chars, rng)
+    return responses
+
+
+# --- Follow-up Routing Set ---
+# Follow-ups whose right route depends on code from an earlier turn, labeled with the
+# route Model1 should pick when it can see that code in full. The stand-in orchestrator
+# routes them from the evidence left in its context (imports, docstrings, markers in
+# function bodies), so scoring the set at each fidelity level shows which compression
+# loses what routing needs, and --compare fails when a level starts losing more.
+_ROUTING_EVIDENCE = [
+    ("optimize_ml_solution_m_ml", re.compile(r"\b(sklearn|torch|xgboost|train_test_split|classifier|regressor)\b", re.I)),
+    ("fix_and_verify_code_m4", re.compile(r"(Traceback|NotImplementedError|# BUG\b|FIXME)")),
+    ("iteratively_perfect_code_m5", re.compile(r"\b(TODO|flaky|intermittent\w*)\b", re.I)),
+]
+
+def earlier_code(purpose, imports=(), marker="", marked_docstring="", helpers=10):
+    lines = [f'"""{purpose}"""', *imports, "", "THRESHOLD = 0.5", ""]
+    for index in range(helpers):
+        docstring = marked_docstring if marked_docstring and index == helpers // 2 else f"Stage {index} of the pipeline."
+        lines += [f"def step_{index}(rows):", f'    """{docstring}"""', f"    total = sum(row[{index % 3}] for row in rows)"]
+        if marker and index == helpers // 2: lines.append(f"    {marker}")
+        lines += [f"    return total * {index + 1}", ""]
+    return "\n".join(lines + ["if __name__ == '__main__':", "    print(step_0([[1, 2, 3]]))"])
+
+FOLLOW_UP_CASES = [
+    ("make it faster on the full data", earlier_code("Churn scoring.", ["from sklearn.linear_model import LogisticRegression", "import numpy as np"]), "optimize_ml_solution_m_ml"),
+    ("make it faster on the full data", earlier_code("Train a classifier that predicts churn from usage rows.", ["import numpy as np"]), "optimize_ml_solution_m_ml"),
+    ("it gets better results with more epochs, go ahead", earlier_code("Image tagging.", ["import torch", "import torch.nn as nn"]), "optimize_ml_solution_m_ml"),
+    ("the totals still look wrong, sort it out", earlier_code("Summarise order totals.", ["import csv"], marker="raise NotImplementedError  # BUG: totals are off by one"), "fix_and_verify_code_m4"),
+    ("please take care of that", earlier_code("Merge two inventory files.", ["import json"], marker="# FIXME: crashes on duplicate SKUs"), "fix_and_verify_code_m4"),
+    ("keep going until it is solid", earlier_code("Resize uploaded images.", ["import os"], marked_docstring="TODO: flaky on empty folders."), "iteratively_perfect_code_m5"),
+    ("add a command line interface", earlier_code("Rename files by date.", ["import os", "import datetime"]), "generate_new_code_m3"),
+    ("also write a README section for it", earlier_code("Count words in text files.", ["import collections"]), "generate_new_code_m3"),
+]
+
+def follow_up_orchestrator(model_handle, contents):
+    text = contents_to_text(contents)
+    request = _CURRENT_REQUEST.search(text)
+    context = text[:request.start()] + text[request.end():] if request else text
+    action = next((label for label, pattern in _ROUTING_EVIDENCE if pattern.search(context)), "generate_new_code_m3")
+    return json.dumps({"is_code_related": True, "user_facing_acknowledgement": "On it.", "action_for_next_model": action,
+                       "prompt_for_next_model": f"<RequestDetails>{request.group(1) if request else ''}</RequestDetails>",
+                       "library_constraints_for_next_model": None})
+
+# Share of FOLLOW_UP_CASES routed to their label, each in a fresh session whose earlier
+# turn produced the code.
+def follow_up_routing_accuracy(fidelity):
+    backend = FakeBackend(responses=follow_up_orchestrator)
+    correct = 0
+    for follow_up, code, expected_action in FOLLOW_UP_CASES:
+        model1_instance, history = new_session(backend, fidelity)
+        model1_instance.intent_router = None  # Only the orchestrator's reading of the context is scored.
+        history += [{"role": "user", "content_parts": [{"type": "text", "data": "Here is my script."}]},
+                    {"role": "assistant", "content_parts": [{"type": "code", "data": {"language": "python", "code": code}}]},
+                    {"role": "user", "content_parts": [{"type": "text", "data": follow_up}]}]
+        correct += model1_instance(follow_up, history)["action_for_next_model"] == expected_action
+    return round(correct / len(FOLLOW_UP_CASES), 4)
+
+
+def parse_mix(mix_text):
+    mix = {}
+    for item in mix_text.split(","):
+        action, weight = item.split("=")
+        if action not in ACTION_MODEL_CLASSES:
+            raise ValueError(f"Unknown action '{action}'. Known: {', '.join(ACTION_MODEL_CLASSES)}")
+        mix[action] = float(weight)
+    return mix
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+def summarise(values):
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99), "mean": sum(values) / len(values) if values else 0.0}
+
+
+# --- One Orchestrate-then-Stream Turn ---
+# Mirrors the Streamlit turn: Model1 directive -> model_map dispatch -> incremental render
+# of the stream -> display_ai_parts_from_string over the final text. Times are seconds.
+def run_turn(model1_instance, model_map, user_input, history):
+    turn_start = time.perf_counter()
+    directive = model1_instance(user_input, history)
+    orchestrator_done = time.perf_counter()
+    target_model = model_map[directive["action_for_next_model"]]
+
+    renderer = IncrementalStreamRenderer(NullContainer())
+    render_seconds, first_chunk_at = 0.0, None
+    for chunk_text in target_model(directive["prompt_for_next_model"]):
+        if first_chunk_at is None: first_chunk_at = time.perf_counter()
+        render_start = time.perf_counter()
+        renderer.append(chunk_text)
+        render_seconds += time.perf_counter() - render_start
+    render_start = time.perf_counter()
+    full_text = renderer.finish()
+    render_seconds += time.perf_counter() - render_start
+    stream_done = time.perf_counter()
+
+    parse_start = time.perf_counter()
+    parts = display_ai_parts_from_string(full_text, NullContainer())
+    parse_done = time.perf_counter()
+    first_chunk_at = first_chunk_at or stream_done
+    return {
+        "action": directive["action_for_next_model"],
+        "orchestrator_prompt_tokens": model1_instance.last_context_metrics.get("prompt_tokens", 0),
+        "response_chars": len(full_text),
+        "orchestrator": orchestrator_done - turn_start,
+        "ttft": first_chunk_at - turn_start,
+        "stream": stream_done - first_chunk_at - render_seconds,
+        "render": render_seconds,
+        "parse": parse_done - parse_start,
+        "total": parse_done - turn_start,
+        "parts": parts,
+    }
+
+
+def build_models(backend):
+    model_map = {action: model_cls(backend=backend) for action, model_cls in ACTION_MODEL_CLASSES.items()}
+    for model in model_map.values():
+        model.response_cache = None  # Every turn must exercise the full path.
+    return model_map
+
+def new_session(backend, code_fidelity=DEFAULT_CODE_FIDELITY):
+    model1_instance = make_model1(backend=backend)
+    model1_instance.response_cache = None
+    model1_instance.log_directives = False  # Synthetic requests must not reach the intent router's training log.
+    model1_instance.context_manager.code_fidelity = code_fidelity
+    return model1_instance, [{"role": "assistant", "content_parts": [{"type": "text", "data": "Hello!"}]}]
+
+
+def run_benchmark(args):
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    actions, weights = list(mix), list(mix.values())
+    backend = FakeBackend(
+        responses=make_bench_responses(args.seed), chunk_chars=args.chunk_chars,
+        tokens_per_second=args.tokens_per_second or None,
+        first_token_latency=lognormal_latency(args.ttft_ms / 1000.0) if args.ttft_ms else constant_latency(0.0),
+        request_latency=lognormal_latency(args.orchestrator_ms / 1000.0) if args.orchestrator_ms else constant_latency(0.0),
+        seed=args.seed, prefill_tokens_per_second=args.prefill_tokens_per_second or None,
+    )
+
+    turn_results, memory_peaks = [], []
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Startup work, as in the app and the service: not part of any measured turn.
+        if shared_intent_router is not None: shared_intent_router.warm_up()
+        model_map = build_models(backend)
+        model1_instance, history = new_session(backend, args.context_fidelity)
+        for turn_index in range(args.turns):
+            if turn_index and turn_index % args.turns_per_session == 0:
+                model1_instance, history = new_session(backend, args.context_fidelity)
+            action = rng.choices(actions, weights)[0]
+            response_chars = rng.randint(args.min_chars, args.max_chars)
+            user_input = f"[bench:{action}:{response_chars}] please handle this request"
+            history.append({"role": "user", "content_parts": [{"type": "text", "data": user_input}]})
+
+            measure_memory = turn_index < args.memory_turns
+            if measure_memory: tracemalloc.start()
+            result = run_turn(model1_instance, model_map, user_input, history)
+            if measure_memory:
+                memory_peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            else:
+                turn_results.append(result)  # tracemalloc skews timings; memory turns are not timed.
+            history.append({"role": "assistant", "content_parts": result.pop("parts")})
+
+    report = {"config": vars(args), "turns_timed": len(turn_results), "stages_ms": {}, "by_action_total_ms": {}, "parser_us_per_kb": {}}
+    for stage in STAGES:
+        report["stages_ms"][stage] = {k: round(v * 1000, 4) for k, v in summarise([r[stage] for r in turn_results]).items()}
+    for action in actions:
+        totals = [r["total"] for r in turn_results if r["action"] == action]
+        if totals: report["by_action_total_ms"][action] = {k: round(v * 1000, 4) for k, v in summarise(totals).items()}
+    for low, high in SIZE_BUCKETS:
+        costs = [r["parse"] * 1e6 / (r["response_chars"] / 1024) for r in turn_results
+                 if r["response_chars"] >= low and (high is None or r["response_chars"] < high) and r["response_chars"]]
+        if costs:
+            label = f"{low // 1024}-{high // 1024}KB" if high else f">{low // 1024}KB"
+            report["parser_us_per_kb"][label] = {k: round(v, 3) for k, v in summarise(costs).items()}
+    # Compressing earlier code must not cost routing accuracy on follow-ups that depend on it.
+    with contextlib.redirect_stdout(io.StringIO()):
+        report["routing_accuracy"] = {fidelity: follow_up_routing_accuracy(fidelity) for fidelity in FIDELITY_LEVELS}
+    report["orchestrator_prompt_tokens"] = {k: round(v, 1) for k, v in summarise([r["orchestrator_prompt_tokens"] for r in turn_results]).items()}
+    if memory_peaks:
+        report["peak_memory_kb"] = {k: round(v / 1024, 1) for k, v in summarise(memory_peaks).items()}
+    return report
+
+
+def print_report(report):
+    print(f"Timed turns: {report['turns_timed']}")
+    print(f"{'stage':<14}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}")
+    for stage, values in report["stages_ms"].items():
+        print(f"{stage:<14}{values['p50']:>12.3f}{values['p95']:>12.3f}{values['p99']:>12.3f}")
+    print("\nTotal turn latency by action (ms):")
+    for action, values in report["by_action_total_ms"].items():
+        print(f"  {action:<30} p50={values['p50']:.3f} p95={values['p95']:.3f} p99={values['p99']:.3f}")
+    print("\nParser cost (us per KB of response):")
+    for bucket, values in report["parser_us_per_kb"].items():
+        print(f"  {bucket:<12} p50={values['p50']:.2f} p95={values['p95']:.2f} p99={values['p99']:.2f}")
+    values = report["orchestrator_prompt_tokens"]
+    print(f"\nOrchestrator prompt tokens ({report['config']['context_fidelity']} code): p50={values['p50']} p95={values['p95']} mean={values['mean']}")
+    print("Follow-up routing accuracy: " + ", ".join(f"{fidelity}={accuracy}" for fidelity, accuracy in report["routing_accuracy"].items()))
+    if "peak_memory_kb" in report:
+        values = report["peak_memory_kb"]
+        print(f"\nPeak traced memory per turn (KB): p50={values['p50']} p95={values['p95']} p99={values['p99']}")
+
+
+# Flags stage/percentile pairs slower than baseline * (1 + tolerance) by more than min_delta_ms.
+def compare_to_baseline(report, baseline, tolerance, min_delta_ms):
+    regressions = []
+    base_accuracy = baseline.get("routing_accuracy")
+    if isinstance(base_accuracy, dict):
+        for fidelity, accuracy in report["routing_accuracy"].items():
+            if fidelity in base_accuracy and accuracy < base_accuracy[fidelity]:
+                regressions.append(f"follow-up routing accuracy ({fidelity}): {base_accuracy[fidelity]:.4f} -> {accuracy:.4f}")
+    for stage, values in report["stages_ms"].items():
+        for pct in ("p50", "p95", "p99"):
+            base_value = baseline.get("stages_ms", {}).get(stage, {}).get(pct)
+            if base_value is None: continue
+            current = values[pct]
+            if current > base_value * (1 + tolerance) and current - base_value > min_delta_ms:
+                regressions.append(f"{stage} {pct}: {base_value:.3f}ms -> {current:.3f}ms (+{(current / base_value - 1) * 100 if base_value else float('inf'):.1f}%)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the orchestrate-then-stream pipeline against the offline fake backend.")
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--turns-per-session", type=int, default=20, help="Start a fresh make_model1 session every N turns.")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Comma-separated action=weight pairs.")
+    parser.add_argument("--min-chars", type=int, default=1000)
+    parser.add_argument("--max-chars", type=int, default=32000, help="Upper bound of specialized response size (8120 tokens ~ 32k chars).")
+    parser.add_argument("--chunk-chars", type=int, default=64)
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="Simulated stream rate; 0 = unthrottled.")
+    parser.add_argument("--ttft-ms", type=float, default=0, help="Median simulated time-to-first-token (lognormal).")
+    parser.add_argument("--orchestrator-ms", type=float, default=0, help="Median simulated Model1 latency (lognormal).")
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=0, help="Simulated prompt prefill rate; 0 = free prefill.")
+    parser.add_argument("--context-fidelity", choices=FIDELITY_LEVELS, default=DEFAULT_CODE_FIDELITY, help="How earlier code is compressed in Model1's context.")
+    parser.add_argument("--memory-turns", type=int, default=20, help="Leading turns run under tracemalloc (excluded from timings).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here.")
+    parser.add_argument("--save-baseline", help="Write the JSON report as a baseline for later --compare runs.")
+    parser.add_argument("--compare", help="Baseline JSON to compare against; exits 1 on regression.")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative slowdown in --compare mode.")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5, help="Ignore regressions smaller than this (noise floor).")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args)
+    print_report(report)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as handle:
+                json.dump(report, handle, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as handle:
+            baseline = json.load(handle)
+        regressions = compare_to_baseline(report, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print("\nREGRESSIONS vs baseline:")
+            for line in regressions: print(f"  {line}")
+            return 1
+        print("\nNo regressions vs baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
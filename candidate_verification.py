@@ -0,0 +1,276 @@
+import ast
+import contextvars
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from response_cache import replay_cached_text
+from stream_parser import parse_parts
+from tracing import shared_tracer
+
+VERIFIABLE_ACTIONS = ("fix_and_verify_code_m4", "iteratively_perfect_code_m5")
+PYTHON_LANGUAGES = ("python", "py", "python3", "")
+DEFAULT_CANDIDATES = 3
+DEFAULT_TIMEOUT_SECONDS = 10.0
+MEMORY_LIMIT_BYTES = 512 * 1024 * 1024
+FILE_SIZE_LIMIT_BYTES = 16 * 1024 * 1024
+# Verification runs model-generated code on this host, so it is off unless the operator
+# sets CANDIDATE_VERIFICATION_ENABLED. Test code from users is only accepted when every
+# check runs under CANDIDATE_VERIFICATION_SANDBOX: a command prefix that really isolates
+# the interpreter (nsjail, bwrap or a container with no network and a read-only
+# filesystem), in which "{workdir}" stands for the check's scratch directory, e.g.
+#   bwrap --ro-bind / / --bind {workdir} {workdir} --chdir {workdir} --unshare-all --die-with-parent --
+VERIFICATION_ENABLED = bool(os.getenv("CANDIDATE_VERIFICATION_ENABLED"))
+VERIFICATION_SANDBOX = os.getenv("CANDIDATE_VERIFICATION_SANDBOX", "")
+
+_CANDIDATE_HINTS = [
+    "",
+    "\n<CandidateVariant>Prefer the most conservative fix: change as little of the original code as possible.</CandidateVariant>",
+    "\n<CandidateVariant>Prefer a clean rewrite of the affected code if that is more robust.</CandidateVariant>",
+    "\n<CandidateVariant>Prefer standard-library-only solutions where the constraints allow it.</CandidateVariant>",
+]
+
+# Runs the user's tests against candidate.py: top-level asserts run on import, then
+# every test_* function is called.
+_TEST_RUNNER = """
+import runpy, sys
+sys.path.insert(0, sys.argv[1])
+namespace = runpy.run_path(sys.argv[2], run_name="candidate_tests")
+for name, value in list(namespace.items()):
+    if name.startswith("test_") and callable(value):
+        value()
+"""
+
+
+def candidate_hint(index):
+    return _CANDIDATE_HINTS[index % len(_CANDIDATE_HINTS)] + (f"\n<CandidateIndex>{index}</CandidateIndex>" if index >= len(_CANDIDATE_HINTS) else "")
+
+def python_code_blocks(response_text):
+    parts, _ = parse_parts(response_text)
+    return [part["data"]["code"] for part in parts
+            if part["type"] == "code" and (part["data"].get("language") or "").lower() in PYTHON_LANGUAGES]
+
+def import_statements(tree):
+    statements = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            statements.append(ast.unparse(node))
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module != "__future__":
+            statements.append(ast.unparse(node))
+    return statements
+
+
+def _limit_resources(timeout_seconds):
+    try:
+        import resource
+    except ImportError:
+        return None
+    def apply_limits():
+        cpu_seconds = int(timeout_seconds) + 1
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds))
+        resource.setrlimit(resource.RLIMIT_AS, (MEMORY_LIMIT_BYTES, MEMORY_LIMIT_BYTES))
+        resource.setrlimit(resource.RLIMIT_FSIZE, (FILE_SIZE_LIMIT_BYTES, FILE_SIZE_LIMIT_BYTES))
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    return apply_limits
+
+
+# --- Sandboxed Verification ---
+# Each check runs in its own short-lived interpreter: isolated mode (-I), a scratch
+# working directory, no inherited environment (so no API keys), and CPU, memory, file
+# size and wall-clock limits. Without a sandbox_command that is not a security boundary
+# against hostile code (network and the filesystem stay reachable); it keeps broken or
+# runaway candidates from hurting the app. cancel_event kills the running check early.
+class SandboxedVerifier:
+    def __init__(self, timeout_seconds=DEFAULT_TIMEOUT_SECONDS, python_executable=sys.executable, sandbox_command=VERIFICATION_SANDBOX):
+        self.timeout_seconds = timeout_seconds
+        self.python_executable = python_executable
+        self.sandbox_command = shlex.split(sandbox_command or "")
+
+    # Only an isolating sandbox makes it safe to run test code a user typed in.
+    @property
+    def isolated(self):
+        return bool(self.sandbox_command)
+
+    def _run(self, args, workdir, cancel_event):
+        sandbox = [token.replace("{workdir}", workdir) for token in self.sandbox_command]
+        process = subprocess.Popen(
+            [*sandbox, self.python_executable, "-I", *args], cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            stdin=subprocess.DEVNULL, env={"PATH": os.environ.get("PATH", ""), "PYTHONDONTWRITEBYTECODE": "1"},
+            preexec_fn=_limit_resources(self.timeout_seconds), text=True,
+        )
+        deadline = time.monotonic() + self.timeout_seconds
+        try:
+            while True:
+                try:
+                    _, stderr = process.communicate(timeout=0.05)
+                    error_lines = stderr.strip().splitlines()
+                    return process.returncode == 0, error_lines[-1] if error_lines else f"exit code {process.returncode}"
+                except subprocess.TimeoutExpired:
+                    if cancel_event is not None and cancel_event.is_set():
+                        return False, "cancelled"
+                    if time.monotonic() > deadline:
+                        return False, f"timed out after {self.timeout_seconds:.0f}s"
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.communicate()
+
+    # Returns {"passed", "checks": {name: bool}, "error"}; passed is None when the
+    # response holds no Python code to check.
+    def verify(self, response_text, tests=None, cancel_event=None):
+        if tests and not self.isolated:
+            raise ValueError("User tests need an isolating sandbox_command (CANDIDATE_VERIFICATION_SANDBOX).")
+        blocks = python_code_blocks(response_text)
+        if not blocks:
+            return {"passed": None, "checks": {}, "error": "no Python code block to verify"}
+        checks = {}
+        trees = []
+        for index, code in enumerate(blocks):
+            try:
+                trees.append(ast.parse(code))
+            except SyntaxError as e:
+                checks["syntax"] = False
+                return {"passed": False, "checks": checks, "error": f"block {index + 1}: SyntaxError: {e.msg} (line {e.lineno})"}
+        checks["syntax"] = True
+
+        with tempfile.TemporaryDirectory(prefix="candidate_") as workdir:
+            imports = sorted({statement for tree in trees for statement in import_statements(tree)})
+            if imports:
+                ok, error = self._run(["-c", "\n".join(imports)], workdir, cancel_event)
+                checks["imports"] = ok
+                if not ok:
+                    return {"passed": False, "checks": checks, "error": error}
+            if tests:
+                # The longest block is taken to be the solution; tests import it as `candidate`.
+                Path(workdir, "candidate.py").write_text(max(blocks, key=len), encoding="utf-8")
+                Path(workdir, "candidate_tests.py").write_text(tests, encoding="utf-8")
+                ok, error = self._run(["-c", _TEST_RUNNER, workdir, str(Path(workdir, "candidate_tests.py"))], workdir, cancel_event)
+                checks["tests"] = ok
+                if not ok:
+                    return {"passed": False, "checks": checks, "error": error}
+        return {"passed": True, "checks": checks, "error": None}
+
+
+# --- Parallel Verified Candidates ---
+# Wraps a specialized streaming model for the fix/refine actions: K differently-hinted
+# requests run concurrently, each full response is verified as soon as it completes,
+# and the first one that passes wins; the other generations are closed (which stops
+# their upstream streams) and their checks killed. If none pass, the candidate that got
+# furthest through the checks is returned with a note. The winner is replayed in chunks
+# so callers consume it like a normal stream.
+class VerifiedCandidateRunner:
+    def __init__(self, model, candidates=DEFAULT_CANDIDATES, verifier=None):
+        self.model = model
+        self.candidates = candidates
+        self.verifier = verifier or SandboxedVerifier()
+        self.model_label = getattr(model, "model_label", model.__class__.__name__)
+        self._lock = threading.Lock()
+        self.counters = {"runs": 0, "verified_runs": 0, "unverified_runs": 0, "candidates_started": 0,
+                         "candidates_passed": 0, "candidates_failed": 0, "candidates_cancelled": 0,
+                         "winner_seconds_total": 0.0}
+
+    def _generate_and_verify(self, index, prompt, tests, cancel_event, started_at):
+        stream = self.model(prompt + candidate_hint(index))
+        chunks = []
+        try:
+            for chunk_text in stream:
+                if cancel_event.is_set():
+                    return {"index": index, "cancelled": True}
+                chunks.append(chunk_text)
+        finally:
+            stream.close()
+        generated_at = time.perf_counter()
+        response_text = "".join(chunks)
+        result = self.verifier.verify(response_text, tests, cancel_event)
+        finished_at = time.perf_counter()
+        shared_tracer.metrics.observe("candidate_latency_seconds", finished_at - started_at, model=self.model_label,
+                                      outcome={True: "passed", False: "failed", None: "unverifiable"}[result["passed"]])
+        return dict(result, index=index, cancelled=False, text=response_text,
+                    generation_seconds=generated_at - started_at, verification_seconds=finished_at - generated_at)
+
+    def __call__(self, prompt_content_for_model, tests=None):
+        yield from replay_cached_text(self.run(prompt_content_for_model, tests))
+
+    # Returns the chosen response text with a short verification note appended.
+    def run(self, prompt_content_for_model, tests=None):
+        if tests and not self.verifier.isolated:
+            print("WARNING (VerifiedCandidateRunner): Ignoring user tests; no isolating sandbox is configured.")
+            tests = None
+        cancel_event = threading.Event()
+        started_at = time.perf_counter()
+        results = []
+        with shared_tracer.span("candidates", model=self.model_label, candidates=self.candidates) as span:
+            executor = ThreadPoolExecutor(max_workers=self.candidates, thread_name_prefix="candidate")
+            try:
+                # Each worker keeps the caller's trace and session (for scheduler fairness).
+                futures = [executor.submit(contextvars.copy_context().run, self._generate_and_verify, index, prompt_content_for_model, tests, cancel_event, started_at)
+                           for index in range(self.candidates)]
+                winner = self._first_passing(futures, results, cancel_event)
+            finally:
+                cancel_event.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+            elapsed = time.perf_counter() - started_at
+            span.set(passed=winner is not None and winner["passed"] is True, candidates_finished=len(results))
+        self._record(winner, results, elapsed)
+        if winner is None:
+            return "\n\n--- ERROR: No candidate completed. ---\n\n"
+        return winner["text"] + self._note(winner, len(results), elapsed)
+
+    def _first_passing(self, futures, results, cancel_event):
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"WARNING (VerifiedCandidateRunner): Candidate failed: {e}")
+                    continue
+                if result.get("cancelled"): continue
+                results.append(result)
+                if result["passed"] is True:
+                    cancel_event.set()
+                    return result
+        # Nothing passed: prefer a candidate with code to one with nothing to check, then the
+        # one that cleared the most checks, then the earliest.
+        if not results:
+            return None
+        return max(results, key=lambda result: (result["passed"] is not None, sum(result["checks"].values()), -result["index"]))
+
+    def _record(self, winner, results, elapsed):
+        passed = sum(1 for result in results if result["passed"] is True)
+        failed = sum(1 for result in results if result["passed"] is False)
+        with self._lock:
+            self.counters["runs"] += 1
+            self.counters["candidates_started"] += self.candidates
+            self.counters["candidates_passed"] += passed
+            self.counters["candidates_failed"] += failed
+            self.counters["candidates_cancelled"] += self.candidates - len(results)
+            if winner is not None and winner["passed"] is True:
+                self.counters["verified_runs"] += 1
+                self.counters["winner_seconds_total"] += elapsed
+            else:
+                self.counters["unverified_runs"] += 1
+        shared_tracer.count("candidate_runs_total", model=self.model_label, outcome="verified" if winner is not None and winner["passed"] is True else "unverified")
+
+    def _note(self, winner, finished, elapsed):
+        if winner["passed"] is True:
+            checks = ", ".join(winner["checks"])
+            return f"\n\n*Verified locally ({checks}) — candidate {winner['index'] + 1} of {self.candidates}, {elapsed:.1f}s.*"
+        if winner["passed"] is None:
+            return f"\n\n*Not verified locally: {winner['error']}.*"
+        return f"\n\n*No candidate passed local verification ({finished} checked); showing the closest. Last error: {winner['error']}*"
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        finished = stats["candidates_passed"] + stats["candidates_failed"]
+        stats["candidate_pass_rate"] = round(stats["candidates_passed"] / finished, 4) if finished else None
+        stats["mean_seconds_to_verified"] = round(stats["winner_seconds_total"] / stats["verified_runs"], 3) if stats["verified_runs"] else None
+        del stats["winner_seconds_total"]
+        return stats
@@ -0,0 +1,132 @@
+import argparse
+import ast
+import os
+import re
+import sys
+from functools import lru_cache
+
+# How much of earlier code the orchestrator sees, most to least:
+#   full        verbatim
+#   truncate    first/last lines (the original behaviour)
+#   outline     imports, top-level constants, signatures, class outlines, docstring summaries
+#   signatures  imports and def/class lines only
+FIDELITY_LEVELS = ("full", "truncate", "outline", "signatures")
+DEFAULT_CODE_FIDELITY = os.getenv("CONTEXT_CODE_FIDELITY", "outline")
+MAX_OUTLINE_LINES = 80
+PYTHON_LANGUAGES = ("python", "py", "python3")
+
+_REGEX_OUTLINE = re.compile(
+    r"^\s*(?:#include\b|import\b|from\s+\S+\s+import\b|using\b|require\(|package\b|"
+    r"(?:export\s+)?(?:default\s+)?(?:async\s+)?(?:function|class|interface|struct|enum|trait|impl|fn|func|def|module|type)\b|"
+    r"(?:public|private|protected|static|final|abstract|internal)\b[^;=]*\(|"
+    r"(?:const|let|var)\s+\w+\s*=\s*(?:async\s*)?(?:\([^)]*\)|\w+)\s*=>)"
+)
+
+
+def truncate_code(code, max_lines=40, head_lines=25):
+    lines = code.splitlines()
+    if len(lines) <= max_lines:
+        return code
+    tail_lines = max_lines - head_lines
+    omitted = len(lines) - head_lines - tail_lines
+    return "\n".join(lines[:head_lines] + [f"# ... [{omitted} lines truncated] ..."] + lines[-tail_lines:])
+
+def _docstring_summary(node):
+    docstring = ast.get_docstring(node, clean=True)
+    if not docstring:
+        return None
+    first_line = docstring.strip().splitlines()[0]
+    return first_line if len(first_line) <= 100 else first_line[:97] + "..."
+
+def _signature(node):
+    prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+    returns = f" -> {ast.unparse(node.returns)}" if node.returns is not None else ""
+    return f"{prefix} {node.name}({ast.unparse(node.args)}){returns}:"
+
+def _outline_body(body, indent, with_docstrings, lines):
+    for node in body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            lines.append(indent + ast.unparse(node))
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            if with_docstrings:
+                lines.extend(indent + "@" + ast.unparse(decorator) for decorator in node.decorator_list)
+            if isinstance(node, ast.ClassDef):
+                bases = ", ".join(ast.unparse(base) for base in node.bases + node.keywords)
+                lines.append(f"{indent}class {node.name}({bases}):" if bases else f"{indent}class {node.name}:")
+            else:
+                lines.append(indent + _signature(node))
+            summary = _docstring_summary(node) if with_docstrings else None
+            if summary: lines.append(f'{indent}    """{summary}"""')
+            if isinstance(node, ast.ClassDef):
+                nested = len(lines)
+                _outline_body(node.body, indent + "    ", with_docstrings, lines)
+                if len(lines) == nested: lines.append(indent + "    ...")
+            else:
+                lines.append(indent + "    ...")
+        elif with_docstrings and not indent and isinstance(node, (ast.Assign, ast.AnnAssign)):
+            source = ast.unparse(node)
+            lines.append(source if len(source) <= 100 else source[:97] + "...")
+        elif with_docstrings and not indent and isinstance(node, ast.If) and "__name__" in ast.unparse(node.test):
+            lines.append(f"if {ast.unparse(node.test)}:")
+            lines.append("    ...")
+
+def python_outline(code, with_docstrings=True):
+    tree = ast.parse(code)
+    lines = []
+    summary = _docstring_summary(tree) if with_docstrings else None
+    if summary: lines.append(f'"""{summary}"""')
+    _outline_body(tree.body, "", with_docstrings, lines)
+    return "\n".join(lines)
+
+# Non-Python (or unparsable) code: keep import and declaration lines.
+def regex_outline(code):
+    return "\n".join(line.rstrip() for line in code.splitlines() if _REGEX_OUTLINE.match(line))
+
+
+# --- Code Compression for the Orchestrator Context ---
+# Model1 only needs to know what earlier code is (its imports, names, signatures and
+# what each piece is for) to route the next request, not every line of it. Python is
+# reduced through ast; other languages (or code that does not parse) keep their
+# import and declaration lines. Short code is left alone. Results are cached on the
+# code text, so each message's code is compressed once however often it is re-formatted.
+@lru_cache(maxsize=512)
+def compress_code(code, language="python", fidelity=DEFAULT_CODE_FIDELITY, max_lines=40):
+    if fidelity == "full":
+        return code
+    if fidelity == "truncate" or len(code.splitlines()) <= max_lines:
+        return truncate_code(code, max_lines)
+    outline = None
+    if (language or "python").lower() in PYTHON_LANGUAGES:
+        try:
+            outline = python_outline(code, with_docstrings=fidelity == "outline")
+        except (SyntaxError, ValueError, RecursionError):
+            outline = None
+    if outline is None:
+        outline = regex_outline(code)
+    if not outline.strip():
+        return truncate_code(code, max_lines)
+    omitted = len(code.splitlines()) - len(outline.splitlines())
+    outline = truncate_code(outline, MAX_OUTLINE_LINES, MAX_OUTLINE_LINES * 2 // 3)
+    return f"# [{fidelity} of {len(code.splitlines())} lines; bodies omitted]\n{outline}" if omitted > 0 else outline
+
+
+def main(argv=None):
+    from conversation_context import estimate_tokens
+    parser = argparse.ArgumentParser(description="Show how a source file is compressed for the orchestrator context at each fidelity level.")
+    parser.add_argument("path")
+    parser.add_argument("--language", default=None, help="Defaults to python for .py files, else a regex outline.")
+    parser.add_argument("--fidelity", choices=FIDELITY_LEVELS, help="Print the compressed text at this level instead of the token table.")
+    args = parser.parse_args(argv)
+    with open(args.path, "r", encoding="utf-8") as handle:
+        code = handle.read()
+    language = args.language or ("python" if args.path.endswith(".py") else os.path.splitext(args.path)[1].lstrip("."))
+    if args.fidelity:
+        print(compress_code(code, language, args.fidelity))
+        return 0
+    for fidelity in FIDELITY_LEVELS:
+        print(f"{fidelity:<12}{estimate_tokens(compress_code(code, language, fidelity)):>8} tokens")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,289 @@
+import ast
+import difflib
+import re
+import threading
+import time
+from conversation_context import estimate_tokens
+from response_cache import replay_cached_text
+from stream_parser import parse_parts
+from tracing import shared_tracer
+
+PATCHABLE_ACTIONS = ("fix_and_verify_code_m4", "iteratively_perfect_code_m5")
+MIN_PATCH_LINES = 30  # Below this a full answer costs about as much as a patch.
+FUZZY_MATCH_RATIO = 0.85
+FUZZY_AMBIGUITY_MARGIN = 0.05  # A fuzzy match must beat any other (non-overlapping) place by this much.
+PYTHON_LANGUAGES = ("python", "py", "python3")
+
+_CODE_INPUT_RE = re.compile(r"<(CodeToFix|CodeToPerfect)(?:\s+language=['\"]?([\w+#.-]*)['\"]?)?\s*>\n?(.*?)\n?</\1>", re.S)
+_EDIT_BLOCK_RE = re.compile(r"<{5,9} SEARCH[^\n]*\n(.*?)\n?={5,9}\n(.*?)\n?>{5,9} REPLACE[^\n]*", re.S)
+_DIFF_FENCE_RE = re.compile(r"```(?:diff|patch)[^\n]*\n(.*?)```", re.S)
+_HUNK_HEADER_RE = re.compile(r"^@@ .* @@")
+_SEARCH_MARKER_RE = re.compile(r"^<{5,9} SEARCH")
+
+PATCH_MODE_INSTRUCTIONS = """
+<OutputMode>PATCH</OutputMode>
+<PatchFormat>Keep PART 1 (the JSON report) exactly as specified. For PART 2, do NOT repeat the whole program: output a single ```diff block containing only SEARCH/REPLACE edits against the code in the input tag, in file order, each in this exact form:
+<<<<<<< SEARCH
+[lines copied verbatim from the original, with enough unchanged context to be unique]
+=======
+[the replacement lines]
+>>>>>>> REPLACE
+An empty SEARCH section appends the replacement to the end of the file.</PatchFormat>"""
+
+
+class PatchError(ValueError):
+    pass
+
+
+# Returns (language, code) of the code the user submitted for fixing, or None.
+def extract_code_input(prompt):
+    match = _CODE_INPUT_RE.search(prompt)
+    if not match or not match.group(3).strip():
+        return None
+    return (match.group(2) or "python").lower(), match.group(3)
+
+def parse_edit_blocks(response_text):
+    return [(search, replace) for search, replace in _EDIT_BLOCK_RE.findall(response_text)]
+
+# Unified diff hunks as (search, replace) pairs: context and '-' lines vs context and '+' lines.
+def parse_unified_diff(diff_text):
+    edits, search, replace, in_hunk = [], [], [], False
+    for line in diff_text.splitlines():
+        if _HUNK_HEADER_RE.match(line):
+            if in_hunk and (search or replace): edits.append(("\n".join(search), "\n".join(replace)))
+            search, replace, in_hunk = [], [], True
+        elif not in_hunk or line.startswith(("--- ", "+++ ", "\\")):
+            continue
+        elif line.startswith("-"):
+            search.append(line[1:])
+        elif line.startswith("+"):
+            replace.append(line[1:])
+        else:
+            context = line[1:] if line.startswith(" ") else line
+            search.append(context)
+            replace.append(context)
+    if in_hunk and (search or replace): edits.append(("\n".join(search), "\n".join(replace)))
+    return edits
+
+def parse_edits(response_text):
+    edits = parse_edit_blocks(response_text)
+    if edits:
+        return edits
+    for diff_text in _DIFF_FENCE_RE.findall(response_text):
+        edits.extend(parse_unified_diff(diff_text))
+    return edits
+
+
+def _indent(line):
+    return line[:len(line) - len(line.lstrip())]
+
+# Finds search_lines in lines (from `start` first, then anywhere). Returns
+# (index, kind): exact, whitespace-insensitive, or difflib-fuzzy above FUZZY_MATCH_RATIO.
+# A fuzzy match that another place in the file nearly equals (near-duplicate blocks) is
+# refused rather than guessed.
+def _locate(lines, search_lines, start):
+    size = len(search_lines)
+    candidates = list(range(start, len(lines) - size + 1)) + list(range(0, min(start, len(lines) - size + 1)))
+    for index in candidates:
+        if lines[index:index + size] == search_lines:
+            return index, "exact"
+    stripped = [line.strip() for line in search_lines]
+    for index in candidates:
+        if [line.strip() for line in lines[index:index + size]] == stripped:
+            return index, "whitespace"
+    target = "\n".join(stripped)
+    scored = []
+    for index in candidates:
+        ratio = difflib.SequenceMatcher(None, target, "\n".join(line.strip() for line in lines[index:index + size]), autojunk=False).ratio()
+        if ratio > FUZZY_MATCH_RATIO: scored.append((ratio, index))
+    if not scored:
+        raise PatchError(f"SEARCH block not found: {search_lines[0].strip()[:60]!r}")
+    best_ratio, best_index = max(scored, key=lambda item: item[0])
+    if any(best_ratio - ratio < FUZZY_AMBIGUITY_MARGIN for ratio, index in scored if abs(index - best_index) >= size):
+        raise PatchError(f"SEARCH block matches more than one place: {search_lines[0].strip()[:60]!r}")
+    return best_index, "fuzzy"
+
+# Re-bases the replacement on the indentation actually found in the file.
+def _reindent(replace_lines, search_lines, matched_lines):
+    search_first = next((line for line in search_lines if line.strip()), None)
+    matched_first = next((line for line in matched_lines if line.strip()), None)
+    if search_first is None or matched_first is None or _indent(search_first) == _indent(matched_first):
+        return replace_lines
+    found, expected = _indent(matched_first), _indent(search_first)
+    rebased = []
+    for line in replace_lines:
+        if line.startswith(expected): rebased.append(found + line[len(expected):])
+        else: rebased.append(line)
+    return rebased
+
+# Applies edits in order; returns (patched_code, match kinds). Raises PatchError.
+def apply_edits(original, edits):
+    lines = original.split("\n")
+    cursor, kinds = 0, []
+    for search, replace in edits:
+        search_lines = search.split("\n") if search.strip() else []
+        replace_lines = replace.split("\n") if replace else []
+        if not search_lines:
+            lines.extend(replace_lines)
+            kinds.append("append")
+            continue
+        while search_lines and not search_lines[-1].strip(): search_lines.pop()
+        index, kind = _locate(lines, search_lines, cursor)
+        matched = lines[index:index + len(search_lines)]
+        lines[index:index + len(search_lines)] = _reindent(replace_lines, search_lines, matched)
+        cursor = index + len(replace_lines)
+        kinds.append(kind)
+    return "\n".join(lines), kinds
+
+def _same_language(language, other):
+    if language in ("", "infer"):
+        return other != "json"
+    return language == other or (language in PYTHON_LANGUAGES and other in PYTHON_LANGUAGES)
+
+# A full program in the input's language; the JSON report fence alone does not count.
+def has_code_part(response_text, language):
+    parts, _ = parse_parts(response_text)
+    return any(part["type"] == "code" and _same_language(language, (part["data"].get("language") or "").lower()) for part in parts)
+
+def validate_patched(original, patched, language):
+    if patched.strip() == original.strip():
+        raise PatchError("patch made no changes")
+    if language in PYTHON_LANGUAGES:
+        try:
+            ast.parse(patched)
+        except SyntaxError as e:
+            raise PatchError(f"patched code does not parse: {e.msg} (line {e.lineno})")
+
+
+# Lets PART 1 (text and the ```json report) through line by line while the reply streams,
+# and holds back everything from the first edit on: a SEARCH marker or any other fence.
+# `text` is the whole reply so far, `shown_chars` how much of it went to the user.
+class _ReportStreamer:
+    def __init__(self):
+        self.text, self.shown_chars = "", 0
+        self._holding, self._in_json_fence = False, False
+
+    def feed(self, chunk_text):
+        self.text += chunk_text
+        if self._holding:
+            return ""
+        start = position = self.shown_chars
+        for line in self.text[start:self.text.rfind("\n") + 1].splitlines(keepends=True):
+            if self._starts_edits(line):
+                self._holding = True
+                break
+            position += len(line)
+        self.shown_chars = position
+        return self.text[start:position]
+
+    # The last line has no newline; it is shown unless it starts the edits.
+    def close(self):
+        if self._holding or self._starts_edits(self.text[self.shown_chars:]):
+            self._holding = True
+            return ""
+        start, self.shown_chars = self.shown_chars, len(self.text)
+        return self.text[start:]
+
+    def _starts_edits(self, line):
+        stripped = line.strip()
+        if self._in_json_fence:
+            if stripped == "```": self._in_json_fence = False
+            return False
+        if stripped.startswith("```"):
+            self._in_json_fence = stripped[3:].strip().lower() == "json"
+            return not self._in_json_fence
+        return bool(_SEARCH_MARKER_RE.match(stripped))
+
+
+# --- Patch Mode for Code-Fixing Models ---
+# Wraps make_model4 / make_model5. When the prompt carries the user's code (CodeToFix /
+# CodeToPerfect, at least min_lines long), the model is asked for SEARCH/REPLACE edits
+# (unified diff hunks are accepted too) instead of the whole program. The edits are
+# applied locally (exact, then whitespace-insensitive, then fuzzy context matching) and
+# the result is validated; the user sees the report, a diff and the full patched code.
+# Anything that does not apply cleanly falls back to normal full regeneration. The report
+# streams as it arrives; the diff and patched code can only follow once the whole reply
+# is in, and a fallback costs a second full generation.
+class PatchModeModel:
+    def __init__(self, model, min_lines=MIN_PATCH_LINES):
+        self.model = model
+        self.min_lines = min_lines
+        self.model_label = f"{model.__class__.__name__}+patch"
+        self._lock = threading.Lock()
+        self.counters = {"patch_attempts": 0, "applied": 0, "fuzzy_applied": 0, "full_answers": 0, "fallbacks": 0,
+                         "not_eligible": 0, "output_tokens_saved": 0, "est_seconds_saved": 0.0}
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self.counters[name] += amount
+
+    def __call__(self, prompt_content_for_model):
+        code_input = extract_code_input(prompt_content_for_model)
+        if code_input is None or len(code_input[1].splitlines()) < self.min_lines:
+            self._count(not_eligible=1)
+            yield from self.model(prompt_content_for_model)
+            return
+        language, original = code_input
+        self._count(patch_attempts=1)
+        streamer = _ReportStreamer()
+        with shared_tracer.span("patch_mode", model=self.model_label, original_lines=len(original.splitlines())) as span:
+            started_at, consumer_seconds = time.perf_counter(), 0.0
+            for chunk_text in self.model(prompt_content_for_model + PATCH_MODE_INSTRUCTIONS):
+                report_text = streamer.feed(chunk_text)
+                if report_text:
+                    yielded_at = time.perf_counter()
+                    yield report_text
+                    consumer_seconds += time.perf_counter() - yielded_at
+            report_text = streamer.close()
+            if report_text: yield report_text
+            generation_seconds = time.perf_counter() - started_at - consumer_seconds
+            output, outcome = self._apply(streamer.text, streamer.shown_chars, original, language, generation_seconds)
+            span.set(outcome=outcome)
+        shared_tracer.count("patch_mode_total", model=self.model_label, outcome=outcome)
+        if output is not None:
+            yield from replay_cached_text(output)
+            return
+        self._count(fallbacks=1)
+        yield "\n\n*Patch could not be applied cleanly; regenerating the full program.*\n\n"
+        yield from self.model(prompt_content_for_model)
+
+    # Returns (the rest of the text to show, or None to fall back; outcome label). The
+    # first shown_chars of response_text were already streamed.
+    def _apply(self, response_text, shown_chars, original, language, generation_seconds):
+        edits = parse_edits(response_text)
+        if not edits:
+            # The model answered with the full program anyway; that is a usable answer.
+            if not has_code_part(response_text, language):
+                return None, "no_edits"
+            self._count(full_answers=1)
+            return response_text[shown_chars:], "full_answer"
+        try:
+            patched, kinds = apply_edits(original, edits)
+            validate_patched(original, patched, language)
+        except PatchError as e:
+            print(f"WARNING (PatchModeModel): {e}")
+            return None, "failed"
+
+        edit_text = "".join(search + replace for search, replace in edits)
+        tokens_saved = max(0, estimate_tokens(patched) - estimate_tokens(edit_text))
+        output_tokens = estimate_tokens(response_text)
+        seconds_saved = tokens_saved / (output_tokens / generation_seconds) if generation_seconds > 0 and output_tokens else 0.0
+        fuzzy = any(kind in ("whitespace", "fuzzy") for kind in kinds)
+        self._count(applied=1, fuzzy_applied=int(fuzzy), output_tokens_saved=tokens_saved, est_seconds_saved=seconds_saved)
+        shared_tracer.count("patch_output_tokens_saved_total", amount=tokens_saved, model=self.model_label)
+
+        report = _EDIT_BLOCK_RE.sub("", response_text[shown_chars:])
+        report = _DIFF_FENCE_RE.sub("", report)
+        report = re.sub(r"```[\w-]*\s*```", "", report).strip()
+        unified = "\n".join(difflib.unified_diff(original.split("\n"), patched.split("\n"), "original", "patched", lineterm=""))
+        note = f"*Applied {len(edits)} edit(s) locally ({', '.join(sorted(set(kinds)))} match); ~{tokens_saved} output tokens saved vs. full regeneration.*"
+        output = f"{report}\n\n```diff\n{unified}\n```\n\n```{language}\n{patched}\n```\n\n{note}"
+        return output, "applied_fuzzy" if fuzzy else "applied"
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats["est_seconds_saved"] = round(stats["est_seconds_saved"], 2)
+        stats["apply_rate"] = round(stats["applied"] / stats["patch_attempts"], 4) if stats["patch_attempts"] else None
+        return stats
@@ -0,0 +1,130 @@
+import math
+import os
+import threading
+from collections import deque
+
+MAX_TOKENS_MARKER = "\n\n---MAX_TOKENS_REACHED---\n"
+CONTINUATION_INSTRUCTION = "Continue exactly where your previous response stopped. Do not repeat any text you already wrote, do not add commentary."
+DEFAULT_MAX_CONTINUATIONS = 3
+OVERLAP_WINDOW_CHARS = 240
+MIN_OVERLAP_CHARS = 12
+
+def fence_is_open(text):
+    return sum(1 for line in text.splitlines() if line.lstrip().startswith("```")) % 2 == 1
+
+# Appended before a truncation notice so the renderer does not swallow it into a code block.
+def close_open_fence(text):
+    if not fence_is_open(text):
+        return ""
+    return "```\n" if text.endswith("\n") else "\n```\n"
+
+def strip_overlap(tail, text, min_overlap=MIN_OVERLAP_CHARS):
+    for size in range(min(len(tail), len(text)), min_overlap - 1, -1):
+        if tail.endswith(text[:size]):
+            return text[size:]
+    return text
+
+
+# --- Continuation Stitching ---
+# A continuation (after MAX_TOKENS, or a retry that resumes a broken stream) is asked to
+# carry on from the emitted text, but models often re-open the code fence they were in
+# or repeat the last line. The first OVERLAP_WINDOW_CHARS of each continuation are held
+# back, a re-opened fence and any text repeating the emitted tail are dropped, and the
+# rest flows through untouched.
+class ContinuationStitcher:
+    def __init__(self, overlap_window=OVERLAP_WINDOW_CHARS):
+        self.overlap_window = overlap_window
+        self._tail = None
+        self._in_fence = False
+        self._held = []
+        self._held_chars = 0
+        self.trimmed_chars = 0
+
+    def begin(self, emitted_text):
+        self._tail = emitted_text[-self.overlap_window:]
+        self._in_fence = fence_is_open(emitted_text)
+        self._held, self._held_chars = [], 0
+
+    def feed(self, chunk_texts):
+        if self._tail is None:
+            return chunk_texts
+        self._held.extend(chunk_texts)
+        self._held_chars += sum(len(text) for text in chunk_texts)
+        if self._held_chars < self.overlap_window:
+            return []
+        return self.flush()
+
+    def flush(self):
+        if self._tail is None:
+            return []
+        held = "".join(self._held)
+        stitched = held
+        if self._in_fence and stitched.lstrip().startswith("```"):
+            first_line_end = stitched.find("\n", stitched.find("```"))
+            stitched = "" if first_line_end == -1 else stitched[first_line_end + 1:]
+        stitched = strip_overlap(self._tail, stitched)
+        self.trimmed_chars += len(held) - len(stitched)
+        self._tail, self._held, self._held_chars = None, [], 0
+        return [stitched] if stitched else []
+
+
+# --- Adaptive Output Budgets ---
+# Per model, the last `window` output lengths (in tokens) of finished answers. Once
+# min_samples are known, each call asks for p95 x headroom (rounded up to 256, within
+# [min_budget, the model's configured max]) instead of always reserving the maximum;
+# answers that outgrow it are continued automatically, and their full length feeds back
+# into the next budget.
+class OutputBudgetTracker:
+    def __init__(self, window=200, min_samples=20, percentile=0.95, headroom=1.3, min_budget=1024, granularity=256):
+        self.window = window
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_budget = min_budget
+        self.granularity = granularity
+        self._lock = threading.Lock()
+        self._lengths = {}
+        self._metrics = {}
+
+    def _model_metrics(self, model_label):
+        if model_label not in self._metrics:
+            self._metrics[model_label] = {"calls": 0, "continuations": 0, "truncated": 0, "tokens_reserved": 0, "tokens_reserved_saved": 0, "last_budget": None}
+        return self._metrics[model_label]
+
+    def _budget(self, model_label, max_output_tokens):
+        lengths = self._lengths.get(model_label)
+        if not lengths or len(lengths) < self.min_samples:
+            return max_output_tokens
+        ordered = sorted(lengths)
+        high = ordered[min(len(ordered) - 1, int(math.ceil(self.percentile * len(ordered))) - 1)]
+        budget = int(math.ceil(high * self.headroom / self.granularity) * self.granularity)
+        return max(min(self.min_budget, max_output_tokens), min(budget, max_output_tokens))
+
+    def budget_for(self, model_label, max_output_tokens):
+        with self._lock:
+            budget = self._budget(model_label, max_output_tokens)
+            metrics = self._model_metrics(model_label)
+            metrics["calls"] += 1
+            metrics["tokens_reserved"] += budget
+            metrics["tokens_reserved_saved"] += max_output_tokens - budget
+            metrics["last_budget"] = budget
+            return budget
+
+    def record(self, model_label, output_tokens, continuations=0, truncated=False):
+        with self._lock:
+            self._lengths.setdefault(model_label, deque(maxlen=self.window)).append(output_tokens)
+            metrics = self._model_metrics(model_label)
+            metrics["continuations"] += continuations
+            metrics["truncated"] += int(truncated)
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for model_label, metrics in self._metrics.items():
+                lengths = self._lengths.get(model_label) or ()
+                stats[model_label] = dict(metrics, samples=len(lengths), max_seen_tokens=max(lengths) if lengths else None)
+            return stats
+
+
+# OUTPUT_BUDGETS_DISABLED=1 always requests the configured max_output_tokens.
+shared_output_budgets = None if os.getenv("OUTPUT_BUDGETS_DISABLED") else OutputBudgetTracker()
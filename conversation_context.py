@@ -0,0 +1,201 @@
+import hashlib
+import json
+import re
+from collections import deque
+from code_compression import DEFAULT_CODE_FIDELITY, compress_code
+
+# Rough Gemini-style token estimate (~4 characters per token for English and code).
+def estimate_tokens(text):
+    if not text:
+        return 0
+    return len(text) // 4 + 1
+
+# UI history is append-only, so (position, content) identifies a message across reruns.
+# Messages read from the message store carry their own position ("seq"), which stays
+# stable when only a recent page of the history is passed in.
+def _message_fingerprint(position, msg_data):
+    position = msg_data.get("seq", position)
+    return hashlib.sha1(f"{position}:{json.dumps(msg_data, sort_keys=True, default=str)}".encode("utf-8")).hexdigest()
+
+# Text the pre-bounded make_model1 pasted into every prompt: last 6 UI messages, code verbatim.
+def legacy_history_text(ui_chat_history):
+    if not ui_chat_history or len(ui_chat_history) <= 1:
+        return ""
+    history_to_send = []
+    for msg_data in reversed(ui_chat_history[:-1]):
+        if len(history_to_send) >= 6: break
+        text_content = ""
+        for part in msg_data.get("content_parts", []):
+            if part["type"] == "text": text_content += part["data"] + " "
+            elif part["type"] == "code": text_content += f"\n```python\n{part['data']['code']}\n```\n"
+        if not msg_data.get("content_parts") and "content" in msg_data: text_content = msg_data["content"]
+        if text_content.strip():
+            history_to_send.append(f"{msg_data['role']}: {text_content.strip()}")
+    return "\n".join(reversed(history_to_send))
+
+
+# --- Token-Budgeted Conversation Window for the Orchestrator ---
+# Keeps Model1's chat history bounded: turns live in a deque, the oldest are folded
+# into a one-line-per-turn summary once the window exceeds max_context_tokens, and
+# UI messages are only pasted into a prompt the first time they are seen. Code longer
+# than max_code_lines is compressed at code_fidelity (see code_compression).
+class ConversationContextManager:
+    def __init__(self, max_context_tokens=3000, max_summary_tokens=400, max_code_lines=40, code_fidelity=DEFAULT_CODE_FIDELITY):
+        self.max_context_tokens = max_context_tokens
+        self.max_summary_tokens = max_summary_tokens
+        self.max_code_lines = max_code_lines
+        self.code_fidelity = code_fidelity
+        self.turns = deque()
+        self.summary_lines = deque()
+        self._seen_fingerprints = set()
+        self._seen_texts = set()
+        self._pending_turn = None
+        self._unbounded_history_tokens = 0
+        self.total_prompt_tokens = 0
+        self.total_tokens_saved = 0
+        self.on_commit = None  # Called with each committed turn's delta (see apply_delta), e.g. to persist it.
+
+    def _format_message(self, msg_data):
+        text_content = ""
+        for part in msg_data.get("content_parts", []):
+            if part["type"] == "text":
+                if part["data"].strip() in self._seen_texts: continue  # Already in chat history (e.g. Model1's own ack).
+                text_content += part["data"] + " "
+            elif part["type"] == "code":
+                code_data = part["data"]
+                language = code_data.get("language") or "plaintext"
+                text_content += f"\n```{language}\n{compress_code(code_data['code'], language, self.code_fidelity, self.max_code_lines)}\n```\n"
+            elif part["type"] == "json":
+                text_content += f"[JSON report with keys: {', '.join(part['data']) if isinstance(part['data'], dict) else 'n/a'}] "
+        if not msg_data.get("content_parts") and "content" in msg_data:
+            text_content = msg_data["content"]
+        return f"{msg_data['role']}: {text_content.strip()}" if text_content.strip() else ""
+
+    def build_prompt(self, user_prompt_for_current_turn, ui_chat_history_for_context=None):
+        ui_chat_history_for_context = ui_chat_history_for_context or []
+        new_context_lines = []
+        # Only marked as seen in commit_turn, so a failed send re-offers this context next turn.
+        new_fingerprints = [_message_fingerprint(i, msg_data) for i, msg_data in enumerate(ui_chat_history_for_context)]
+        for msg_data, fingerprint in zip(ui_chat_history_for_context[:-1], new_fingerprints):
+            if fingerprint in self._seen_fingerprints: continue
+            formatted = self._format_message(msg_data)
+            if formatted: new_context_lines.append(formatted)
+
+        turn_prompt = f"Current user request: \"{user_prompt_for_current_turn}\"\n\n"
+        if new_context_lines:
+            turn_prompt += "New conversation context since your last directive:\n" + "\n".join(new_context_lines)
+        turn_prompt += "\n\nBased on the current request and this history, generate your JSON directive."
+
+        full_prompt = turn_prompt
+        if self.summary_lines:
+            full_prompt = "Summary of earlier conversation:\n" + "\n".join(self.summary_lines) + "\n\n" + turn_prompt
+
+        naive_prompt = f"Current user request: \"{user_prompt_for_current_turn}\"\n\n"
+        legacy_text = legacy_history_text(ui_chat_history_for_context)
+        if legacy_text: naive_prompt += "Recent conversation history (last 3 user/assistant exchanges):\n" + legacy_text
+        naive_prompt += "\n\nBased on the current request and this history, generate your JSON directive."
+
+        history_tokens = sum(turn["tokens"] for turn in self.turns)
+        prompt_tokens = history_tokens + estimate_tokens(full_prompt)
+        naive_prompt_tokens = self._unbounded_history_tokens + estimate_tokens(naive_prompt)
+        metrics = {
+            "prompt_tokens": prompt_tokens,
+            "naive_prompt_tokens": naive_prompt_tokens,
+            "tokens_saved": max(0, naive_prompt_tokens - prompt_tokens),
+            "history_turns": len(self.turns),
+            "summarised_turns": len(self.summary_lines),
+        }
+        self._pending_turn = {
+            "user": turn_prompt, "naive_user": naive_prompt, "user_request": user_prompt_for_current_turn,
+            "fingerprints": new_fingerprints, "metrics": metrics,
+        }
+        return full_prompt, metrics
+
+    def chat_history(self):
+        history = []
+        for turn in self.turns:
+            history.append({"role": "user", "parts": [turn["user"]]})
+            history.append({"role": "model", "parts": [turn["model"]]})
+        return history
+
+    def commit_turn(self, model_response_text):
+        if self._pending_turn is None:
+            return
+        pending, self._pending_turn = self._pending_turn, None
+        json_match = re.search(r"```json\s*(\{.*?\})\s*```", model_response_text or "", re.DOTALL)
+        try:
+            directive = json.loads(json_match.group(1) if json_match else model_response_text)
+        except (json.JSONDecodeError, TypeError):
+            directive = {}
+        seen_texts = [pending["user_request"].strip()]
+        if isinstance(directive, dict) and directive.get("user_facing_acknowledgement"):
+            seen_texts.append(directive["user_facing_acknowledgement"].strip())
+
+        delta = {
+            "fingerprints": [fingerprint for fingerprint in pending["fingerprints"] if fingerprint not in self._seen_fingerprints],
+            "seen_texts": [text for text in seen_texts if text not in self._seen_texts],
+            "unbounded_tokens": estimate_tokens(pending["naive_user"]) + estimate_tokens(model_response_text),
+            "prompt_tokens": pending["metrics"]["prompt_tokens"],
+            "tokens_saved": pending["metrics"]["tokens_saved"],
+            "turn": {
+                "user": pending["user"], "model": model_response_text,
+                "tokens": estimate_tokens(pending["user"]) + estimate_tokens(model_response_text),
+                "user_request": pending["user_request"],
+                "action": directive.get("action_for_next_model") if isinstance(directive, dict) else None,
+            },
+        }
+        self.apply_delta(delta)
+        if self.on_commit is not None: self.on_commit(delta)
+
+    # Everything a committed turn changes, so another process can replay it exactly
+    # (trimming and summarising are deterministic).
+    def apply_delta(self, delta):
+        self._seen_fingerprints.update(delta["fingerprints"])
+        self._seen_texts.update(delta["seen_texts"])
+        self._unbounded_history_tokens += delta["unbounded_tokens"]
+        self.total_prompt_tokens += delta["prompt_tokens"]
+        self.total_tokens_saved += delta["tokens_saved"]
+        if delta["turn"] is None:
+            return
+        self.turns.append(dict(delta["turn"]))
+        while len(self.turns) > 1 and sum(turn["tokens"] for turn in self.turns) > self.max_context_tokens:
+            self._summarise(self.turns.popleft())
+
+    def snapshot(self):
+        return {
+            "turns": list(self.turns), "summary_lines": list(self.summary_lines),
+            "fingerprints": sorted(self._seen_fingerprints), "seen_texts": sorted(self._seen_texts),
+            "unbounded_tokens": self._unbounded_history_tokens,
+            "prompt_tokens": self.total_prompt_tokens, "tokens_saved": self.total_tokens_saved,
+        }
+
+    def restore(self, state):
+        self.turns = deque(dict(turn) for turn in state["turns"])
+        self.summary_lines = deque(state["summary_lines"])
+        self._seen_fingerprints = set(state["fingerprints"])
+        self._seen_texts = set(state["seen_texts"])
+        self._unbounded_history_tokens = state["unbounded_tokens"]
+        self.total_prompt_tokens = state["prompt_tokens"]
+        self.total_tokens_saved = state["tokens_saved"]
+        self._pending_turn = None
+
+    def _summarise(self, turn):
+        request = " ".join(turn["user_request"].split())
+        if len(request) > 160: request = request[:157] + "..."
+        self.summary_lines.append(f"- user asked: \"{request}\" -> action: {turn['action'] or 'chat'}")
+        while len(self.summary_lines) > 1 and estimate_tokens("\n".join(self.summary_lines)) > self.max_summary_tokens:
+            self.summary_lines.popleft()
+
+    def discard_pending_turn(self):
+        self._pending_turn = None
+
+    # For a turn that is never sent (rejected as over budget): its new context is marked as
+    # seen, so an oversized paste is not offered again on every later turn.
+    def skip_pending_turn(self):
+        if self._pending_turn is None:
+            return
+        pending, self._pending_turn = self._pending_turn, None
+        delta = {"fingerprints": [fingerprint for fingerprint in pending["fingerprints"] if fingerprint not in self._seen_fingerprints],
+                 "seen_texts": [], "unbounded_tokens": 0, "prompt_tokens": 0, "tokens_saved": 0, "turn": None}
+        self.apply_delta(delta)
+        if self.on_commit is not None: self.on_commit(delta)
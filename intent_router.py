@@ -0,0 +1,352 @@
+import argparse
+import json
+import math
+import os
+import pickle
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from speculative_dispatch import build_speculative_prompt, is_context_dependent, predict_action
+from traffic_capture import redact_secrets
+
+CHAT_LABEL = "chat"
+CACHE_DIR = Path(__file__).resolve().parent / ".cache"
+DEFAULT_LOG_PATH = CACHE_DIR / "directives.jsonl"
+DEFAULT_MODEL_PATH = CACHE_DIR / "intent_router.pkl"
+
+# Built-in examples so the router works before any directives have been logged.
+SEED_EXAMPLES = [
+    ("hi", CHAT_LABEL), ("hello", CHAT_LABEL), ("hey there", CHAT_LABEL), ("good morning", CHAT_LABEL),
+    ("thanks", CHAT_LABEL), ("thank you so much", CHAT_LABEL), ("thanks, that worked", CHAT_LABEL),
+    ("ok cool", CHAT_LABEL), ("bye", CHAT_LABEL), ("how are you?", CHAT_LABEL), ("who are you", CHAT_LABEL),
+    ("what can you do?", CHAT_LABEL), ("great, appreciate it", CHAT_LABEL), ("nice", CHAT_LABEL),
+    ("write a python script that renames files in a folder", "generate_new_code_m3"),
+    ("generate a function to parse csv files", "generate_new_code_m3"),
+    ("create a flask api with two endpoints", "generate_new_code_m3"),
+    ("build a command line todo app", "generate_new_code_m3"),
+    ("implement binary search in java", "generate_new_code_m3"),
+    ("write a javascript function that debounces input", "generate_new_code_m3"),
+    ("give me code to download a web page", "generate_new_code_m3"),
+    ("make a class for a bank account", "generate_new_code_m3"),
+    ("script to resize all images in a directory", "generate_new_code_m3"),
+    ("implement a linked list with insert and delete", "generate_new_code_m3"),
+    ("fix this bug: KeyError when reading the config", "fix_and_verify_code_m4"),
+    ("my code throws ImportError cannot import name AdamW from transformers", "fix_and_verify_code_m4"),
+    ("why does this crash with a traceback", "fix_and_verify_code_m4"),
+    ("this function returns the wrong result, please fix it", "fix_and_verify_code_m4"),
+    ("getting TypeError: unsupported operand types", "fix_and_verify_code_m4"),
+    ("the loop never ends, what's wrong", "fix_and_verify_code_m4"),
+    ("debug this script, it is not working", "fix_and_verify_code_m4"),
+    ("IndexError list index out of range in my code", "fix_and_verify_code_m4"),
+    ("segfault in my c program", "fix_and_verify_code_m4"),
+    ("refine this code until it runs without errors", "iteratively_perfect_code_m5"),
+    ("iterate on this script until it is perfect", "iteratively_perfect_code_m5"),
+    ("polish and perfect this module", "iteratively_perfect_code_m5"),
+    ("keep improving this code until all tests pass", "iteratively_perfect_code_m5"),
+    ("make this run flawlessly, iterate as needed", "iteratively_perfect_code_m5"),
+    ("self-correct this program until it works end to end", "iteratively_perfect_code_m5"),
+    ("train a classification model on an imbalanced dataset", "optimize_ml_solution_m_ml"),
+    ("improve my model accuracy, it overfits", "optimize_ml_solution_m_ml"),
+    ("build a regression model to predict house prices", "optimize_ml_solution_m_ml"),
+    ("tune xgboost hyperparameters for better auc", "optimize_ml_solution_m_ml"),
+    ("sklearn pipeline for text classification", "optimize_ml_solution_m_ml"),
+    ("neural network for image classification with pytorch", "optimize_ml_solution_m_ml"),
+    ("handle class imbalance with smote", "optimize_ml_solution_m_ml"),
+    ("feature engineering for a churn prediction dataset", "optimize_ml_solution_m_ml"),
+]
+
+_SMALL_TALK_REPLIES = [
+    (re.compile(r"\b(thank|thanks|thx|appreciate)", re.I), "You're welcome! Let me know if there's anything else I can help with."),
+    (re.compile(r"\b(bye|goodbye|see you)\b", re.I), "Goodbye! Come back any time you need help with code."),
+    (re.compile(r"\b(who are you|what can you do|what do you do)\b", re.I), "I'm your AI Super Coder: I can write new code, fix bugs, iteratively perfect programs and build ML solutions. What would you like to work on?"),
+]
+_DEFAULT_SMALL_TALK_REPLY = "Hello! How can I help you today?"
+
+# Only whole-input small talk is answered locally: "thanks! can you also add type hints?"
+# starts like small talk but is a request, and a canned reply would swallow it.
+_SMALL_TALK_PHRASE = (r"(hi|hello|hey|hey there|good (morning|afternoon|evening)|thanks|thank you|thank you (so|very) much|thx|"
+                      r"ok|okay|ok cool|cool|nice|great|awesome|appreciate it|(that|it) worked|bye|goodbye|see you|"
+                      r"how are you|who are you|what can you do|what do you do)")
+_WHOLE_SMALL_TALK = re.compile(rf"^\s*{_SMALL_TALK_PHRASE}([\s,.!?]+{_SMALL_TALK_PHRASE})*[\s,.!?]*$", re.I)
+_REQUEST_WORDS = re.compile(r"\b(can|could|would|will) you\b|\b(please|add|write|fix|fails?|failing|error|make|create|build|implement|"
+                            r"generate|change|update|convert|explain|why|how (do|to|can)|help me|code|script|function|bug)\b", re.I)
+
+def is_small_talk(user_input):
+    return bool(_WHOLE_SMALL_TALK.match(user_input)) and not _REQUEST_WORDS.search(user_input) and predict_action(user_input) is None
+
+def small_talk_reply(user_input):
+    for pattern, reply in _SMALL_TALK_REPLIES:
+        if pattern.search(user_input):
+            return reply
+    return _DEFAULT_SMALL_TALK_REPLY
+
+
+# --- Directive Log ---
+# Every directive Model1 actually produced, with the user input that led to it; the
+# training set for the router. Only the label fields of the directive are kept, and the
+# input goes through redact_secrets first: users paste code, keys and addresses.
+def record_directive(user_input, directive, log_path=DEFAULT_LOG_PATH):
+    label_fields = {key: directive.get(key) for key in ("is_code_related", "action_for_next_model")}
+    try:
+        Path(log_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(log_path, "a", encoding="utf-8") as handle:
+            handle.write(json.dumps({"user_input": redact_secrets(user_input), "directive": label_fields, "logged_at": time.time()}) + "\n")
+    except OSError as e:
+        print(f"WARNING (intent_router): Could not log directive: {e}")
+
+def directive_label(directive):
+    if not directive.get("is_code_related") or not directive.get("action_for_next_model"):
+        return CHAT_LABEL
+    return directive["action_for_next_model"]
+
+def load_logged_examples(log_path=DEFAULT_LOG_PATH):
+    examples = []
+    if not Path(log_path).is_file():
+        return examples
+    with open(log_path, "r", encoding="utf-8") as handle:
+        for line in handle:
+            if not line.strip(): continue
+            try:
+                record = json.loads(line)
+                examples.append((record["user_input"], directive_label(record["directive"])))
+            except (json.JSONDecodeError, KeyError, AttributeError):
+                continue
+    return examples
+
+
+def build_pipeline():
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import FeatureUnion, make_pipeline
+    features = FeatureUnion([
+        ("words", TfidfVectorizer(lowercase=True, ngram_range=(1, 2), sublinear_tf=True, min_df=1)),
+        ("chars", TfidfVectorizer(lowercase=True, analyzer="char_wb", ngram_range=(3, 5), sublinear_tf=True, min_df=1)),
+    ])
+    return make_pipeline(features, LogisticRegression(C=10.0, max_iter=2000, class_weight="balanced"))
+
+
+# The fitted pipeline re-expressed as plain dict lookups: sklearn's per-call input
+# validation costs milliseconds on a single short string, this costs tens of µs.
+# Matches predict_proba for the sublinear-tf, l2-normalised multinomial model above.
+class _CompiledScorer:
+    def __init__(self, pipeline):
+        features, classifier = pipeline.steps[0][1], pipeline.steps[-1][1]
+        self.classes = list(classifier.classes_)
+        self.intercept = [float(value) for value in classifier.intercept_]
+        self.blocks = []
+        offset = 0
+        for _, vectorizer in features.transformer_list:
+            weights = {term: (float(vectorizer.idf_[index]), [float(value) for value in classifier.coef_[:, offset + index]])
+                       for term, index in vectorizer.vocabulary_.items()}
+            self.blocks.append((vectorizer.build_analyzer(), weights))
+            offset += len(vectorizer.vocabulary_)
+
+    def predict(self, text):
+        scores = list(self.intercept)
+        for analyzer, weights in self.blocks:
+            features, norm = [], 0.0
+            for term, count in Counter(analyzer(text)).items():
+                entry = weights.get(term)
+                if entry is None: continue
+                value = (1.0 + math.log(count)) * entry[0]
+                features.append((value, entry[1]))
+                norm += value * value
+            if not features: continue
+            norm = math.sqrt(norm)
+            for value, coefficients in features:
+                value /= norm
+                for i, coefficient in enumerate(coefficients):
+                    scores[i] += value * coefficient
+        top = max(scores)
+        exps = [math.exp(score - top) for score in scores]
+        best = max(range(len(exps)), key=exps.__getitem__)
+        return self.classes[best], exps[best] / sum(exps)
+
+
+# --- Local Intent Router ---
+# TF-IDF (word + character n-grams) with logistic regression over labels "chat" and the
+# four specialized actions. route() answers confident, whole-input small talk locally and returns
+# None (defer to Model1) otherwise. Local routing of code requests is opt-in through
+# code_threshold: the generated prompt cannot use the conversation history Model1 sees.
+# The model is trained (or, given a model_path, unpickled) by warm_up() at startup;
+# model_path must be a file the operator controls, since unpickling runs code.
+class IntentRouter:
+    def __init__(self, chat_threshold=0.8, code_threshold=None, max_local_chars=200, model_path=None, log_path=DEFAULT_LOG_PATH):
+        self.chat_threshold = chat_threshold
+        self.code_threshold = code_threshold
+        self.max_local_chars = max_local_chars
+        self.model_path = Path(model_path) if model_path else None
+        self.log_path = log_path
+        self._pipeline = None
+        self._scorer = None
+        self._lock = threading.Lock()
+        self.counters = {"routed_chat": 0, "routed_code": 0, "deferred": 0, "predict_seconds": 0.0, "predictions": 0}
+
+    def train(self, examples=None):
+        examples = examples if examples is not None else SEED_EXAMPLES + load_logged_examples(self.log_path)
+        pipeline = build_pipeline()
+        pipeline.fit([text for text, _ in examples], [label for _, label in examples])
+        self._pipeline, self._scorer = pipeline, _CompiledScorer(pipeline)
+        return self
+
+    def save(self):
+        self.model_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.model_path, "wb") as handle:
+            pickle.dump(self._pipeline, handle)
+
+    def warm_up(self):
+        if self._scorer is None:
+            started_at = time.perf_counter()
+            self._ensure_model()
+            print(f"INFO (IntentRouter): Ready in {time.perf_counter() - started_at:.2f}s.")
+        return self
+
+    def _ensure_model(self):
+        with self._lock:
+            if self._scorer is not None:
+                return
+            if self.model_path is not None and self.model_path.is_file():
+                try:
+                    with open(self.model_path, "rb") as handle:
+                        self._pipeline = pickle.load(handle)
+                    self._scorer = _CompiledScorer(self._pipeline)
+                    return
+                except Exception as e:
+                    print(f"WARNING (IntentRouter): Could not load '{self.model_path}', retraining: {e}")
+            self.train()
+
+    # Returns (label, confidence).
+    def predict(self, user_input):
+        self._ensure_model()
+        started_at = time.perf_counter()
+        label, confidence = self._scorer.predict(user_input)
+        self.counters["predict_seconds"] += time.perf_counter() - started_at
+        self.counters["predictions"] += 1
+        return label, confidence
+
+    # Returns a Model1-shaped directive, or None to let Model1 decide.
+    def route(self, user_input):
+        if not user_input or len(user_input) > self.max_local_chars:
+            self.counters["deferred"] += 1
+            return None
+        # Follow-ups ("now add logging to it") need the earlier turns: neither small talk nor
+        # a code prompt built from the raw input can answer them.
+        if is_context_dependent(user_input):
+            self.counters["deferred"] += 1
+            return None
+        label, confidence = self.predict(user_input)
+        if label == CHAT_LABEL and confidence >= self.chat_threshold and is_small_talk(user_input):
+            self.counters["routed_chat"] += 1
+            return {"is_code_related": False, "user_facing_acknowledgement": small_talk_reply(user_input),
+                    "action_for_next_model": None, "prompt_for_next_model": None, "library_constraints_for_next_model": None,
+                    "routed_locally": True, "router_confidence": round(confidence, 3)}
+        if label != CHAT_LABEL and self.code_threshold is not None and confidence >= self.code_threshold:
+            self.counters["routed_code"] += 1
+            return {"is_code_related": True, "user_facing_acknowledgement": "On it.",
+                    "action_for_next_model": label, "prompt_for_next_model": build_speculative_prompt(label, user_input),
+                    "library_constraints_for_next_model": None, "routed_locally": True, "router_confidence": round(confidence, 3)}
+        self.counters["deferred"] += 1
+        return None
+
+    def stats(self):
+        predictions = self.counters["predictions"]
+        return dict(self.counters, predict_seconds=round(self.counters["predict_seconds"], 4),
+                    mean_predict_us=round(self.counters["predict_seconds"] / predictions * 1e6, 1) if predictions else None)
+
+
+# --- Offline Evaluation ---
+# Stratified-ish holdout over seed + logged examples; reports accuracy and, for each
+# confidence threshold, the share of turns that would skip Model1 and how often those
+# local answers agree with Model1's label.
+def evaluate(examples, test_fraction=0.3, seed=0, thresholds=(0.5, 0.6, 0.7, 0.8, 0.9, 0.95), model1_latency_ms=800.0):
+    rng = random.Random(seed)
+    by_label = {}
+    for example in examples:
+        by_label.setdefault(example[1], []).append(example)
+    train, test = [], []
+    for label_examples in by_label.values():
+        rng.shuffle(label_examples)
+        cut = max(1, int(len(label_examples) * test_fraction)) if len(label_examples) > 1 else 0
+        test.extend(label_examples[:cut])
+        train.extend(label_examples[cut:])
+
+    router = IntentRouter().train(train)
+    predictions, latencies = [], []
+    for text, label in test:
+        started_at = time.perf_counter()
+        predicted, confidence = router.predict(text)
+        latencies.append(time.perf_counter() - started_at)
+        predictions.append((label, predicted, confidence))
+    latencies.sort()
+    report = {
+        "train_examples": len(train), "test_examples": len(test),
+        "accuracy": round(sum(label == predicted for label, predicted, _ in predictions) / len(predictions), 4) if predictions else None,
+        "predict_us_p50": round(latencies[len(latencies) // 2] * 1e6, 1) if latencies else None,
+        "predict_us_p99": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6, 1) if latencies else None,
+        "per_label": {}, "thresholds": [],
+    }
+    for label in sorted(by_label):
+        rows = [(l, p) for l, p, _ in predictions if l == label]
+        predicted_as = [(l, p) for l, p, _ in predictions if p == label]
+        report["per_label"][label] = {
+            "support": len(rows),
+            "recall": round(sum(l == p for l, p in rows) / len(rows), 3) if rows else None,
+            "precision": round(sum(l == p for l, p in predicted_as) / len(predicted_as), 3) if predicted_as else None,
+        }
+    for threshold in thresholds:
+        local = [(l, p) for l, p, c in predictions if c >= threshold]
+        local_chat = [(l, p) for l, p in local if p == CHAT_LABEL]
+        report["thresholds"].append({
+            "threshold": threshold,
+            "coverage": round(len(local) / len(predictions), 3) if predictions else None,
+            "accuracy_when_local": round(sum(l == p for l, p in local) / len(local), 3) if local else None,
+            "chat_coverage": round(len(local_chat) / len(predictions), 3) if predictions else None,
+            "chat_accuracy_when_local": round(sum(l == p for l, p in local_chat) / len(local_chat), 3) if local_chat else None,
+            "est_model1_ms_saved_per_turn": round(len(local_chat) / len(predictions) * model1_latency_ms, 1) if predictions else None,
+        })
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train or evaluate the local intent router on logged Model1 directives.")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--log", default=str(DEFAULT_LOG_PATH), help="JSONL of logged (user_input, directive) pairs.")
+    parser.add_argument("--model", default=str(DEFAULT_MODEL_PATH))
+    parser.add_argument("--no-seed", action="store_true", help="Use logged examples only.")
+    parser.add_argument("--test-fraction", type=float, default=0.3)
+    parser.add_argument("--model1-latency-ms", type=float, default=800.0, help="Typical Model1 round trip, for the savings estimate.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    examples = ([] if args.no_seed else list(SEED_EXAMPLES)) + load_logged_examples(args.log)
+    if not examples:
+        print("No examples to use.")
+        return 1
+    if args.command == "train":
+        router = IntentRouter(model_path=args.model).train(examples)
+        router.save()
+        print(f"Trained on {len(examples)} examples; saved to {args.model}. Load it with INTENT_ROUTER_MODEL_PATH={args.model}.")
+        return 0
+    print(json.dumps(evaluate(examples, args.test_fraction, args.seed, model1_latency_ms=args.model1_latency_ms), indent=2))
+    return 0
+
+
+# DIRECTIVE_LOG_ENABLED=1 appends (redacted) Model1 directives to the training log.
+DIRECTIVE_LOGGING_ENABLED = bool(os.getenv("DIRECTIVE_LOG_ENABLED"))
+
+# INTENT_ROUTER_ENABLED=1 answers small talk locally (every turn goes to Model1 otherwise);
+# INTENT_ROUTER_CODE_THRESHOLD (e.g. 0.95) also lets confident code requests skip it;
+# INTENT_ROUTER_MODEL_PATH loads a model saved by `intent_router.py train` instead of
+# training at startup.
+shared_intent_router = None if not os.getenv("INTENT_ROUTER_ENABLED") else IntentRouter(
+    code_threshold=float(os.getenv("INTENT_ROUTER_CODE_THRESHOLD")) if os.getenv("INTENT_ROUTER_CODE_THRESHOLD") else None,
+    model_path=os.getenv("INTENT_ROUTER_MODEL_PATH") or None,
+)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,382 @@
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+from pathlib import Path
+from continuation import CONTINUATION_INSTRUCTION
+
+# --- LLM Backend Protocol ---
+# Everything the model classes need from an LLM provider. Model handles, chat sessions,
+# responses and stream chunks are duck-typed on the google.generativeai shapes:
+#   chat session: .history (settable), .send_message(content), async .send_message_async(content)
+#   response / chunk: .text, .candidates[0].finish_reason, .prompt_feedback.block_reason, .usage_metadata
+class LLMBackend:
+    name = "base"
+
+    # Returns the API key (or any truthy credential marker); raises ValueError if missing.
+    def configure(self, env_path=None, key_name='api_key'):
+        raise NotImplementedError
+
+    def create_model(self, model_name, generation_config, system_instruction, safety_settings):
+        raise NotImplementedError
+
+    def start_chat(self, model_handle, history=None):
+        raise NotImplementedError
+
+    def generate_content(self, model_handle, contents):
+        raise NotImplementedError
+
+    # generation_config, when given, overrides fields of the handle's config for this call only.
+    def stream_content(self, model_handle, contents, generation_config=None):
+        raise NotImplementedError
+
+    async def generate_content_async(self, model_handle, contents):
+        raise NotImplementedError
+
+    # Awaitable returning an async iterator of chunks (mirrors generate_content_async(stream=True)).
+    async def stream_content_async(self, model_handle, contents, generation_config=None):
+        raise NotImplementedError
+
+    # Optional server-side prompt-prefix caching. A cached prefix is an opaque handle for a
+    # stored system instruction; model_from_cached_prefix returns a model handle that
+    # reuses it instead of resending (and re-prefilling) the instruction on every call.
+    # No backend implements it yet: Gemini context caching needs google-generativeai >= 0.7
+    # and a prefix of at least 32k tokens, far more than any system instruction here.
+    supports_prefix_cache = False
+    min_prefix_cache_tokens = 0
+
+    def create_cached_prefix(self, model_name, system_instruction, ttl_seconds):
+        raise NotImplementedError
+
+    def refresh_cached_prefix(self, cached_prefix, ttl_seconds):
+        raise NotImplementedError
+
+    def model_from_cached_prefix(self, cached_prefix, generation_config, safety_settings):
+        raise NotImplementedError
+
+    def delete_cached_prefix(self, cached_prefix):
+        raise NotImplementedError
+
+
+# --- Gemini (default) ---
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+
+    def configure(self, env_path=None, key_name='api_key'):
+        import google.generativeai as genai
+        from dotenv import load_dotenv
+        if env_path is None:
+            script_dir = Path(__file__).resolve().parent
+            env_path_to_load = script_dir / 'api_key.env'
+        else:
+            env_path_to_load = Path(env_path)
+
+        if env_path_to_load.is_file():
+            load_dotenv(dotenv_path=env_path_to_load)
+
+        api_key = os.getenv(key_name)
+        if not api_key:
+            error_message = (
+                f"API key '{key_name}' not found. Checked path: '{env_path_to_load}'. "
+                "Ensure the file exists, contains the key, or the environment variable is correctly set."
+            )
+            print(f"ERROR (GeminiBackend): {error_message}")
+            raise ValueError(error_message)
+
+        genai.configure(api_key=api_key)
+        return api_key
+
+    def create_model(self, model_name, generation_config, system_instruction, safety_settings):
+        import google.generativeai as genai
+        return genai.GenerativeModel(
+            model_name=model_name, safety_settings=safety_settings,
+            generation_config=generation_config, system_instruction=system_instruction
+        )
+
+    def start_chat(self, model_handle, history=None):
+        return model_handle.start_chat(history=history or [])
+
+    def generate_content(self, model_handle, contents):
+        return model_handle.generate_content(contents=contents)
+
+    def stream_content(self, model_handle, contents, generation_config=None):
+        return model_handle.generate_content(contents=contents, stream=True, generation_config=generation_config)
+
+    async def generate_content_async(self, model_handle, contents):
+        return await model_handle.generate_content_async(contents=contents)
+
+    async def stream_content_async(self, model_handle, contents, generation_config=None):
+        return await model_handle.generate_content_async(contents=contents, stream=True, generation_config=generation_config)
+
+
+# --- Latency Distributions for the Fake Backend ---
+# Each takes a random.Random and returns seconds, so runs are reproducible from a seed.
+def constant_latency(seconds):
+    return lambda rng: seconds
+
+def uniform_latency(low, high):
+    return lambda rng: rng.uniform(low, high)
+
+def lognormal_latency(median_seconds, sigma=0.5):
+    return lambda rng: rng.lognormvariate(0.0, sigma) * median_seconds
+
+
+class FakeFinishReason:
+    def __init__(self, value, name):
+        self.value = value
+        self.name = name
+
+class FakeCandidate:
+    def __init__(self, finish_reason):
+        self.finish_reason = finish_reason
+
+class FakePromptFeedback:
+    def __init__(self, block_reason=None, block_reason_message=None):
+        self.block_reason = block_reason
+        self.block_reason_message = block_reason_message
+
+class FakeUsageMetadata:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+class FakeChunk:
+    def __init__(self, text, finish_reason=None, usage_metadata=None):
+        self.text = text
+        self.candidates = [FakeCandidate(finish_reason)]
+        self.prompt_feedback = FakePromptFeedback()
+        self.usage_metadata = usage_metadata
+
+FINISH_STOP = FakeFinishReason(1, "STOP")
+FINISH_MAX_TOKENS = FakeFinishReason(2, "MAX_TOKENS")
+
+
+class FakeModelHandle:
+    def __init__(self, model_name, generation_config, system_instruction):
+        self.model_name = model_name
+        self.generation_config = dict(generation_config or {})
+        self.system_instruction = system_instruction or ""
+
+
+class FakeChatSession:
+    def __init__(self, backend, model_handle, history=None):
+        self._backend = backend
+        self._model_handle = model_handle
+        self.history = list(history or [])
+
+    def _contents_for(self, content):
+        return self.history + [{"role": "user", "parts": [content]}]
+
+    def _remember(self, content, response):
+        self.history = self.history + [{"role": "user", "parts": [content]}, {"role": "model", "parts": [response.text]}]
+
+    def send_message(self, content):
+        response = self._backend.generate_content(self._model_handle, self._contents_for(content))
+        self._remember(content, response)
+        return response
+
+    async def send_message_async(self, content):
+        response = await self._backend.generate_content_async(self._model_handle, self._contents_for(content))
+        self._remember(content, response)
+        return response
+
+
+def contents_to_text(contents):
+    if isinstance(contents, str):
+        return contents
+    pieces = []
+    for item in contents:
+        if isinstance(item, dict):
+            pieces.extend(str(part) for part in item.get("parts", []))
+        else:
+            pieces.append(str(item))
+    return "\n".join(pieces)
+
+def last_user_text(contents):
+    if isinstance(contents, str):
+        return contents
+    for item in reversed(contents):
+        if isinstance(item, dict) and item.get("role", "user") == "user":
+            return " ".join(str(part) for part in item.get("parts", []))
+    return contents_to_text(contents)
+
+def load_recorded_responses(jsonl_path):
+    recorded = []
+    with open(jsonl_path, "r", encoding="utf-8") as handle:
+        for line in handle:
+            if line.strip():
+                record = json.loads(line)
+                recorded.append((record["match"], record["text"]))
+    return recorded
+
+
+# --- Offline Deterministic Backend ---
+# Answers from `responses` (a callable(model_handle, contents) -> text, or a list of
+# (regex, text) pairs tried in order against the latest user message) and falls back to
+# synthetic answers shaped like each model's real output. Text is split into chunk_chars
+# pieces and delivered after first_token_latency, at tokens_per_second (None = as fast as
+# possible). Output longer than max_output_tokens is cut and finished with MAX_TOKENS.
+# With prefill_tokens_per_second set, every prompt token (system instruction included)
+# adds prefill time before the first token.
+class FakeBackend(LLMBackend):
+    name = "fake"
+
+    def __init__(self, responses=None, chunk_chars=64, tokens_per_second=None, first_token_latency=None,
+                 request_latency=None, synthetic_code_lines=60, seed=0, sleep=time.sleep,
+                 prefill_tokens_per_second=None):
+        self.responses = responses
+        self.chunk_chars = chunk_chars
+        self.tokens_per_second = tokens_per_second
+        self.first_token_latency = first_token_latency or constant_latency(0.0)
+        self.request_latency = request_latency or self.first_token_latency
+        self.synthetic_code_lines = synthetic_code_lines
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._sleep = sleep
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.counters = {"generate_calls": 0, "stream_calls": 0, "chunks": 0}
+
+    def configure(self, env_path=None, key_name='api_key'):
+        return "offline-fake-backend"
+
+    def create_model(self, model_name, generation_config, system_instruction, safety_settings):
+        return FakeModelHandle(model_name, generation_config, system_instruction)
+
+    def start_chat(self, model_handle, history=None):
+        return FakeChatSession(self, model_handle, history)
+
+    # Prompt tokens of a call, system instruction included.
+    def _prompt_tokens(self, model_handle, contents):
+        return (len(contents_to_text(contents)) + len(model_handle.system_instruction)) // 4 + 1
+
+    def _sample(self, distribution):
+        with self._rng_lock:
+            return max(0.0, distribution(self._rng))
+
+    def respond(self, model_handle, contents):
+        if callable(self.responses):
+            return self.responses(model_handle, contents)
+        user_text = last_user_text(contents)
+        for pattern, text in self.responses or []:
+            if re.search(pattern, user_text, re.I | re.S):
+                return text
+        return self._synthetic_response(model_handle, user_text)
+
+    def _synthetic_response(self, model_handle, user_text):
+        instruction = model_handle.system_instruction
+        if "AI Orchestrator" in instruction:
+            from speculative_dispatch import predict_action
+            request_match = re.search(r'Current user request: "(.*?)"', user_text, re.S)
+            request = request_match.group(1) if request_match else user_text
+            action = predict_action(request)
+            return json.dumps({
+                "is_code_related": action is not None,
+                "user_facing_acknowledgement": "Working on it." if action else "Hello! How can I help you today?",
+                "action_for_next_model": action,
+                "prompt_for_next_model": f"<RequestDetails>{request}</RequestDetails>" if action else None,
+                "library_constraints_for_next_model": None,
+            })
+        code_lines = ["# Standard Library Only - No external setup required.", "import sys", "", "def main():"]
+        code_lines += [f"    value_{i} = {i} * 2  # step {i}" for i in range(self.synthetic_code_lines)]
+        code_lines += ["    return 0", "", "if __name__ == '__main__':", "    sys.exit(main())"]
+        code = "\n".join(code_lines)
+        if "JSON object" in instruction:
+            report = {"report": {"summary": f"Synthetic answer for: {user_text[:80]}", "checks_passed": True}}
+            return f"```json\n{json.dumps(report, indent=2)}\n```\n```python\n{code}\n```"
+        return code
+
+    # Continuation requests (the model's partial answer followed by a user turn) get the
+    # rest of the answer the original prompt would have produced.
+    def _respond_or_continue(self, model_handle, contents):
+        if isinstance(contents, list) and len(contents) >= 3 and contents[-2].get("role") == "model" and last_user_text(contents) == CONTINUATION_INSTRUCTION:
+            full_text = self.respond(model_handle, contents[:-2])
+            emitted_text = "".join(str(part) for part in contents[-2].get("parts", []))
+            if full_text.startswith(emitted_text):
+                return full_text[len(emitted_text):]
+        return self.respond(model_handle, contents)
+
+    def _plan(self, model_handle, contents, generation_config=None):
+        text = self._respond_or_continue(model_handle, contents)
+        finish_reason = FINISH_STOP
+        max_output_tokens = dict(model_handle.generation_config, **(generation_config or {})).get("max_output_tokens")
+        if max_output_tokens and len(text) // 4 > max_output_tokens:
+            text = text[:max_output_tokens * 4]
+            finish_reason = FINISH_MAX_TOKENS
+        pieces = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)] or [""]
+        usage = FakeUsageMetadata(self._prompt_tokens(model_handle, contents), len(text) // 4 + 1)
+        return text, finish_reason, pieces, usage
+
+    def _prefill_delay(self, usage):
+        if not self.prefill_tokens_per_second:
+            return 0.0
+        return usage.prompt_token_count / self.prefill_tokens_per_second
+
+    def _pause(self, seconds):
+        if seconds > 0: self._sleep(seconds)
+
+    def _chunk_delay(self, piece):
+        if not self.tokens_per_second:
+            return 0.0
+        return (len(piece) / 4) / self.tokens_per_second
+
+    def generate_content(self, model_handle, contents):
+        self.counters["generate_calls"] += 1
+        text, finish_reason, _, usage = self._plan(model_handle, contents)
+        self._pause(self._sample(self.request_latency) + self._prefill_delay(usage) + self._chunk_delay(text))
+        return FakeChunk(text, finish_reason, usage)
+
+    def stream_content(self, model_handle, contents, generation_config=None):
+        self.counters["stream_calls"] += 1
+        _, finish_reason, pieces, usage = self._plan(model_handle, contents, generation_config)
+        first_token_delay = self._sample(self.first_token_latency) + self._prefill_delay(usage)
+
+        def chunks():
+            self._pause(first_token_delay)
+            for index, piece in enumerate(pieces):
+                if index: self._pause(self._chunk_delay(piece))
+                self.counters["chunks"] += 1
+                is_last = index == len(pieces) - 1
+                yield FakeChunk(piece, finish_reason if is_last else None, usage if is_last else None)
+        return chunks()
+
+    async def generate_content_async(self, model_handle, contents):
+        self.counters["generate_calls"] += 1
+        text, finish_reason, _, usage = self._plan(model_handle, contents)
+        await asyncio.sleep(self._sample(self.request_latency) + self._prefill_delay(usage) + self._chunk_delay(text))
+        return FakeChunk(text, finish_reason, usage)
+
+    async def stream_content_async(self, model_handle, contents, generation_config=None):
+        self.counters["stream_calls"] += 1
+        _, finish_reason, pieces, usage = self._plan(model_handle, contents, generation_config)
+        first_token_delay = self._sample(self.first_token_latency) + self._prefill_delay(usage)
+
+        async def chunks():
+            await asyncio.sleep(first_token_delay)
+            for index, piece in enumerate(pieces):
+                if index: await asyncio.sleep(self._chunk_delay(piece))
+                self.counters["chunks"] += 1
+                is_last = index == len(pieces) - 1
+                yield FakeChunk(piece, finish_reason if is_last else None, usage if is_last else None)
+        return chunks()
+
+
+# --- Default Backend Selection ---
+# LLM_BACKEND=fake runs the whole app offline; anything else uses Gemini.
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+def get_default_backend():
+    global _default_backend
+    with _default_backend_lock:
+        if _default_backend is None:
+            _default_backend = FakeBackend() if os.getenv("LLM_BACKEND", "gemini").lower() == "fake" else GeminiBackend()
+        return _default_backend
+
+def set_default_backend(backend):
+    global _default_backend
+    with _default_backend_lock:
+        _default_backend = backend
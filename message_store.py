@@ -0,0 +1,134 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+DEFAULT_STORE_PATH = Path(__file__).resolve().parent / ".cache" / "messages.sqlite3"
+COMPRESS_MIN_BYTES = 512
+
+# content_parts as minified JSON, zlib-compressed once they are big enough to benefit
+# (long code answers shrink 3-5x). The first byte says which.
+def encode_parts(content_parts):
+    raw = json.dumps(content_parts, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    if len(raw) >= COMPRESS_MIN_BYTES:
+        return b"z" + zlib.compress(raw, 6)
+    return b"j" + raw
+
+def decode_parts(blob):
+    blob = bytes(blob)
+    raw = zlib.decompress(blob[1:]) if blob[:1] == b"z" else blob[1:]
+    return json.loads(raw.decode("utf-8"))
+
+
+# --- Persistent Message Store ---
+# Chat history lives in SQLite instead of st.session_state: one row per message keyed by
+# (session_id, seq), appended once and never modified. Readers page backwards from the
+# newest message; decoded messages are kept in a small LRU because the same tail is read
+# on every Streamlit rerun. Sessions idle for longer than max_age_seconds are dropped.
+class MessageStore:
+    def __init__(self, db_path=DEFAULT_STORE_PATH, max_decoded_messages=256, max_age_seconds=7 * 24 * 3600):
+        self.max_decoded_messages = max_decoded_messages
+        self.max_age_seconds = max_age_seconds
+        self._decoded = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"appends": 0, "reads": 0, "decode_hits": 0, "decode_misses": 0, "stored_bytes": 0, "raw_bytes": 0}
+        self._conn = self._connect(db_path)
+
+    def _connect(self, db_path):
+        if db_path is not None:
+            try:
+                Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+                conn = sqlite3.connect(str(db_path), check_same_thread=False, timeout=10.0)
+                # Several service workers may share the file: WAL lets readers run alongside a writer.
+                conn.execute("PRAGMA journal_mode=WAL")
+                return self._init_schema(conn)
+            except sqlite3.Error as e:
+                print(f"WARNING (MessageStore): Could not open '{db_path}', keeping messages in memory: {e}")
+        return self._init_schema(sqlite3.connect(":memory:", check_same_thread=False))
+
+    def _init_schema(self, conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages (session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, "
+            "parts BLOB NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (session_id, seq))"
+        )
+        conn.execute("DELETE FROM messages WHERE session_id IN (SELECT session_id FROM messages GROUP BY session_id HAVING MAX(created_at) < ?)",
+                     (time.time() - self.max_age_seconds,))
+        conn.commit()
+        return conn
+
+    def append(self, session_id, role, content_parts):
+        blob = encode_parts(content_parts)
+        with self._lock:
+            # IMMEDIATE takes the write lock before reading MAX(seq), so processes sharing the file cannot both claim a seq.
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                seq = self._conn.execute("SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE session_id = ?", (session_id,)).fetchone()[0]
+                self._conn.execute("INSERT INTO messages (session_id, seq, role, parts, created_at) VALUES (?, ?, ?, ?, ?)",
+                                   (session_id, seq, role, blob, time.time()))
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self.counters["appends"] += 1
+            self.counters["stored_bytes"] += len(blob)
+            self.counters["raw_bytes"] += len(json.dumps(content_parts, ensure_ascii=False).encode("utf-8"))
+            self._remember((session_id, seq), {"role": role, "content_parts": content_parts, "seq": seq})
+        return seq
+
+    def count(self, session_id):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+    # Up to `limit` messages ending just before `before_seq` (None: the newest), oldest
+    # first. Each message dict carries its "seq".
+    def page(self, session_id, limit, before_seq=None):
+        with self._lock:
+            self.counters["reads"] += 1
+            if before_seq is None:
+                rows = self._conn.execute("SELECT seq, role, parts FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?",
+                                          (session_id, limit)).fetchall()
+            else:
+                rows = self._conn.execute("SELECT seq, role, parts FROM messages WHERE session_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                                          (session_id, before_seq, limit)).fetchall()
+            messages = []
+            for seq, role, blob in reversed(rows):
+                message = self._decoded.get((session_id, seq))
+                if message is not None:
+                    self._decoded.move_to_end((session_id, seq))
+                    self.counters["decode_hits"] += 1
+                else:
+                    message = {"role": role, "content_parts": decode_parts(blob), "seq": seq}
+                    self._remember((session_id, seq), message)
+                    self.counters["decode_misses"] += 1
+                messages.append(message)
+            return messages
+
+    def _remember(self, key, message):
+        self._decoded[key] = message
+        self._decoded.move_to_end(key)
+        while len(self._decoded) > self.max_decoded_messages:
+            self._decoded.popitem(last=False)
+
+    def delete_session(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+            for key in [key for key in self._decoded if key[0] == session_id]:
+                del self._decoded[key]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["decoded_messages"] = len(self._decoded)
+            stats["sessions"], stats["messages"] = self._conn.execute("SELECT COUNT(DISTINCT session_id), COUNT(*) FROM messages").fetchone()
+        stats["compression_ratio"] = round(stats["raw_bytes"] / stats["stored_bytes"], 2) if stats["stored_bytes"] else None
+        return stats
+
+
+# MESSAGE_STORE_PATH overrides the database file; ":memory:" keeps history off disk.
+_store_path = os.getenv("MESSAGE_STORE_PATH") or DEFAULT_STORE_PATH
+shared_message_store = MessageStore(db_path=None if _store_path == ":memory:" else _store_path)
@@ -1,36 +1,45 @@
-import google.generativeai as genai
-from dotenv import load_dotenv
-import os
 import json
 import re
-from pathlib import Path
+import threading
+import time
+from contextlib import closing
+from continuation import CONTINUATION_INSTRUCTION, DEFAULT_MAX_CONTINUATIONS, MAX_TOKENS_MARKER, ContinuationStitcher, close_open_fence, shared_output_budgets
+from conversation_context import ConversationContextManager, estimate_tokens
+from intent_router import DIRECTIVE_LOGGING_ENABLED, record_directive, shared_intent_router
+from llm_backends import contents_to_text, get_default_backend
+from model_registry import ModelRegistry, shared_model_registry
+from response_cache import ResponseCache, replay_cached_text, shared_response_cache
+from resilience import shared_resilience
+from scheduler import PRIORITY_GENERATION, PRIORITY_LONG_GENERATION, PRIORITY_ORCHESTRATOR, current_session, shared_scheduler
+from single_flight import shared_single_flight
+from token_accounting import TokenBudgetExceeded, shared_token_accounting
+from traffic_capture import shared_traffic_recorder
+from tracing import FINISH_REASON_NAMES, shared_tracer
+
+# Credentials already loaded and configured, keyed by (backend name, env_path, key_name).
+_configured_api_keys = {}
+_api_config_lock = threading.Lock()
 
 # --- Base Class for API Key and Basic Config ---
 class AIModelBase:
-    def __init__(self, env_path=None, key_name='api_key'):
-        self.GOOGLE_API_KEY = None
-        try:
-            if env_path is None:
-                script_dir = Path(__file__).resolve().parent
-                env_path_to_load = script_dir / 'api_key.env'
-            else:
-                env_path_to_load = Path(env_path)
-
-            if env_path_to_load.is_file():
-                load_dotenv(dotenv_path=env_path_to_load)
+    scheduler_priority = PRIORITY_GENERATION
 
-            self.GOOGLE_API_KEY = os.getenv(key_name)
-
-            if not self.GOOGLE_API_KEY:
-                error_message = (
-                    f"API key '{key_name}' not found. Checked path: '{env_path_to_load}'. "
-                    "Ensure the file exists, contains the key, or the environment variable is correctly set."
-                )
-                print(f"ERROR (AIModelBase): {error_message}")
-                raise ValueError(error_message)
-
-            genai.configure(api_key=self.GOOGLE_API_KEY)
+    def __init__(self, env_path=None, key_name='api_key', backend=None):
+        self.backend = backend or get_default_backend()
+        self.scheduler = shared_scheduler
+        self.token_accounting = shared_token_accounting
+        self.GOOGLE_API_KEY = None
+        config_cache_key = (self.backend.name, str(env_path), key_name)
+        with _api_config_lock:
+            if config_cache_key in _configured_api_keys:
+                self.GOOGLE_API_KEY = _configured_api_keys[config_cache_key]
+                return
+            self._load_and_configure_api_key(env_path, key_name)
+            _configured_api_keys[config_cache_key] = self.GOOGLE_API_KEY
 
+    def _load_and_configure_api_key(self, env_path, key_name):
+        try:
+            self.GOOGLE_API_KEY = self.backend.configure(env_path, key_name)
         except ValueError as ve:
             print(f"CONFIG ERROR in AIModelBase __init__: {ve}")
             raise RuntimeError(f"API Key Configuration Error: {ve}") from ve
@@ -40,10 +49,72 @@ class AIModelBase:
             traceback.print_exc()
             raise RuntimeError(f"Unexpected Initialization Error: {e}") from e
 
+    # Shared process-wide per (backend, model name, generation config, system instruction).
+    def _shared_model_handle(self, generation_config, system_instruction, safety_settings):
+        return shared_model_registry.get_or_create(
+            ModelRegistry.make_key(f"{self.backend.name}:{self.model_name}", generation_config, system_instruction),
+            lambda: self.backend.create_model(self.model_name, generation_config, system_instruction, safety_settings)
+        )
+
+    # Every upstream request (retries included) waits for quota in the shared scheduler.
+    # Returns (input tokens, expected output tokens).
+    def _upstream_estimate(self, prompt_tokens):
+        max_output_tokens = self.generation_config['max_output_tokens']
+        return prompt_tokens + self.instruction_tokens, self.scheduler.expected_output_tokens(self.__class__.__name__, max_output_tokens)
+
+    def _admit_upstream(self, prompt_tokens):
+        if self.scheduler is None:
+            return None
+        input_tokens, output_tokens = self._upstream_estimate(prompt_tokens)
+        return self.scheduler.admit(self.model_name, self.scheduler_priority, input_tokens + output_tokens, expected_output_tokens=output_tokens)
+
+    async def _admit_upstream_async(self, prompt_tokens):
+        if self.scheduler is None:
+            return None
+        input_tokens, output_tokens = self._upstream_estimate(prompt_tokens)
+        return await self.scheduler.aadmit(self.model_name, self.scheduler_priority, input_tokens + output_tokens, expected_output_tokens=output_tokens)
+
+    # usage_metadata (when the backend reports it) replaces the estimate in the TPM bucket
+    # and the learned output length, and calibrates the token accountant; accounting is (estimated prompt tokens, sent at).
+    # google-generativeai 0.5.x responses carry no usage_metadata, so output_text (what the
+    # attempt generated) is estimated instead and output still counts against the budgets.
+    def _settle_upstream(self, ticket, usage_metadata=None, accounting=None, output_text=""):
+        estimated_output_tokens = estimate_tokens(output_text) if usage_metadata is None else 0
+        if self.token_accounting is not None and accounting is not None and accounting[0] is not None:
+            self.token_accounting.record(self.__class__.__name__, accounting[0], usage_metadata, time.perf_counter() - accounting[1],
+                                         current_session(), estimated_output_tokens)
+        if ticket is None:
+            return
+        if usage_metadata is not None:
+            self.scheduler.complete(ticket, usage_metadata.total_token_count, self.__class__.__name__, usage_metadata.candidates_token_count)
+        elif output_text:
+            self.scheduler.complete(ticket, model_label=self.__class__.__name__, output_tokens=estimated_output_tokens)
+        else:
+            self.scheduler.complete(ticket)  # Nothing generated (an error): keep the estimate.
+
+DIRECTIVE_KEYS = ["is_code_related", "user_facing_acknowledgement",
+                  "action_for_next_model", "prompt_for_next_model",
+                  "library_constraints_for_next_model"]
+
+# The text of a finished response; a blocked one (or none) has no text.
+def response_text(response):
+    try:
+        return response.text if response is not None else ""
+    except ValueError:
+        return ""
+
+def fallback_directive(user_facing_acknowledgement):
+    return {
+        "is_code_related": False, "user_facing_acknowledgement": user_facing_acknowledgement,
+        "action_for_next_model": None, "prompt_for_next_model": None, "library_constraints_for_next_model": None
+    }
+
 # --- Model 1: Orchestrator ---
 class make_model1(AIModelBase):
-    def __init__(self, model_name='gemini-1.5-flash-latest', max_output_tokens=2048):
-        super().__init__()
+    scheduler_priority = PRIORITY_ORCHESTRATOR
+
+    def __init__(self, model_name='gemini-1.5-flash-latest', max_output_tokens=2048, max_context_tokens=3000, backend=None):
+        super().__init__(backend=backend)
         if not self.GOOGLE_API_KEY:
             raise RuntimeError('CRITICAL ERROR: Google API Key not configured from AIModelBase. Model1 cannot initialize.')
 
@@ -102,80 +173,184 @@ class make_model1(AIModelBase):
             Your entire output is ONLY the JSON.
         '''
         try:
-            self.model_instance = genai.GenerativeModel(
-                model_name=self.model_name, safety_settings=safety_settings,
-                generation_config=genai_parameters, system_instruction=system_instruction_model1
-            )
-            self.chat_session = self.model_instance.start_chat(history=[])
+            self.model_instance = self._shared_model_handle(genai_parameters, system_instruction_model1, safety_settings)
+            # The model handle is shared process-wide; the chat session is per instance (per browser session).
+            self.chat_session = self.backend.start_chat(self.model_instance)
+            self.context_manager = ConversationContextManager(max_context_tokens=max_context_tokens)
+            self.last_context_metrics = {}
+            self.generation_config = genai_parameters
+            self.system_instruction_text = system_instruction_model1
+            self.instruction_tokens = estimate_tokens(system_instruction_model1)
+            self.response_cache = shared_response_cache
+            self.resilience = shared_resilience
+            self.single_flight = shared_single_flight
+            self.intent_router = shared_intent_router
+            self.traffic_recorder = shared_traffic_recorder
+            self.log_directives = DIRECTIVE_LOGGING_ENABLED
+            self._turn_user_prompt = None
+            self._turn_history, self._turn_estimate = [], None
+            self._turn_upstream_seconds = 0.0
             print("INFO (make_model1): Initialized.")
         except Exception as e:
             raise RuntimeError(f'ERROR in make_model1 __init__: {e}')
 
     def __call__(self, user_prompt_for_current_turn, ui_chat_history_for_context=None):
-        try:
-            if not self.chat_session:
-                raise RuntimeError('Model1 chat_session is not initialized.')
-            
-            contextual_prompt_for_model1 = f"Current user request: \"{user_prompt_for_current_turn}\"\n\n"
-            if ui_chat_history_for_context and len(ui_chat_history_for_context) > 1:
-                contextual_prompt_for_model1 += "Recent conversation history (last 3 user/assistant exchanges):\n"
-                history_to_send = []
-                count = 0
-                for msg_data in reversed(ui_chat_history_for_context[:-1]): 
-                    if count >= 6: break
-                    text_content = ""
-                    if "content_parts" in msg_data:
-                        for part in msg_data["content_parts"]:
-                            if part["type"] == "text": text_content += part["data"] + " "
-                            elif part["type"] == "code":
-                                text_content += f"\n```python\n{part['data']['code']}\n```\n" # Include code in history context
-                    elif "content" in msg_data: text_content = msg_data["content"]
-                    if text_content.strip():
-                        history_to_send.append(f"{msg_data['role']}: {text_content.strip()}")
-                        count += 1
-                contextual_prompt_for_model1 += "\n".join(reversed(history_to_send))
-            contextual_prompt_for_model1 += f"\n\nBased on the current request and this history, generate your JSON directive."
-            
-            response = self.chat_session.send_message(contextual_prompt_for_model1)
-            raw_text = response.text.strip()
+        if self.traffic_recorder is None:
+            return self._orchestrate(user_prompt_for_current_turn, ui_chat_history_for_context)
+        started_at, self._turn_upstream_seconds = time.perf_counter(), 0.0
+        directive = self._orchestrate(user_prompt_for_current_turn, ui_chat_history_for_context)
+        self.traffic_recorder.record_directive(self.__class__.__name__, user_prompt_for_current_turn, directive,
+                                               time.perf_counter() - started_at, self._turn_upstream_seconds)
+        return directive
 
-            json_match = re.search(r"```json\s*(\{.*?\})\s*```", raw_text, re.DOTALL)
-            if json_match: json_string = json_match.group(1)
-            else: json_string = raw_text
-            
-            try:
-                parsed_json = json.loads(json_string)
-                required_keys = ["is_code_related", "user_facing_acknowledgement", 
-                                 "action_for_next_model", "prompt_for_next_model", 
-                                 "library_constraints_for_next_model"]
-                if not all(k in parsed_json for k in required_keys):
-                    missing_keys = [k for k in required_keys if k not in parsed_json]
-                    print(f"WARNING (make_model1): Model1 JSON missing essential keys: {missing_keys}. Output: {parsed_json}")
-                    # Graceful degradation: fill missing keys with defaults
-                    parsed_json["is_code_related"] = parsed_json.get("is_code_related", False)
-                    parsed_json["user_facing_acknowledgement"] = parsed_json.get("user_facing_acknowledgement", "Sorry, an issue occurred while processing the request structure.")
-                    parsed_json["action_for_next_model"] = parsed_json.get("action_for_next_model", None)
-                    parsed_json["prompt_for_next_model"] = parsed_json.get("prompt_for_next_model", None)
-                    parsed_json["library_constraints_for_next_model"] = parsed_json.get("library_constraints_for_next_model", None)
-                return parsed_json
-            except json.JSONDecodeError as e:
-                print(f"ERROR (make_model1): Did not return valid JSON. Error: {e}. Raw output: '{raw_text}'")
-                return {
-                    "is_code_related": False, "user_facing_acknowledgement": f"Sorry, I had a problem structuring my thoughts (M1_JSON_ERR).",
-                    "action_for_next_model": None, "prompt_for_next_model": None, "library_constraints_for_next_model": None
-                }
+    def _orchestrate(self, user_prompt_for_current_turn, ui_chat_history_for_context):
+        try:
+            directive = self._route_locally(user_prompt_for_current_turn)
+            if directive is not None:
+                return directive
+            with shared_tracer.span("orchestrator.build_prompt") as span:
+                contextual_prompt_for_model1, cache_key, raw_text = self._begin_turn(user_prompt_for_current_turn, ui_chat_history_for_context)
+                span.set(prompt_tokens=self.last_context_metrics.get("prompt_tokens"), cache_hit=raw_text is not None)
+            if raw_text is None:
+                try:
+                    with shared_tracer.span("orchestrator.llm_call", model=self.model_name):
+                        send = lambda: self.resilience.call(self.model_name, lambda: self._send_turn(contextual_prompt_for_model1))
+                        if self.single_flight is not None:
+                            response = self.single_flight.call(self._request_key(contextual_prompt_for_model1), send)
+                        else:
+                            response = send()
+                except Exception:
+                    self.context_manager.discard_pending_turn()
+                    raise
+                raw_text = response.text.strip()
+            return self._finish_turn(raw_text, cache_key)
+        except TokenBudgetExceeded as e:
+            return fallback_directive(str(e))
         except Exception as e:
             print(f'ERROR (make_model1) during response generation: {e}')
             import traceback; traceback.print_exc()
-            return {
-                "is_code_related": False, "user_facing_acknowledgement": f"Sorry, an internal error occurred in Model 1: {e}",
-                "action_for_next_model": None, "prompt_for_next_model": None, "library_constraints_for_next_model": None
-            }
+            return fallback_directive(f"Sorry, an internal error occurred in Model 1: {e}")
+
+    # Confident small talk is answered without the Model1 round trip; returns None to defer.
+    def _route_locally(self, user_prompt_for_current_turn):
+        if self.intent_router is None:
+            return None
+        with shared_tracer.span("orchestrator.route") as span:
+            directive = self.intent_router.route(user_prompt_for_current_turn)
+            span.set(routed_locally=directive is not None)
+        if directive is not None:
+            shared_tracer.count("orchestrator_routed_locally_total", action=directive["action_for_next_model"] or "chat")
+            print(f"INFO (make_model1): Routed locally (confidence {directive['router_confidence']}).")
+        return directive
+
+    # Shared by the sync path above and AsyncOrchestrator: builds the bounded prompt and
+    # returns (prompt, cache_key, cached_raw_text_or_None).
+    def _begin_turn(self, user_prompt_for_current_turn, ui_chat_history_for_context):
+        if not self.chat_session:
+            raise RuntimeError('Model1 chat_session is not initialized.')
+
+        self._turn_user_prompt = user_prompt_for_current_turn
+        contextual_prompt_for_model1, self.last_context_metrics = self.context_manager.build_prompt(
+            user_prompt_for_current_turn, ui_chat_history_for_context
+        )
+        # The chat history is rebuilt from the bounded window on every turn instead of growing forever.
+        self._turn_history, self._turn_estimate = self.context_manager.chat_history(), None
+        self.chat_session.history = list(self._turn_history)
+        cache_key, raw_text = None, None
+        if self.response_cache is not None:
+            cache_key = self._request_key(contextual_prompt_for_model1)
+            raw_text = self.response_cache.get(cache_key)
+            if raw_text is not None:
+                cache_key = None  # Served from cache; nothing new to store.
+                print("INFO (make_model1): Directive served from response cache.")
+        if raw_text is None and self.token_accounting is not None:
+            try:
+                self._fit_to_budget(contextual_prompt_for_model1)
+            except TokenBudgetExceeded:
+                self.context_manager.skip_pending_turn()
+                raise
+        return contextual_prompt_for_model1, cache_key, raw_text
+
+    # The bounded window plus the current request normally fits easily. When it does not
+    # (a huge paste), the oldest exchanges are left out of this request only; the request
+    # is rejected if the current turn alone is over budget.
+    def _fit_to_budget(self, contextual_prompt_for_model1):
+        model_label = self.__class__.__name__
+        request_texts = lambda history: [self.system_instruction_text, contextual_prompt_for_model1] + [part for message in history for part in message["parts"]]
+        history, max_request_tokens = self._turn_history, self.token_accounting.max_request_tokens
+        while history and max_request_tokens and self.token_accounting.estimate(model_label, request_texts(history)) > max_request_tokens:
+            history = history[2:]
+        self._turn_estimate = self.token_accounting.preflight(model_label, request_texts(history), current_session())
+        if len(history) < len(self._turn_history):
+            tokens_trimmed = self.token_accounting.estimate(model_label, request_texts(self._turn_history)) - self._turn_estimate
+            self.token_accounting.note_trim(model_label, tokens_trimmed)
+            print(f"INFO (make_model1): Left {(len(self._turn_history) - len(history)) // 2} earlier exchange(s) (~{tokens_trimmed} tokens) out to fit the request budget.")
+            self._turn_history = history
+            self.chat_session.history = list(history)
+
+    # Directives are cached and coalesced across sessions, so the key covers both the prompt
+    # and the bounded history sent with it: "now add logging" after different code differs.
+    def _request_key(self, contextual_prompt_for_model1):
+        request_material = json.dumps([self._turn_history, contextual_prompt_for_model1], sort_keys=True, default=str)
+        return ResponseCache.make_key(request_material, f"{self.backend.name}:{self.model_name}", self.generation_config, self.system_instruction_text)
+
+    # Each (re)try starts from the bounded window, never from a half-updated chat session.
+    # _turn_upstream_seconds keeps the duration of the call that answered (for capture).
+    def _send_turn(self, contextual_prompt_for_model1):
+        self.chat_session.history = list(self._turn_history)
+        ticket, response = self._admit_upstream(self.last_context_metrics.get("prompt_tokens", 0)), None
+        sent_at = time.perf_counter()
+        try:
+            response = self.chat_session.send_message(contextual_prompt_for_model1)
+            self._turn_upstream_seconds = time.perf_counter() - sent_at
+            return response
+        finally:
+            self._settle_upstream(ticket, getattr(response, "usage_metadata", None), (self._turn_estimate, sent_at), response_text(response))
+
+    async def _send_turn_async(self, contextual_prompt_for_model1):
+        self.chat_session.history = list(self._turn_history)
+        ticket, response = await self._admit_upstream_async(self.last_context_metrics.get("prompt_tokens", 0)), None
+        sent_at = time.perf_counter()
+        try:
+            response = await self.chat_session.send_message_async(contextual_prompt_for_model1)
+            self._turn_upstream_seconds = time.perf_counter() - sent_at
+            return response
+        finally:
+            self._settle_upstream(ticket, getattr(response, "usage_metadata", None), (self._turn_estimate, sent_at), response_text(response))
+
+    def _finish_turn(self, raw_text, cache_key):
+        self.context_manager.commit_turn(raw_text)
+        print(f"INFO (make_model1): Context {self.last_context_metrics['prompt_tokens']} tokens "
+              f"(saved ~{self.last_context_metrics['tokens_saved']} vs unbounded history).")
+
+        json_match = re.search(r"```json\s*(\{.*?\})\s*```", raw_text, re.DOTALL)
+        if json_match: json_string = json_match.group(1)
+        else: json_string = raw_text
+
+        try:
+            parsed_json = json.loads(json_string)
+            if not all(k in parsed_json for k in DIRECTIVE_KEYS):
+                missing_keys = [k for k in DIRECTIVE_KEYS if k not in parsed_json]
+                print(f"WARNING (make_model1): Model1 JSON missing essential keys: {missing_keys}. Output: {parsed_json}")
+                # Graceful degradation: fill missing keys with defaults
+                parsed_json["is_code_related"] = parsed_json.get("is_code_related", False)
+                parsed_json["user_facing_acknowledgement"] = parsed_json.get("user_facing_acknowledgement", "Sorry, an issue occurred while processing the request structure.")
+                parsed_json["action_for_next_model"] = parsed_json.get("action_for_next_model", None)
+                parsed_json["prompt_for_next_model"] = parsed_json.get("prompt_for_next_model", None)
+                parsed_json["library_constraints_for_next_model"] = parsed_json.get("library_constraints_for_next_model", None)
+            else:
+                if cache_key is not None: self.response_cache.put(cache_key, raw_text)
+                if self.log_directives: record_directive(self._turn_user_prompt, parsed_json)
+            return parsed_json
+        except json.JSONDecodeError as e:
+            shared_tracer.count("orchestrator_invalid_directive_total")
+            print(f"ERROR (make_model1): Did not return valid JSON. Error: {e}. Raw output: '{raw_text}'")
+            return fallback_directive("Sorry, I had a problem structuring my thoughts (M1_JSON_ERR).")
 
 # --- Base Class for Specialized Streaming Models ---
 class SpecializedStreamingModel(AIModelBase):
-    def __init__(self, class_name_for_log, model_name_suffix, system_instruction_text, max_output_tokens, temperature=0.3, top_p=0.9, top_k=40):
-        super().__init__()
+    def __init__(self, class_name_for_log, model_name_suffix, system_instruction_text, max_output_tokens, temperature=0.3, top_p=0.9, top_k=40, backend=None):
+        super().__init__(backend=backend)
         if not self.GOOGLE_API_KEY:
             raise RuntimeError(f'CRITICAL ERROR: Google API Key not configured. {class_name_for_log} cannot initialize.')
         
@@ -192,53 +367,277 @@ class SpecializedStreamingModel(AIModelBase):
             {'category': 'HARM_CATEGORY_HATE_SPEECH', 'threshold': 'BLOCK_MEDIUM_AND_ABOVE'}
         ]
         try:
-            self.model_instance = genai.GenerativeModel(
-                model_name=self.model_name, safety_settings=self.safety_settings,
-                generation_config=self.generation_config, system_instruction=self.system_instruction_text
-            )
+            self.model_instance = self._shared_model_handle(self.generation_config, self.system_instruction_text, self.safety_settings)
+            self.response_cache = shared_response_cache
+            self.resilience = shared_resilience
+            self.single_flight = shared_single_flight
+            self.output_budgets = shared_output_budgets
+            self.traffic_recorder = shared_traffic_recorder
+            self.max_continuations = DEFAULT_MAX_CONTINUATIONS
+            self.instruction_tokens = estimate_tokens(self.system_instruction_text)
             print(f"INFO ({class_name_for_log}): Initialized with model {self.model_name}.")
         except Exception as e:
             raise RuntimeError(f'ERROR in {class_name_for_log} __init__ for model {self.model_name}: {e}')
 
+    # With traffic capture on, the stream's chunk timings and finish reason are recorded.
     def __call__(self, prompt_content_for_model):
+        if self.traffic_recorder is None:
+            return self._respond(prompt_content_for_model, {})
+        return self.traffic_recorder.capture_stream(self.__class__.__name__, prompt_content_for_model,
+                                                    lambda outcome: self._respond(prompt_content_for_model, outcome))
+
+    # outcome receives the finish reason (CACHED for a replay from the response cache).
+    def _respond(self, prompt_content_for_model, outcome):
         if not self.model_instance:
             raise RuntimeError(f"ERROR: {self.__class__.__name__} model instance not initialized.")
+        if self.response_cache is None and self.single_flight is None:
+            yield from self._stream_from_model(prompt_content_for_model, outcome)
+            return
+
+        cache_key, cached_text = self._cached_reply(prompt_content_for_model)
+        if cached_text is not None:
+            outcome["finish_reason"] = "CACHED"
+            yield from replay_cached_text(cached_text)
+            return
+
+        if self.single_flight is None:
+            yield from self._stream_and_store(prompt_content_for_model, cache_key, outcome)
+            return
+        # Identical prompts already streaming for this model share that upstream call.
+        yield from self.single_flight.stream(cache_key, lambda: self._stream_and_store(prompt_content_for_model, cache_key, outcome))
+
+    def _stream_and_store(self, prompt_content_for_model, cache_key, stream_outcome):
+        emitted_chunks = []
+        for chunk_text in self._stream_from_model(prompt_content_for_model, stream_outcome):
+            emitted_chunks.append(chunk_text)
+            yield chunk_text
+        self._store_reply(cache_key, stream_outcome, emitted_chunks)
+
+    # Returns (cache_key, cached text or None). The response cache may hit disk, so the
+    # async path calls this (and _store_reply) on a worker thread.
+    def _cached_reply(self, prompt_content_for_model):
+        cache_key = self._cache_key(prompt_content_for_model)
+        cached_text = self.response_cache.get(cache_key) if self.response_cache is not None else None
+        if cached_text is not None:
+            shared_tracer.count("response_cache_replays_total", model=self.__class__.__name__)
+            print(f"INFO ({self.__class__.__name__}): Replaying response from cache.")
+        return cache_key, cached_text
+
+    # Only complete, normally finished answers are worth replaying.
+    def _store_reply(self, cache_key, outcome, emitted_chunks):
+        if self.response_cache is not None and outcome.get("completed") and emitted_chunks:
+            self.response_cache.put(cache_key, "".join(emitted_chunks))
+
+    def _cache_key(self, prompt_content_for_model):
+        return ResponseCache.make_key(prompt_content_for_model, f"{self.backend.name}:{self.model_name}", self.generation_config, self.system_instruction_text)
+
+    # Contents for resuming an interrupted answer: the model sees its own partial output.
+    def _continuation_contents(self, prompt_content_for_model, emitted_text):
+        return [
+            {"role": "user", "parts": [prompt_content_for_model]},
+            {"role": "model", "parts": [emitted_text]},
+            {"role": "user", "parts": [CONTINUATION_INSTRUCTION]},
+        ]
+
+    # --- Streaming Call State Machine ---
+    # One upstream answer: attempts (retries), continuations after MAX_TOKENS, stitching,
+    # quota and token settlement. _stream_from_model and AsyncSpecializedStreamingModel only
+    # drive it: they open the streams, iterate the chunks and yield what it returns.
+
+    # Per-call output budget and streaming state.
+    def _begin_call(self, prompt_content_for_model, outcome):
+        max_output_tokens = self.generation_config['max_output_tokens']
+        call_state = {"prompt": prompt_content_for_model, "outcome": outcome, "emitted": [],
+                      "finish_reason": None, "observer": shared_tracer.observe_stream(self.__class__.__name__),
+                      "ticket": None, "usage": None, "truncated": False, "continuations": 0, "stitcher": ContinuationStitcher(),
+                      "max_output_tokens": max_output_tokens, "accounting": None, "attempt_output": []}
+        if self.output_budgets is not None:
+            call_state["max_output_tokens"] = self.output_budgets.budget_for(self.__class__.__name__, max_output_tokens)
+        return call_state
+
+    # Per-call override of the handle's generation config; None when it would not change it.
+    def _call_generation_config(self, call_state):
+        if call_state["max_output_tokens"] == self.generation_config['max_output_tokens']:
+            return None
+        return {'max_output_tokens': call_state["max_output_tokens"]}
+
+    # After MAX_TOKENS: resume from the emitted text (with the full configured budget)
+    # unless max_continuations are used up. Returns True if another segment should run.
+    def _begin_continuation(self, call_state, emitted_chunks):
+        if not call_state["truncated"] or call_state["continuations"] >= self.max_continuations or not emitted_chunks:
+            return False
+        call_state["truncated"] = False
+        call_state["continuations"] += 1
+        call_state["max_output_tokens"] = self.generation_config['max_output_tokens']
+        shared_tracer.count("llm_auto_continuations_total", model=self.__class__.__name__)
+        print(f"INFO ({self.__class__.__name__}): Output hit MAX_TOKENS; continuing ({call_state['continuations']}/{self.max_continuations}).")
+        return True
+
+    # Texts to append once generation is over (a closed fence and notice if still
+    # truncated); also feeds the answer length back into the output budget.
+    def _end_output(self, call_state, emitted_chunks):
+        emitted_text = "".join(emitted_chunks)
+        if self.output_budgets is not None and emitted_text:
+            self.output_budgets.record(self.__class__.__name__, estimate_tokens(emitted_text), call_state["continuations"], call_state["truncated"])
+        if not call_state["truncated"]:
+            return []
+        return [close_open_fence(emitted_text) + MAX_TOKENS_MARKER]
+
+    # Settles the quota ticket of the previous attempt (if any) before a new one is admitted.
+    def _end_attempt(self, call_state):
+        ticket, call_state["ticket"] = call_state["ticket"], None
+        self._settle_upstream(ticket, call_state["usage"], call_state["accounting"], "".join(call_state["attempt_output"]))
+        call_state["usage"], call_state["accounting"], call_state["attempt_output"] = None, None, []
+
+    # Notes what this attempt is estimated to cost, to be settled against usage_metadata.
+    def _start_attempt_accounting(self, call_state, contents):
+        if self.token_accounting is not None:
+            estimate = self.token_accounting.estimate(self.__class__.__name__, [self.system_instruction_text, contents_to_text(contents)])
+            call_state["accounting"] = (estimate, time.perf_counter())
+
+    # Over-budget prompts are answered with a notice instead of being sent upstream; code
+    # to fix is not trimmed, since a partial file would only get a wrong fix.
+    def _preflight_notice(self, prompt_content_for_model):
+        if self.token_accounting is None:
+            return None
+        try:
+            self.token_accounting.preflight(self.__class__.__name__, [self.system_instruction_text, contents_to_text(prompt_content_for_model)], current_session())
+        except TokenBudgetExceeded as e:
+            return f"\n\n---REQUEST NOT SENT by {self.__class__.__name__}: {e}---\n"
+        return None
+
+    # Retries and MAX_TOKENS continuations resume from what was already emitted; the
+    # stitcher trims whatever the resumed stream repeats.
+    def _attempt_contents(self, prompt_content_for_model, emitted_chunks, attempt, call_state=None):
+        if (attempt > 0 or (call_state is not None and call_state["continuations"] > 0)) and emitted_chunks:
+            emitted_text = "".join(emitted_chunks)
+            if call_state is not None: call_state["stitcher"].begin(emitted_text)
+            return self._continuation_contents(prompt_content_for_model, emitted_text)
+        return prompt_content_for_model
+
+    def _contents_tokens(self, contents):
+        return estimate_tokens(contents if isinstance(contents, str) else json.dumps(contents, default=str))
+
+    # Contents for the next attempt; the previous attempt is settled first.
+    def _prepare_attempt(self, call_state, attempt):
+        contents = self._attempt_contents(call_state["prompt"], call_state["emitted"], attempt, call_state)
+        self._end_attempt(call_state)
+        return contents
+
+    def _attempt_admitted(self, call_state, ticket, contents):
+        call_state["ticket"] = ticket
+        self._start_attempt_accounting(call_state, contents)
+
+    # Returns (texts to yield, stream_finished) for one upstream chunk.
+    def _feed_chunk(self, call_state, chunk):
+        chunk_texts, stream_finished = self._texts_from_chunk(chunk, call_state)
+        chunk_texts = call_state["stitcher"].feed(chunk_texts)
+        call_state["emitted"].extend(chunk_texts)
+        return chunk_texts, stream_finished
+
+    # One upstream stream is over (completed: it ended without a finish chunk cutting it
+    # short). Returns (texts to yield, whether a continuation follows).
+    def _end_segment(self, call_state, completed):
+        if completed: call_state["outcome"]["completed"] = True
+        chunk_texts = call_state["stitcher"].flush()
+        call_state["emitted"].extend(chunk_texts)
+        return chunk_texts, self._begin_continuation(call_state, call_state["emitted"])
+
+    def _finish_call(self, call_state):
+        chunk_texts = self._end_output(call_state, call_state["emitted"])
+        call_state["outcome"]["finish_reason"] = call_state["finish_reason"] or "STOP"
+        call_state["observer"].finish(call_state["outcome"]["finish_reason"])
+        return chunk_texts
+
+    def _cancel_call(self, call_state):
+        call_state["observer"].finish("CANCELLED")
+
+    # Returns the error notice to show in place of the rest of the answer.
+    def _fail_call(self, call_state, error):
+        call_state["outcome"]["finish_reason"] = "ERROR"
+        call_state["observer"].finish("ERROR")
+        print(f'ERROR during {self.__class__.__name__} streaming response: {error}')
+        import traceback; traceback.print_exc()
+        return f"\n\n--- ERROR in {self.__class__.__name__} while streaming: {error} ---\n\n"
+
+    def _open_stream(self, call_state, attempt):
+        contents = self._prepare_attempt(call_state, attempt)
+        self._attempt_admitted(call_state, self._admit_upstream(self._contents_tokens(contents)), contents)
+        return self.backend.stream_content(self.model_instance, contents, self._call_generation_config(call_state))
+
+    def _stream_from_model(self, prompt_content_for_model, stream_outcome):
+        preflight_notice = self._preflight_notice(prompt_content_for_model)
+        if preflight_notice is not None:
+            stream_outcome["finish_reason"] = "REJECTED"
+            yield preflight_notice
+            return
+        call_state = self._begin_call(prompt_content_for_model, stream_outcome)
         try:
-            stream = self.model_instance.generate_content(contents=prompt_content_for_model, stream=True)
-            for chunk_idx, chunk in enumerate(stream):
-                if chunk.text: yield chunk.text
-
-                finish_reason_val = None
-                if chunk.candidates and chunk.candidates[0].finish_reason is not None:
-                    try:
-                        finish_reason_val = chunk.candidates[0].finish_reason.value
-                    except AttributeError: 
-                        finish_reason_val = chunk.candidates[0].finish_reason 
-                
-                if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
-                    reason_message = chunk.prompt_feedback.block_reason_message or "Content blocked by safety filter"
-                    print(f"WARNING: Stream from {self.__class__.__name__} blocked. Reason: {reason_message}")
-                    yield f"\n\n---STREAM BLOCKED by Safety Filter in {self.__class__.__name__}: {reason_message}---\n"
-                    break 
-                
-                if finish_reason_val is not None:
-                    if finish_reason_val == 2: # MAX_TOKENS
-                        yield "\n\n---MAX_TOKENS_REACHED---\n"
-                        break
-                    elif finish_reason_val in [3, 4, 5]: # SAFETY, RECITATION, OTHER
-                        reason_map = {3: "SAFETY", 4: "RECITATION", 5: "OTHER"}
-                        finish_reason_name = reason_map.get(finish_reason_val, f"UNKNOWN_TERMINAL_REASON_CODE_{finish_reason_val}")
-                        yield f"\n\n---STREAM_ENDED_UNEXPECTEDLY ({finish_reason_name})---\n"
-                        break
+            while True:
+                chunks = self.resilience.stream(self.model_name, lambda attempt: self._open_stream(call_state, attempt))
+                completed = False
+                with closing(chunks):
+                    for chunk in chunks:
+                        chunk_texts, stream_finished = self._feed_chunk(call_state, chunk)
+                        yield from chunk_texts
+                        if stream_finished: break
+                    else:
+                        completed = True
+                chunk_texts, continuing = self._end_segment(call_state, completed)
+                yield from chunk_texts
+                if not continuing: break
+            yield from self._finish_call(call_state)
+        except GeneratorExit:
+            self._cancel_call(call_state)
+            raise
         except Exception as e:
-            print(f'ERROR during {self.__class__.__name__} streaming response: {e}')
-            import traceback; traceback.print_exc()
-            yield f"\n\n--- ERROR in {self.__class__.__name__} while streaming: {e} ---\n\n"
+            yield self._fail_call(call_state, e)
+        finally:
+            self._end_attempt(call_state)
+
+    # Returns (texts_to_yield, stream_finished) for one streamed chunk; shared with the async
+    # path. The finish reason, if any, is recorded in call_state for tracing.
+    def _texts_from_chunk(self, chunk, call_state=None):
+        chunk_texts = [chunk.text] if chunk.text else []
+        if call_state is not None:
+            if chunk_texts:
+                call_state["observer"].chunk(len(chunk.text))
+                call_state["attempt_output"].append(chunk.text)
+            if getattr(chunk, "usage_metadata", None) is not None: call_state["usage"] = chunk.usage_metadata
+
+        finish_reason_val = None
+        if chunk.candidates and chunk.candidates[0].finish_reason is not None:
+            try:
+                finish_reason_val = chunk.candidates[0].finish_reason.value
+            except AttributeError:
+                finish_reason_val = chunk.candidates[0].finish_reason
+
+        if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
+            reason_message = chunk.prompt_feedback.block_reason_message or "Content blocked by safety filter"
+            if call_state is not None: call_state["finish_reason"] = "BLOCKED"
+            print(f"WARNING: Stream from {self.__class__.__name__} blocked. Reason: {reason_message}")
+            chunk_texts.append(f"\n\n---STREAM BLOCKED by Safety Filter in {self.__class__.__name__}: {reason_message}---\n")
+            return chunk_texts, True
+
+        if finish_reason_val is not None:
+            if call_state is not None:
+                call_state["finish_reason"] = FINISH_REASON_NAMES.get(finish_reason_val, f"UNKNOWN_{finish_reason_val}")
+            if finish_reason_val == 2: # MAX_TOKENS
+                # With call_state the caller decides whether to continue or to append the notice.
+                if call_state is not None: call_state["truncated"] = True
+                else: chunk_texts.append(MAX_TOKENS_MARKER)
+                return chunk_texts, True
+            elif finish_reason_val in [3, 4, 5]: # SAFETY, RECITATION, OTHER
+                reason_map = {3: "SAFETY", 4: "RECITATION", 5: "OTHER"}
+                finish_reason_name = reason_map.get(finish_reason_val, f"UNKNOWN_TERMINAL_REASON_CODE_{finish_reason_val}")
+                chunk_texts.append(f"\n\n---STREAM_ENDED_UNEXPECTEDLY ({finish_reason_name})---\n")
+                return chunk_texts, True
+        return chunk_texts, False
 
 
 # --- Specialized Model Implementations ---
 class make_model2(SpecializedStreamingModel): # Basic Code Generator
-    def __init__(self, max_output_tokens=8120, model_name_suffix='latest'):
+    def __init__(self, max_output_tokens=8120, model_name_suffix='latest', backend=None):
         system_instruction = """**CORE DIRECTIVE: Elite AI Code Synthesis Engine**
 
                             **Mission Critical Objective:** Your SOLE function is to synthesize raw, executable, production-grade source code based on the precise specifications provided in the user prompt.
@@ -282,10 +681,10 @@ class make_model2(SpecializedStreamingModel): # Basic Code Generator
 
                             **Performance Standard:** Your output will be judged on its direct usability, adherence to the STRUCTURED CODE OUTPUT format, and the extreme quality standards. Failure to include necessary setup instructions when external libraries are used (with versions), or including any extraneous text, is unacceptable. Synthesize with unparalleled precision.
 """
-        super().__init__("make_model2", model_name_suffix, system_instruction, max_output_tokens, temperature=0.2)
+        super().__init__("make_model2", model_name_suffix, system_instruction, max_output_tokens, temperature=0.2, backend=backend)
 
 class make_model3(SpecializedStreamingModel): # Apex Code Synthesizer
-    def __init__(self, max_output_tokens=8120, model_name_suffix='latest'):
+    def __init__(self, max_output_tokens=8120, model_name_suffix='latest', backend=None):
         system_instruction = """**CORE DIRECTIVE: Apex AI Code Synthesizer - Master Craftsman of Code**
             **Unwavering Mission:** Your singular, non-negotiable purpose is to transmute highly detailed user specifications, as relayed by an orchestrating AI (model1), into raw, directly executable, production-caliber source code. You are a precision instrument for code generation.
             **Output Protocol: PRECISION-STRUCTURED RAW TEXT CODE**
@@ -310,10 +709,10 @@ class make_model3(SpecializedStreamingModel): # Apex Code Synthesizer
             *   DO NOT infer beyond prompt unless critical for safety/functionality, and document such inferences in comments.
             **Performance Benchmark:** Judged by immediate fitness for production, adherence to RAW TEXT output, and Uncompromising Excellence. Deviations are critical failures.
 """
-        super().__init__("make_model3", model_name_suffix, system_instruction, max_output_tokens, temperature=0.3)
+        super().__init__("make_model3", model_name_suffix, system_instruction, max_output_tokens, temperature=0.3, backend=backend)
 
 class make_model4(SpecializedStreamingModel): # Grandmaster Code Physician
-    def __init__(self, max_output_tokens=8120, model_name_suffix='latest'):
+    def __init__(self, max_output_tokens=8120, model_name_suffix='latest', backend=None):
         system_instruction = """**CORE DIRECTIVE: Grandmaster AI Code Physician & Optimization Surgeon**
             **Unyielding Mission:** Diagnose, surgically correct, and optimize source code, adhering to library constraints. Multi-stage mandate: Forensic Analysis -> Strategic Remediation Plan (respecting constraints, checking for versioning issues like deprecated imports) -> Surgical Implementation -> Rigorous Post-Operative Verification -> Comprehensive Reporting & Delivery.
             **Output Mandate: Clinical Two-Part Response (No Deviation Permitted)**
@@ -325,10 +724,12 @@ class make_model4(SpecializedStreamingModel): # Grandmaster Code Physician
             **Operational Protocol:** Input: `<CodeToFix>` & `<RequestDetails>` (with constraints & error context if any). Library constraints are ABSOLUTE. If an import error is noted, specifically investigate if the item was moved/deprecated in newer library versions and provide the modern, correct import.
             **Performance Benchmark:** Judged on PART 2's quality/runnability/constraint adherence, and PART 1's accuracy (especially for version-aware import fixes). Violating constraints is critical failure.
 """
-        super().__init__("make_model4", model_name_suffix, system_instruction, max_output_tokens, temperature=0.4)
+        super().__init__("make_model4", model_name_suffix, system_instruction, max_output_tokens, temperature=0.4, backend=backend)
 
 class make_model5(SpecializedStreamingModel): # Iterative Self-Correcting Refiner
-    def __init__(self, max_output_tokens=8120, model_name_suffix='latest'):
+    scheduler_priority = PRIORITY_LONG_GENERATION
+
+    def __init__(self, max_output_tokens=8120, model_name_suffix='latest', backend=None):
         system_instruction = """**CORE DIRECTIVE: Autonomous AI Code Resilience & Perfection Engine**
             **Unyielding Mission:** Iteratively debug and refine code into a flawlessly runnable and functionally complete version. Relentless cycle: Analysis -> Targeted Correction -> Re-analysis until no execution-halting errors and core functionality met.
             **Input Expectation:** `<CodeToPerfect>`, `<TaskGoal>` (Highly Recommended), `<LibraryConstraints>`, `<MaxIterations>` (e.g., 10).
@@ -343,10 +744,12 @@ class make_model5(SpecializedStreamingModel): # Iterative Self-Correcting Refine
             **Operational Protocol:** Input tags as above. Embrace the loop. One critical error at a time. Be tenacious but bounded by MaxIterations.
             **Performance Standard:** Success = systematically eliminating errors, delivering runnable code for TaskGoal. Clarity of Log and quality of Final Code.
 """
-        super().__init__("make_model5", model_name_suffix, system_instruction, max_output_tokens, temperature=0.5)
+        super().__init__("make_model5", model_name_suffix, system_instruction, max_output_tokens, temperature=0.5, backend=backend)
 
 class make_model_ml_optimizer(SpecializedStreamingModel): # ML Performance Optimizer
-    def __init__(self, max_output_tokens=8192, model_name_suffix='latest'):
+    scheduler_priority = PRIORITY_LONG_GENERATION
+
+    def __init__(self, max_output_tokens=8192, model_name_suffix='latest', backend=None):
         system_instruction = """**CORE DIRECTIVE: AI Peak Performance ML Engineering Specialist**
             **Mission Critical Objective:** Transform a user's ML problem description—and any provided initial code—into a fully operational, robust, and **maximally performant** ML solution. Final code MUST be 100% runnable, achieve highest possible relevant metrics, be resilient against overfitting, and represent gold standard in ML engineering.
             **Input Expectation:** `<MLTaskDescription>` (detailed ML problem, dataset characteristics, performance metrics, algo preferences, constraints), `<OriginalCodeContext>` (Optional).
@@ -361,4 +764,4 @@ class make_model_ml_optimizer(SpecializedStreamingModel): # ML Performance Optim
             **Operational Protocol:** Deeply analyze task & constraints -> Strategize for peak performance & robustness -> Design/Refine data pipeline -> Select/Design optimal model architecture -> Implement rigorous training & validation -> Ensure anti-overfitting -> Engineer for production -> Output structured response. Heavy refactor/rewrite of original code is authorized if it hinders peak performance (justify in PART 1).
             **Performance Standard:** Judged on PART 3's *demonstrable potential* for SOTA results, flawless execution, robustness, and strict adherence to output format. Deliver excellence.
 """
-        super().__init__("make_model_ml_optimizer", model_name_suffix, system_instruction, max_output_tokens, temperature=0.4)
+        super().__init__("make_model_ml_optimizer", model_name_suffix, system_instruction, max_output_tokens, temperature=0.4, backend=backend)
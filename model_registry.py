@@ -0,0 +1,78 @@
+import hashlib
+import json
+import threading
+import time
+
+# --- Process-wide Registry of Shared Model Objects ---
+# Streamlit runs every browser session in the same Python process, so anything
+# built here is shared by all visitors. Only stateless objects belong in the
+# registry; per-session state (e.g. the Model1 chat) must stay in session_state.
+class ModelRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        self._entries = {}
+
+    @staticmethod
+    def make_key(model_name, generation_config=None, system_instruction=None):
+        config_key = json.dumps(generation_config or {}, sort_keys=True, default=str)
+        instruction_digest = hashlib.sha256((system_instruction or "").encode("utf-8")).hexdigest()
+        return ("model", model_name, config_key, instruction_digest)
+
+    @staticmethod
+    def make_instance_key(model_cls, **init_kwargs):
+        return ("instance", model_cls.__name__, json.dumps(init_kwargs, sort_keys=True, default=str))
+
+    def get_or_create(self, key, factory):
+        entry = self._entries.get(key)
+        if entry is None:
+            with self._lock:
+                build_lock = self._build_locks.setdefault(key, threading.Lock())
+            # Per-key lock: concurrent cold sessions wait for one build instead of racing.
+            with build_lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    build_start = time.perf_counter()
+                    instance = factory()
+                    entry = {
+                        "instance": instance,
+                        "created_at": time.time(),
+                        "build_seconds": time.perf_counter() - build_start,
+                        "hits": 0,
+                    }
+                    with self._lock:
+                        self._entries[key] = entry
+                    print(f"INFO (ModelRegistry): Built shared {key[0]} '{key[1]}' in {entry['build_seconds']:.3f}s.")
+        with self._lock:
+            entry["hits"] += 1
+        return entry["instance"]
+
+    def get_shared_instance(self, model_cls, **init_kwargs):
+        return self.get_or_create(self.make_instance_key(model_cls, **init_kwargs), lambda: model_cls(**init_kwargs))
+
+    def instance_count(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            items = list(self._entries.items())
+        return [
+            {
+                "kind": key[0],
+                "name": key[1],
+                "key_digest": hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:12],
+                "created_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["created_at"])),
+                "build_seconds": round(entry["build_seconds"], 4),
+                "hits": entry["hits"],
+            }
+            for key, entry in items
+        ]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._build_locks.clear()
+
+
+shared_model_registry = ModelRegistry()
@@ -0,0 +1,393 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+from async_models import AsyncOrchestrator, AsyncSpecializedStreamingModel
+from candidate_verification import VERIFIABLE_ACTIONS, VERIFICATION_ENABLED, VerifiedCandidateRunner
+from code_patch import PATCHABLE_ACTIONS, PatchModeModel
+from intent_router import shared_intent_router
+from message_store import shared_message_store
+from model1 import make_model1, make_model3, make_model4, make_model5, make_model_ml_optimizer
+from model_registry import shared_model_registry
+from scheduler import set_current_session
+from session_store import PersistentContext, shared_session_store
+from speculative_dispatch import shared_speculative_dispatcher
+from stream_parser import StreamingPartParser
+from tracing import shared_tracer
+
+ACTION_MODELS = {
+    "generate_new_code_m3": (make_model3, "Synthesizing High-Quality Code (Model 3)..."),
+    "fix_and_verify_code_m4": (make_model4, "Diagnosing & Correcting Code (Model 4)..."),
+    "iteratively_perfect_code_m5": (make_model5, "Iteratively Perfecting Code (Model 5)..."),
+    "optimize_ml_solution_m_ml": (make_model_ml_optimizer, "Engineering Optimal ML Solution..."),
+}
+DEFAULT_CONTEXT_MESSAGES = 12  # Model1 only formats messages it has not seen yet.
+DEFAULT_MAX_SESSIONS = 1000
+TURN_LOCK_POLL_SECONDS = 0.01
+FALLBACK_REPLY = "I'm ready to assist. What can I do for you?"
+EMPTY_ANSWER = "*AI provided no output or only whitespace for this part.*"
+
+
+# Turns a stream into parts for callers that do not render it (e.g. the HTTP service).
+# Same interface as IncrementalStreamRenderer: append / finish / parts.
+class PartCollector:
+    def __init__(self):
+        self._parser = StreamingPartParser()
+        self._chunks = []
+        self.parts = []
+
+    @property
+    def warnings(self):
+        return self._parser.warnings
+
+    def append(self, chunk_text):
+        self._chunks.append(chunk_text)
+        self.parts.extend(self._parser.feed(chunk_text))
+
+    def finish(self):
+        self.parts.extend(self._parser.close())
+        if not self.parts: self.parts.append({"type": "text", "data": EMPTY_ANSWER})
+        return "".join(self._chunks)
+
+
+def _text_part(text):
+    return {"type": "text", "data": text}
+
+# A reply that only repeats Model1's already-shown small-talk ack is not stored again.
+def _is_ack_only(parts, directive, ack_shown, dispatched):
+    return (not dispatched and ack_shown and len(parts) == 1 and parts[0]["type"] == "text"
+            and parts[0]["data"] == directive.get("user_facing_acknowledgement"))
+
+
+# --- Orchestration Pipeline Engine ---
+# One turn, independent of any UI: store the user message, get Model1's directive (with
+# the newest stored messages as context), dispatch to the specialized model (optionally
+# through patch mode and/or verified candidates), stream the answer into a sink, store
+# the reply. A turn is a generator of (event, data) pairs, so the Streamlit page and the
+# HTTP service only differ in how they show them:
+#   directive  Model1's directive dict
+#   ack        Model1's acknowledgement, shown before the answer
+#   progress   status line while the specialized model works
+#   chunk      answer text as it streams
+#   part       a completed answer part (JSON report, code block, text)
+#   text       a reply without a specialized model (small talk, fallback)
+#   warning    e.g. an action this engine does not know
+#   error      the turn failed; an apology is stored as the reply
+#   done       {"seq": stored reply seq or None, "parts": [...], "warnings": [...]}
+# Model1 instances are kept per session (LRU, max_sessions). With a session store their
+# orchestrator state is persisted as it changes and re-synced at the start of every turn,
+# so any process can pick a conversation up; without one, an evicted session only loses
+# its bounded orchestrator window, which is rebuilt from the stored messages. Verified
+# candidates run generated code locally, so verify_candidates is ignored unless the
+# operator enabled verification (CANDIDATE_VERIFICATION_ENABLED).
+class PipelineEngine:
+    def __init__(self, backend=None, message_store=shared_message_store, registry=shared_model_registry,
+                 context_messages=DEFAULT_CONTEXT_MESSAGES, max_sessions=DEFAULT_MAX_SESSIONS, session_store=shared_session_store,
+                 verification_enabled=VERIFICATION_ENABLED):
+        self.backend = backend
+        self.verification_enabled = verification_enabled
+        self.message_store = message_store
+        self.session_store = session_store
+        self.registry = registry
+        self.context_messages = context_messages
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._async_models = {}
+        self.patch_models = {}
+        self.verified_runners = {}
+        self.counters = {"turns": 0, "active_turns": 0, "errors": 0, "abandoned": 0, "sessions_evicted": 0, "sessions_rehydrated": 0}
+
+    def _model_kwargs(self):
+        return {"backend": self.backend} if self.backend is not None else {}
+
+    def model_for(self, action):
+        return self.registry.get_shared_instance(ACTION_MODELS[action][0], **self._model_kwargs())
+
+    def session(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                return session
+        model1_instance = make_model1(**self._model_kwargs())
+        session = {"model1": model1_instance, "async_model1": None, "persistent": None, "turn_lock": threading.Lock()}
+        if self.session_store is not None:
+            session["persistent"] = PersistentContext(self.session_store, session_id, model1_instance.context_manager)
+            rehydrated = session["persistent"].sync()
+            if rehydrated["records"]:
+                print(f"INFO (PipelineEngine): Rehydrated session {session_id} from {rehydrated['records']} record(s) in {rehydrated['seconds'] * 1000:.1f}ms.")
+                with self._lock: self.counters["sessions_rehydrated"] += 1
+        with self._lock:
+            session = self._sessions.setdefault(session_id, session)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.counters["sessions_evicted"] += 1
+        return session
+
+    def delete_session(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        self.message_store.delete_session(session_id)
+        if self.session_store is not None: self.session_store.delete_session(session_id)
+
+    # Builds every specialized model (and the session's Model1, if given) and the intent
+    # router up front, so the first user's turn does not pay for them.
+    def warm_up(self, session_id=None):
+        if session_id is not None: self.session(session_id)
+        for action in ACTION_MODELS:
+            self.model_for(action)
+        if shared_intent_router is not None: shared_intent_router.warm_up()
+
+    def _wrapped_model(self, action, patch_mode, verify_candidates):
+        target = self.model_for(action)
+        patch_mode = patch_mode and action in PATCHABLE_ACTIONS
+        if patch_mode:
+            with self._lock:
+                target = self.patch_models.setdefault(action, PatchModeModel(target))
+        if verify_candidates and self.verification_enabled and action in VERIFIABLE_ACTIONS:
+            runner_key = f"{action}:patch" if patch_mode else action
+            with self._lock:
+                runner = self.verified_runners.setdefault(runner_key, VerifiedCandidateRunner(target))
+            runner.candidates = verify_candidates
+            return runner, f"Verifying {verify_candidates} candidates locally...", True
+        return target, "Streaming output...", patch_mode
+
+    # Verified and patch modes re-request fix/refine answers in their own form, so never speculate on those.
+    def _speculation_targets(self, patch_mode, verify_candidates):
+        return {action: self.model_for(action) for action in ACTION_MODELS
+                if not (verify_candidates and self.verification_enabled and action in VERIFIABLE_ACTIONS) and not (patch_mode and action in PATCHABLE_ACTIONS)}
+
+    def _begin_turn(self, session_id, user_input):
+        set_current_session(session_id)
+        session, user_seq = self._store_user_turn(session_id, user_input)
+        return session, self._start_turn_trace(user_seq)
+
+    # Store I/O only (aturn runs it on a worker thread); the trace and the current session
+    # are context variables and stay with the caller.
+    def _store_user_turn(self, session_id, user_input):
+        session = self.session(session_id)
+        # Another process may have served this conversation since; catch up first.
+        if session["persistent"] is not None: session["persistent"].sync()
+        return session, self.message_store.append(session_id, "user", [_text_part(user_input)])
+
+    def _start_turn_trace(self, user_seq):
+        with self._lock:
+            self.counters["turns"] += 1
+            self.counters["active_turns"] += 1
+        return shared_tracer.start_trace("turn", turn=user_seq + 1).begin()
+
+    def _end_turn(self, session_id, turn_trace, directive, parts, ack_shown, dispatched, error, sink):
+        seq = self._store_answer(session_id, directive, parts, ack_shown, dispatched)
+        self._end_turn_trace(turn_trace, error)
+        return self._turn_outcome(seq, parts, sink)
+
+    def _end_turn_trace(self, turn_trace, error):
+        turn_trace.end()
+        with self._lock:
+            self.counters["active_turns"] -= 1
+            self.counters["errors"] += int(error)
+
+    def _store_answer(self, session_id, directive, parts, ack_shown, dispatched):
+        if parts and not (directive and _is_ack_only(parts, directive, ack_shown, dispatched)):
+            return self.message_store.append(session_id, "assistant", parts)
+        return None
+
+    def _turn_outcome(self, seq, parts, sink):
+        return {"seq": seq, "parts": parts, "warnings": list(getattr(sink, "warnings", []))}
+
+    # The consumer went away mid-turn (closed tab, dropped connection): nothing is stored.
+    def _abandon_turn(self, turn_trace):
+        try:
+            turn_trace.end(error="abandoned")
+        except ValueError:
+            pass  # Generator finalised from another context; the trace is simply not exported.
+        with self._lock:
+            self.counters["active_turns"] -= 1
+            self.counters["abandoned"] += 1
+
+    # Events before the specialized model runs. Returns (events, action, prompt, ack_shown).
+    def _plan(self, directive):
+        if not isinstance(directive, dict):
+            raise ValueError(f"Model1 (Orchestrator) did not return a dictionary. Received: {type(directive)}. Output: {directive}")
+        is_code_related = directive.get("is_code_related", False)
+        ack = directive.get("user_facing_acknowledgement", "")
+        action = directive.get("action_for_next_model")
+        prompt = directive.get("prompt_for_next_model")
+        events = [("directive", directive)]
+        ack_shown = bool(ack) and len(ack.strip()) > 3
+        if ack_shown: events.append(("ack", ack))
+        if is_code_related and action and prompt:
+            if action in ACTION_MODELS:
+                return events, action, prompt, ack_shown
+            events.append(("warning", f"Orchestrator (Model 1) requested an unhandled action: '{action}'."))
+        elif not is_code_related and not ack:
+            events.append(("text", FALLBACK_REPLY))
+        if not is_code_related and ack and not action and not ack_shown:
+            events.append(("text", ack))
+        return events, None, None, ack_shown
+
+    def _collect(self, events, parts):
+        for event, data in events:
+            if event in ("ack", "text", "warning"): parts.append(_text_part(data))
+        return events
+
+    # Turns of one session (two tabs, two requests) share its Model1 context, chat session
+    # and message sequence, so they run one at a time: the lock is held for the whole turn.
+    def turn(self, session_id, user_input, make_sink=PartCollector, patch_mode=False, verify_candidates=0, tests=None, speculative=False):
+        with self.session(session_id)["turn_lock"]:
+            yield from self._turn(session_id, user_input, make_sink, patch_mode, verify_candidates, tests, speculative)
+
+    def _turn(self, session_id, user_input, make_sink, patch_mode, verify_candidates, tests, speculative):
+        session, turn_trace = self._begin_turn(session_id, user_input)
+        directive, parts, ack_shown, dispatched, error, sink = None, [], False, False, False, None
+        speculative_stream, outcome = None, None
+        try:
+            try:
+                if speculative:
+                    # Start the likely specialized model now; kept only if Model1's directive agrees.
+                    speculative_stream = shared_speculative_dispatcher.begin(user_input, self._speculation_targets(patch_mode, verify_candidates))
+                with turn_trace.span("orchestrator"):
+                    directive = session["model1"](user_input, self.message_store.page(session_id, self.context_messages))
+                with turn_trace.span("dispatch") as span:
+                    speculative_chunks = shared_speculative_dispatcher.resolve(speculative_stream, directive)
+                    span.set(speculative_hit=speculative_chunks is not None)
+                events, action, prompt, ack_shown = self._plan(directive)
+                yield from self._collect(events, parts)
+                if action is not None:
+                    dispatched = True
+                    target, status, wrapped = self._wrapped_model(action, patch_mode, verify_candidates)
+                    yield "progress", f"{ACTION_MODELS[action][1]} {status}"
+                    if isinstance(target, VerifiedCandidateRunner):
+                        chunk_source = target(prompt, tests)
+                    elif wrapped or speculative_chunks is None:
+                        chunk_source = target(prompt)
+                    else:
+                        chunk_source = speculative_chunks
+                    sink = make_sink()
+                    render_seconds, emitted_parts = 0.0, 0
+                    with turn_trace.span("stream", action=action, speculative=speculative_chunks is not None) as span:
+                        for chunk_text in chunk_source:
+                            render_started_at = time.perf_counter()
+                            sink.append(chunk_text)
+                            render_seconds += time.perf_counter() - render_started_at
+                            yield "chunk", chunk_text
+                            while emitted_parts < len(sink.parts):
+                                yield "part", sink.parts[emitted_parts]
+                                emitted_parts += 1
+                        span.set(chunks=getattr(sink, "stats", {}).get("chunks"))
+                    turn_trace.add_span("render", render_seconds)
+                    # Parts were built as they closed; finishing only flushes the last one.
+                    with turn_trace.span("finalize"):
+                        sink.finish()
+                    for part in sink.parts[emitted_parts:]:
+                        yield "part", part
+                    parts.extend(sink.parts)
+            except Exception as e:
+                error = True
+                turn_trace.set(error=f"{e.__class__.__name__}: {e}")
+                parts.append(_text_part(f"Sorry, I encountered an error: {e}"))
+                yield "error", f"An unexpected error occurred: {e}"
+                import traceback; traceback.print_exc()
+            outcome = self._end_turn(session_id, turn_trace, directive, parts, ack_shown, dispatched, error, sink)
+        finally:
+            # A kept speculative stream is only done once its chunks were consumed; an error or
+            # an abandoned turn must still stop its pump thread and upstream call.
+            shared_speculative_dispatcher.cancel(speculative_stream)
+            if outcome is None: self._abandon_turn(turn_trace)
+        yield "done", outcome
+
+    # Async counterpart for the HTTP service: Model1 and the plain specialized models run
+    # on the event loop (AsyncOrchestrator / AsyncSpecializedStreamingModel); patch mode
+    # and verified candidates are thread-based, so their chunks are pulled on a worker
+    # thread. No speculation here: it needs a background thread per turn.
+    async def aturn(self, session_id, user_input, patch_mode=False, verify_candidates=0, tests=None):
+        turn_lock = (await asyncio.to_thread(self.session, session_id))["turn_lock"]
+        # Shared with sync turns on other threads; no cross-thread notification on the event loop, so poll.
+        while not turn_lock.acquire(blocking=False):
+            await asyncio.sleep(TURN_LOCK_POLL_SECONDS)
+        try:
+            async with aclosing(self._aturn(session_id, user_input, patch_mode, verify_candidates, tests)) as events:
+                async for event in events:
+                    yield event
+        finally:
+            turn_lock.release()
+
+    async def _aturn(self, session_id, user_input, patch_mode, verify_candidates, tests):
+        set_current_session(session_id)
+        session, user_seq = await asyncio.to_thread(self._store_user_turn, session_id, user_input)
+        turn_trace = self._start_turn_trace(user_seq)
+        directive, parts, ack_shown, dispatched, error, sink = None, [], False, False, False, None
+        outcome = None
+        try:
+            try:
+                if session["async_model1"] is None: session["async_model1"] = AsyncOrchestrator(session["model1"])
+                with turn_trace.span("orchestrator"):
+                    history = await asyncio.to_thread(self.message_store.page, session_id, self.context_messages)
+                    directive = await session["async_model1"](user_input, history)
+                events, action, prompt, ack_shown = self._plan(directive)
+                for event in self._collect(events, parts):
+                    yield event
+                if action is not None:
+                    dispatched = True
+                    target, status, wrapped = self._wrapped_model(action, patch_mode, verify_candidates)
+                    yield "progress", f"{ACTION_MODELS[action][1]} {status}"
+                    if isinstance(target, VerifiedCandidateRunner):
+                        chunk_source = _iterate_in_thread(target(prompt, tests))
+                    elif wrapped:
+                        chunk_source = _iterate_in_thread(target(prompt))
+                    else:
+                        chunk_source = self._async_model(action)(prompt)
+                    sink, emitted_parts = PartCollector(), 0
+                    with turn_trace.span("stream", action=action):
+                        async with aclosing(chunk_source):
+                            async for chunk_text in chunk_source:
+                                sink.append(chunk_text)
+                                yield "chunk", chunk_text
+                                while emitted_parts < len(sink.parts):
+                                    yield "part", sink.parts[emitted_parts]
+                                    emitted_parts += 1
+                    sink.finish()
+                    for part in sink.parts[emitted_parts:]:
+                        yield "part", part
+                    parts.extend(sink.parts)
+            except Exception as e:
+                error = True
+                turn_trace.set(error=f"{e.__class__.__name__}: {e}")
+                parts.append(_text_part(f"Sorry, I encountered an error: {e}"))
+                yield "error", f"An unexpected error occurred: {e}"
+                print(f"ERROR (PipelineEngine): Turn failed: {e}")
+            seq = await asyncio.to_thread(self._store_answer, session_id, directive, parts, ack_shown, dispatched)
+            self._end_turn_trace(turn_trace, error)
+            outcome = self._turn_outcome(seq, parts, sink)
+        finally:
+            if outcome is None: self._abandon_turn(turn_trace)
+        yield "done", outcome
+
+    def _async_model(self, action):
+        with self._lock:
+            if action not in self._async_models:
+                self._async_models[action] = AsyncSpecializedStreamingModel(self.model_for(action))
+            return self._async_models[action]
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, sessions=len(self._sessions))
+
+
+_DONE = object()
+
+# Drives a blocking chunk generator from the event loop, one chunk per worker-thread hop;
+# closing the async generator closes the underlying one (stopping its upstream streams).
+async def _iterate_in_thread(chunks):
+    try:
+        while True:
+            chunk_text = await asyncio.to_thread(next, chunks, _DONE)
+            if chunk_text is _DONE: return
+            yield chunk_text
+    finally:
+        await asyncio.to_thread(chunks.close)
+
+
+shared_pipeline_engine = PipelineEngine()
@@ -0,0 +1,399 @@
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import secrets
+import sys
+import time
+import uuid
+from contextlib import aclosing
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+KEEPALIVE_TIMEOUT_SECONDS = 15.0
+HEARTBEAT_SECONDS = 10.0
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+WRITE_BUFFER_HIGH_BYTES = 64 * 1024
+WRITE_BUFFER_LOW_BYTES = 16 * 1024
+MAX_VERIFY_CANDIDATES = 4
+_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 500: "Internal Server Error"}
+
+LOADTEST_PROMPTS = [
+    "write a python script that parses a csv file and prints column averages",
+    "fix this bug please: my loop never terminates",
+    "hello",
+    "build a classification model for an imbalanced dataset",
+    "refine and polish this function until it passes its tests",
+]
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _head(status, headers):
+    lines = [f"HTTP/1.1 {status} {_REASONS.get(status, 'OK')}"] + [f"{name}: {value}" for name, value in headers]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n".encode("utf-8")
+
+def _chunk(payload):
+    return f"{len(payload):x}\r\n".encode("latin-1") + payload + b"\r\n"
+
+async def read_request(reader):
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.LimitOverrunError:
+        raise HttpError(413, "request head too large")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ", 2)
+        headers = {name.strip().lower(): value.strip() for name, value in (line.split(":", 1) for line in lines[1:] if line)}
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise HttpError(400, "malformed request")
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, "request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target, version, headers, body
+
+# A session's key is derived from its id and the service secret, so every worker (and,
+# with PIPELINE_SESSION_SECRET, every replica) can check it without shared state.
+def session_key(secret, session_id):
+    return hmac.new(secret, session_id.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def _bearer_token(headers):
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    return token.strip() if scheme.lower() == "bearer" else ""
+
+def _wants_keep_alive(version, headers):
+    connection = headers.get("connection", "").lower()
+    return connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+
+# --- Streaming Pipeline Service ---
+# A dependency-free asyncio HTTP/1.1 server around PipelineEngine.aturn:
+#   POST   /v1/turns                        {"message", "session_id"?, "patch_mode"?, "verify_candidates"?, "tests"?}
+#                                           -> text/event-stream: session, directive, ack, progress, chunk, part, ..., done
+#   GET    /v1/sessions/<id>/messages       ?limit=20&before=<seq>
+#   DELETE /v1/sessions/<id>
+#   GET    /healthz, /metrics
+# A turn without session_id starts a new session; its "session" event carries the
+# session_key, which every later request for that session (turns, messages, delete) must
+# send as "Authorization: Bearer <session_key>". verify_candidates and tests run code
+# on this host: they are refused unless the operator started the service with
+# --allow-verification, and tests also need CANDIDATE_VERIFICATION_SANDBOX.
+# Connections are kept alive between requests (the event stream is sent chunked, so it
+# ends without closing the socket). Every event is followed by drain(): a slow reader
+# stalls its own turn, and with it the upstream read, instead of piling the answer up in
+# memory. Each worker is a separate process with its own event loop (SO_REUSEPORT); the
+# message and session stores are shared through their SQLite files, so any worker can
+# serve the next turn of any conversation.
+class PipelineService:
+    def __init__(self, engine, message_store, tracer, token_accounting=None, session_secret=None, allow_verification=False, verifier=None):
+        self.engine = engine
+        self.message_store = message_store
+        self.tracer = tracer
+        self.token_accounting = token_accounting
+        self.session_secret = session_secret or secrets.token_bytes(32)
+        self.allow_verification = allow_verification
+        self.verifier = verifier
+        self.counters = {"connections": 0, "open_connections": 0, "requests": 0, "streams": 0, "active_streams": 0,
+                         "client_disconnects": 0, "heartbeats": 0, "unauthorized": 0}
+
+    async def handle_connection(self, reader, writer):
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH_BYTES, low=WRITE_BUFFER_LOW_BYTES)
+        self.counters["connections"] += 1
+        self.counters["open_connections"] += 1
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    method, target, version, headers, body = await asyncio.wait_for(read_request(reader), KEEPALIVE_TIMEOUT_SECONDS)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except HttpError as e:
+                    await self._send_json(writer, e.status, {"error": str(e)}, keep_alive=False)
+                    return
+                self.counters["requests"] += 1
+                keep_alive = _wants_keep_alive(version, headers)
+                try:
+                    await self._route(method, target, headers, body, writer, keep_alive)
+                except HttpError as e:
+                    await self._send_json(writer, e.status, {"error": str(e)}, keep_alive)
+        except ConnectionError:
+            self.counters["client_disconnects"] += 1
+        finally:
+            self.counters["open_connections"] -= 1
+            writer.close()
+
+    def _authorize(self, session_id, headers):
+        if not hmac.compare_digest(_bearer_token(headers).encode("utf-8"), session_key(self.session_secret, session_id).encode("utf-8")):
+            self.counters["unauthorized"] += 1
+            raise HttpError(401, "missing or invalid session key")
+
+    async def _route(self, method, target, headers, body, writer, keep_alive):
+        url = urlsplit(target)
+        path = url.path.rstrip("/")
+        segments = path.split("/")
+        if path == "/v1/turns":
+            if method != "POST": raise HttpError(405, "use POST")
+            request = self._turn_request(body)
+            if request["session_id"] is None:
+                request["session_id"] = uuid.uuid4().hex
+            else:
+                self._authorize(request["session_id"], headers)
+            return await self._stream_turn(request, writer, keep_alive)
+        if len(segments) == 5 and segments[:3] == ["", "v1", "sessions"] and segments[4] == "messages":
+            if method != "GET": raise HttpError(405, "use GET")
+            self._authorize(segments[3], headers)
+            query = parse_qs(url.query)
+            try:
+                limit = min(200, int(query.get("limit", ["20"])[0]))
+                before_seq = int(query["before"][0]) if "before" in query else None
+            except ValueError:
+                raise HttpError(400, "limit and before must be integers")
+            messages = self.message_store.page(segments[3], limit, before_seq)
+            return await self._send_json(writer, 200, {"session_id": segments[3], "messages": messages}, keep_alive)
+        if len(segments) == 4 and segments[:3] == ["", "v1", "sessions"]:
+            if method != "DELETE": raise HttpError(405, "use DELETE")
+            self._authorize(segments[3], headers)
+            self.engine.delete_session(segments[3])
+            return await self._send_json(writer, 200, {"deleted": segments[3]}, keep_alive)
+        if path == "/healthz":
+            health = {"status": "ok", "pid": os.getpid(), "service": self.counters, "engine": self.engine.stats()}
+            if self.token_accounting is not None: health["tokens"] = self.token_accounting.stats()
+            return await self._send_json(writer, 200, health, keep_alive)
+        if path == "/metrics":
+            payload = self.tracer.exposition().encode("utf-8")
+            writer.write(_head(200, [("Content-Type", "text/plain; version=0.0.4"), ("Content-Length", len(payload)),
+                                     ("Connection", "keep-alive" if keep_alive else "close")]) + payload)
+            return await writer.drain()
+        raise HttpError(404, f"no route for {method} {url.path}")
+
+    def _turn_request(self, body):
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            raise HttpError(400, "body must be JSON")
+        if not isinstance(request, dict) or not isinstance(request.get("message"), str) or not request["message"].strip():
+            raise HttpError(400, "'message' (non-empty string) is required")
+        try:
+            verify_candidates = max(0, min(MAX_VERIFY_CANDIDATES, int(request.get("verify_candidates") or 0)))
+        except (TypeError, ValueError):
+            raise HttpError(400, "'verify_candidates' must be an integer")
+        tests = request.get("tests") or None
+        if (verify_candidates or tests) and not self.allow_verification:
+            raise HttpError(403, "local verification is disabled on this server")
+        if tests is not None and not isinstance(tests, str):
+            raise HttpError(400, "'tests' must be a string")
+        if tests and not (self.verifier is not None and self.verifier.isolated):
+            raise HttpError(403, "tests are only accepted when verification runs in a sandbox (CANDIDATE_VERIFICATION_SANDBOX)")
+        return {"session_id": str(request["session_id"]) if request.get("session_id") else None, "message": request["message"],
+                "patch_mode": bool(request.get("patch_mode")), "verify_candidates": verify_candidates, "tests": tests}
+
+    async def _send_json(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        writer.write(_head(status, [("Content-Type", "application/json"), ("Content-Length", len(body)),
+                                    ("Connection", "keep-alive" if keep_alive else "close")]) + body)
+        await writer.drain()
+
+    async def _stream_turn(self, request, writer, keep_alive):
+        writer.write(_head(200, [("Content-Type", "text/event-stream"), ("Cache-Control", "no-cache"),
+                                 ("Transfer-Encoding", "chunked"), ("Connection", "keep-alive" if keep_alive else "close")]))
+        writer.write(_chunk(_sse("session", {"session_id": request["session_id"],
+                                             "session_key": session_key(self.session_secret, request["session_id"])})))
+        self.counters["streams"] += 1
+        self.counters["active_streams"] += 1
+        # The turn runs in its own task (its trace and session context stay in one task) and
+        # hands events over through a one-slot queue, so it never gets ahead of the socket.
+        events = asyncio.Queue(maxsize=1)
+        producer = asyncio.ensure_future(self._produce_events(request, events))
+        try:
+            await writer.drain()
+            while True:
+                try:
+                    item = await asyncio.wait_for(events.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comment line: keeps proxies from timing out while Model1 or a verifier is busy.
+                    self.counters["heartbeats"] += 1
+                    writer.write(_chunk(b": keep-alive\n\n"))
+                    await writer.drain()
+                    continue
+                if item is None:
+                    break
+                writer.write(_chunk(_sse(*item)))
+                await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            # Also reached when the client goes away mid-answer: cancelling the turn closes the upstream stream.
+            self.counters["active_streams"] -= 1
+            if not producer.done():
+                producer.cancel()
+                await asyncio.gather(producer, return_exceptions=True)
+
+    async def _produce_events(self, request, events):
+        turn = self.engine.aturn(request["session_id"], request["message"], request["patch_mode"], request["verify_candidates"], request["tests"])
+        try:
+            async with aclosing(turn):
+                async for item in turn:
+                    await events.put(item)
+        except Exception as e:
+            print(f"ERROR (PipelineService): Turn failed: {e}")
+            await events.put(("error", f"An unexpected error occurred: {e}"))
+        await events.put(None)
+
+
+def _configure_backend(options):
+    if not options.get("fake"):
+        return
+    from llm_backends import FakeBackend, lognormal_latency, set_default_backend
+    set_default_backend(FakeBackend(
+        chunk_chars=options["fake_chunk_chars"], tokens_per_second=options["fake_tokens_per_second"] or None,
+        first_token_latency=lognormal_latency(options["fake_ttft_ms"] / 1000.0) if options["fake_ttft_ms"] else None,
+        seed=os.getpid(),
+    ))
+
+async def run_server(host, port, reuse_port=False, options=None):
+    options = options or {}
+    _configure_backend(options)
+    from candidate_verification import SandboxedVerifier
+    from message_store import shared_message_store
+    from pipeline_engine import shared_pipeline_engine
+    from token_accounting import shared_token_accounting
+    from tracing import shared_tracer
+    allow_verification = bool(options.get("allow_verification"))
+    shared_pipeline_engine.verification_enabled = allow_verification
+    service = PipelineService(shared_pipeline_engine, shared_message_store, shared_tracer, shared_token_accounting,
+                              session_secret=options.get("session_secret", "").encode("utf-8") or None,
+                              allow_verification=allow_verification, verifier=SandboxedVerifier())
+    # Pay for model handles and the intent router's training before taking traffic.
+    shared_pipeline_engine.warm_up()
+    server = await asyncio.start_server(service.handle_connection, host, port, reuse_port=reuse_port or None, limit=MAX_HEADER_BYTES)
+    print(f"INFO (PipelineService): Worker {os.getpid()} listening on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def _worker_main(host, port, reuse_port, options):
+    try:
+        asyncio.run(run_server(host, port, reuse_port, options))
+    except KeyboardInterrupt:
+        pass
+
+# Worker processes are spawned (not forked): each opens its own SQLite connections and
+# model handles instead of inheriting the parent's. They share one session secret; without
+# PIPELINE_SESSION_SECRET it is random, so session keys do not survive a restart.
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=1, options=None):
+    options = dict(options or {})
+    if not options.get("session_secret"):
+        options["session_secret"] = secrets.token_hex(32)
+        print("WARNING (PipelineService): PIPELINE_SESSION_SECRET is not set; session keys are only valid until the service restarts.")
+    if workers <= 1:
+        return _worker_main(host, port, False, options)
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_worker_main, args=(host, port, True, options), daemon=True) for _ in range(workers)]
+    for process in processes: process.start()
+    try:
+        for process in processes: process.join()
+    except KeyboardInterrupt:
+        for process in processes: process.terminate()
+
+
+# --- Load-Test Client ---
+# Each simulated user keeps one connection alive and runs its turns back to back.
+async def stream_turn(reader, writer, host, payload, session_key=None):
+    body = json.dumps(payload).encode("utf-8")
+    authorization = f"Authorization: Bearer {session_key}\r\n" if session_key else ""
+    writer.write(f"POST /v1/turns HTTP/1.1\r\nHost: {host}\r\n{authorization}Content-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    status_line = (await reader.readuntil(b"\r\n\r\n")).split(b"\r\n", 1)[0]
+    if b" 200 " not in status_line + b" ":
+        raise RuntimeError(f"unexpected response: {status_line.decode('latin-1')}")
+    events, buffer = [], b""
+    while True:
+        size = int((await reader.readuntil(b"\r\n")).strip(), 16)
+        data = await reader.readexactly(size + 2)
+        if size == 0:
+            return events
+        buffer += data[:-2]
+        while b"\n\n" in buffer:
+            block, buffer = buffer.split(b"\n\n", 1)
+            fields = dict(line.split(": ", 1) for line in block.decode("utf-8").split("\n") if ": " in line and not line.startswith(":"))
+            if "event" in fields: events.append((time.perf_counter(), fields["event"], json.loads(fields.get("data", "null"))))
+
+async def _simulated_user(host, port, turns, user_index, results):
+    reader, writer = await asyncio.open_connection(host, port, limit=MAX_BODY_BYTES)
+    session = {}  # The first turn opens the session; later turns authenticate with its key.
+    try:
+        for turn_index in range(turns):
+            started_at = time.perf_counter()
+            prompt = LOADTEST_PROMPTS[(user_index + turn_index) % len(LOADTEST_PROMPTS)]
+            try:
+                events = await stream_turn(reader, writer, host, dict(session_id=session.get("session_id"), message=prompt), session.get("session_key"))
+            except (RuntimeError, ConnectionError, asyncio.IncompleteReadError) as e:
+                results.append({"error": str(e)})
+                return
+            session = next((data for _, event, data in events if event == "session"), session)
+            first_output = next((at for at, event, _ in events if event in ("chunk", "text", "ack")), None)
+            results.append({"total": time.perf_counter() - started_at, "first_output": (first_output or time.perf_counter()) - started_at,
+                            "chars": sum(len(data) for _, event, data in events if event == "chunk"),
+                            "error": next((data for _, event, data in events if event == "error"), None)})
+    finally:
+        writer.close()
+
+async def run_load_test(host, port, users, turns):
+    results = []
+    started_at = time.perf_counter()
+    await asyncio.gather(*(_simulated_user(host, port, turns, index, results) for index in range(users)))
+    return results, time.perf_counter() - started_at
+
+def print_load_test(results, elapsed):
+    from benchmark import summarise
+    completed = [result for result in results if "total" in result]
+    print(f"Turns: {len(completed)} completed, {len(results) - len(completed)} failed, {sum(1 for r in completed if r['error'])} with errors; "
+          f"{len(completed) / elapsed:.1f} turns/s, {sum(r['chars'] for r in completed) / elapsed / 1024:.1f} KB/s streamed")
+    for name in ("first_output", "total"):
+        values = summarise([result[name] * 1000 for result in completed])
+        print(f"  {name:<14} p50={values['p50']:.1f}ms p95={values['p95']:.1f}ms p99={values['p99']:.1f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the orchestration pipeline over HTTP with Server-Sent Events, or load-test a running service.")
+    parser.add_argument("command", nargs="?", choices=("serve", "loadtest"), default="serve")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("PIPELINE_WORKERS", "1")), help="Worker processes sharing the port (SO_REUSEPORT).")
+    parser.add_argument("--fake", action="store_true", help="Serve from the offline fake backend (for load tests).")
+    parser.add_argument("--fake-tokens-per-second", type=float, default=0, help="Simulated stream rate; 0 = unthrottled.")
+    parser.add_argument("--fake-ttft-ms", type=float, default=0, help="Median simulated time-to-first-token (lognormal).")
+    parser.add_argument("--fake-chunk-chars", type=int, default=64)
+    parser.add_argument("--allow-verification", action="store_true", default=bool(os.getenv("CANDIDATE_VERIFICATION_ENABLED")),
+                        help="Accept verify_candidates (and, with CANDIDATE_VERIFICATION_SANDBOX, tests): runs generated code on this host.")
+    parser.add_argument("--users", type=int, default=20, help="loadtest: concurrent users, one keep-alive connection each.")
+    parser.add_argument("--turns", type=int, default=5, help="loadtest: turns per user.")
+    args = parser.parse_args(argv)
+
+    if args.command == "loadtest":
+        results, elapsed = asyncio.run(run_load_test(args.host, args.port, args.users, args.turns))
+        print_load_test(results, elapsed)
+        return 0 if all("total" in result for result in results) else 1
+    options = {"fake": args.fake, "fake_tokens_per_second": args.fake_tokens_per_second,
+               "fake_ttft_ms": args.fake_ttft_ms, "fake_chunk_chars": args.fake_chunk_chars,
+               "allow_verification": args.allow_verification, "session_secret": os.getenv("PIPELINE_SESSION_SECRET", "")}
+    serve(args.host, args.port, args.workers, options)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
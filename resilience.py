@@ -0,0 +1,234 @@
+import asyncio
+import random
+import threading
+import time
+from google.api_core import exceptions as api_exceptions
+
+RETRYABLE_EXCEPTIONS = (
+    api_exceptions.TooManyRequests,       # 429 (ResourceExhausted)
+    api_exceptions.InternalServerError,   # 500
+    api_exceptions.ServiceUnavailable,    # 503
+    api_exceptions.DeadlineExceeded,      # 504
+    ConnectionError,
+    TimeoutError,
+)
+
+def is_retryable(exc):
+    return isinstance(exc, RETRYABLE_EXCEPTIONS)
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=4, base_delay=0.5, max_delay=8.0, deadline_seconds=60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline_seconds = deadline_seconds
+
+    # "Full jitter" exponential backoff: uniform in [0, min(max_delay, base * 2^attempt)].
+    def delay_for(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+# --- Per-Model Circuit Breaker ---
+# closed -> open after failure_threshold consecutive retryable failures; while open every
+# call is rejected immediately; after reset_timeout one trial call is let through
+# (half-open) and its outcome closes or re-opens the circuit.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def release_trial(self):
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+
+    # Returns True if this failure tripped the breaker open.
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            self._trial_in_flight = False
+            if self.state == "half_open" or (self.state == "closed" and self._consecutive_failures >= self.failure_threshold):
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+
+# --- Shared Resilience Layer ---
+# Wraps every upstream Gemini call (sync and async, one-shot and streaming) with
+# deadline-aware jittered retries and a per-model circuit breaker. Streaming callers pass
+# an open_stream(attempt) factory; on a retryable failure mid-stream it is called again
+# with attempt > 0 and is expected to resume from the text already yielded.
+class ResilienceLayer:
+    def __init__(self, policy=None, failure_threshold=5, reset_timeout=30.0, sleep=time.sleep):
+        self.policy = policy or RetryPolicy()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._sleep = sleep
+        self._breakers = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _breaker(self, model_name):
+        with self._lock:
+            if model_name not in self._breakers:
+                self._breakers[model_name] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self._metrics[model_name] = {
+                    "calls": 0, "successes": 0, "failures": 0, "retries": 0, "resumed_streams": 0,
+                    "trips": 0, "short_circuited": 0, "retry_delay_seconds": 0.0,
+                }
+            return self._breakers[model_name]
+
+    def _count(self, model_name, key, amount=1):
+        with self._lock:
+            self._metrics[model_name][key] += amount
+
+    def _admit(self, model_name):
+        breaker = self._breaker(model_name)
+        if not breaker.allow():
+            self._count(model_name, "short_circuited")
+            raise CircuitOpenError(f"Circuit open for '{model_name}': upstream is degraded, request shed. Please retry shortly.")
+        return breaker
+
+    # Returns the backoff delay before the next attempt, or None if the error must propagate.
+    def _on_failure(self, model_name, breaker, exc, attempt, started_at):
+        if not is_retryable(exc):
+            breaker.record_success()  # The backend answered (e.g. a 400), so it is not degraded.
+            self._count(model_name, "failures")
+            return None
+        if breaker.record_failure():
+            self._count(model_name, "trips")
+            print(f"WARNING (ResilienceLayer): Circuit opened for '{model_name}' after {exc.__class__.__name__}.")
+        delay = self.policy.delay_for(attempt)
+        if attempt + 1 >= self.policy.max_attempts or time.monotonic() - started_at + delay > self.policy.deadline_seconds:
+            self._count(model_name, "failures")
+            return None
+        self._count(model_name, "retries")
+        self._count(model_name, "retry_delay_seconds", delay)
+        print(f"WARNING (ResilienceLayer): {exc.__class__.__name__} from '{model_name}', retry {attempt + 1} in {delay:.2f}s.")
+        return delay
+
+    def _on_success(self, model_name, breaker):
+        breaker.record_success()
+        self._count(model_name, "successes")
+
+    def call(self, model_name, fn):
+        started_at, attempt = time.monotonic(), 0
+        self._breaker(model_name)
+        self._count(model_name, "calls")
+        while True:
+            breaker = self._admit(model_name)
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._on_failure(model_name, breaker, e, attempt, started_at)
+                if delay is None: raise
+                self._sleep(delay)
+                attempt += 1
+                continue
+            self._on_success(model_name, breaker)
+            return result
+
+    def stream(self, model_name, open_stream):
+        started_at, attempt = time.monotonic(), 0
+        self._breaker(model_name)
+        self._count(model_name, "calls")
+        while True:
+            breaker = self._admit(model_name)
+            if attempt > 0: self._count(model_name, "resumed_streams")
+            try:
+                for item in open_stream(attempt):
+                    yield item
+            except GeneratorExit:
+                self._on_success(model_name, breaker)  # Consumer stopped early; upstream was healthy.
+                raise
+            except Exception as e:
+                delay = self._on_failure(model_name, breaker, e, attempt, started_at)
+                if delay is None: raise
+                self._sleep(delay)
+                attempt += 1
+                continue
+            self._on_success(model_name, breaker)
+            return
+
+    async def acall(self, model_name, coro_fn):
+        started_at, attempt = time.monotonic(), 0
+        self._breaker(model_name)
+        self._count(model_name, "calls")
+        while True:
+            breaker = self._admit(model_name)
+            try:
+                result = await coro_fn()
+            except asyncio.CancelledError:
+                breaker.release_trial()
+                raise
+            except Exception as e:
+                delay = self._on_failure(model_name, breaker, e, attempt, started_at)
+                if delay is None: raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._on_success(model_name, breaker)
+            return result
+
+    async def astream(self, model_name, open_stream):
+        started_at, attempt = time.monotonic(), 0
+        self._breaker(model_name)
+        self._count(model_name, "calls")
+        while True:
+            breaker = self._admit(model_name)
+            if attempt > 0: self._count(model_name, "resumed_streams")
+            try:
+                async for item in await open_stream(attempt):
+                    yield item
+            except GeneratorExit:
+                self._on_success(model_name, breaker)
+                raise
+            except asyncio.CancelledError:
+                breaker.release_trial()
+                raise
+            except Exception as e:
+                delay = self._on_failure(model_name, breaker, e, attempt, started_at)
+                if delay is None: raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._on_success(model_name, breaker)
+            return
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for model_name, metrics in self._metrics.items():
+                stats[model_name] = dict(metrics, retry_delay_seconds=round(metrics["retry_delay_seconds"], 3), state=self._breakers[model_name].state)
+            return stats
+
+
+shared_resilience = ResilienceLayer()
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+DEFAULT_CACHE_PATH = Path(__file__).resolve().parent / ".cache" / "responses.sqlite3"
+REPLAY_CHUNK_CHARS = 256
+
+def normalise_prompt(prompt):
+    return " ".join(str(prompt).split())
+
+def replay_cached_text(text, chunk_chars=REPLAY_CHUNK_CHARS):
+    for start in range(0, len(text), chunk_chars):
+        yield text[start:start + chunk_chars]
+
+
+# --- Two-Tier Response Cache (in-memory LRU + SQLite) ---
+# Content-addressed on (normalised prompt, model name, generation config, system
+# instruction hash). Entries expire after ttl_seconds; the memory tier is bounded by
+# entry count and the disk tier by total stored bytes (least recently used go first).
+class ResponseCache:
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, max_memory_entries=256, max_disk_bytes=64 * 1024 * 1024, ttl_seconds=24 * 3600):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "puts": 0, "evictions": 0, "expired": 0}
+        self._conn = None
+        if db_path is not None:
+            try:
+                Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+                self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                    "size INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+                )
+                self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+                self._conn.commit()
+            except sqlite3.Error as e:
+                print(f"WARNING (ResponseCache): Disk tier disabled, could not open '{db_path}': {e}")
+                self._conn = None
+
+    @staticmethod
+    def make_key(prompt, model_name, generation_config=None, system_instruction=None):
+        instruction_digest = hashlib.sha256((system_instruction or "").encode("utf-8")).hexdigest()
+        material = json.dumps(
+            [normalise_prompt(prompt), model_name, generation_config or {}, instruction_digest],
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+                self.counters["expired"] += 1
+            if self._conn is not None:
+                row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value, created_at = row
+                    if now - created_at <= self.ttl_seconds:
+                        self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                        self._conn.commit()
+                        self._remember(key, value, created_at)
+                        self.counters["disk_hits"] += 1
+                        return value
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                    self.counters["expired"] += 1
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            self.counters["puts"] += 1
+            if self._conn is not None:
+                size = len(value.encode("utf-8"))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, size, now, now)
+                )
+                self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+                self._evict_disk()
+                self._conn.commit()
+
+    def _remember(self, key, value, created_at):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def _evict_disk(self):
+        total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        while total_size > self.max_disk_bytes:
+            row = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 1").fetchone()
+            if row is None: break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            total_size -= row[1]
+            self.counters["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self._memory)
+            if self._conn is not None:
+                stats["disk_entries"], stats["disk_bytes"] = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+# Set RESPONSE_CACHE_DISABLED=1 to turn caching off for every model.
+shared_response_cache = None if os.getenv("RESPONSE_CACHE_DISABLED") else ResponseCache()
@@ -0,0 +1,258 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from tracing import shared_tracer
+
+# Gemini 1.5 Flash pay-as-you-go limits; the free tier is 15 RPM / 1M TPM.
+DEFAULT_REQUESTS_PER_MINUTE = int(os.getenv("UPSTREAM_RPM", "2000"))
+DEFAULT_TOKENS_PER_MINUTE = int(os.getenv("UPSTREAM_TPM", "4000000"))
+DEFAULT_MAX_WAIT_SECONDS = 120.0
+MAX_TRACKED_SESSIONS = 10000
+
+# Lower runs first. Orchestrator turns are short and block the whole UI turn, so they
+# jump ahead of long specialized generations.
+PRIORITY_ORCHESTRATOR = 0
+PRIORITY_GENERATION = 1
+PRIORITY_LONG_GENERATION = 2
+
+ANONYMOUS_SESSION = "anonymous"
+_current_session = contextvars.ContextVar("current_session", default=ANONYMOUS_SESSION)
+
+# Identifies whose quota share the calls made in this context count against.
+def set_current_session(session_id):
+    _current_session.set(session_id)
+
+def current_session():
+    return _current_session.get()
+
+
+class SchedulerTimeoutError(RuntimeError):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, capacity, refill_per_second, clock=time.monotonic):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._clock = clock
+        self.tokens = float(capacity)
+        self._updated_at = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.refill_per_second)
+        self._updated_at = now
+
+    def wait_time(self, amount):
+        self._refill()
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+    # Settles an estimate against the real cost; the balance may go negative (debt).
+    def adjust(self, delta):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+
+class AdmissionTicket:
+    def __init__(self, seq, model_name, session_id, priority, cost, start_tag, finish_tag, enqueued_at, expected_output_tokens=0):
+        self.seq = seq
+        self.model_name = model_name
+        self.session_id = session_id
+        self.priority = priority
+        self.cost = cost
+        self.expected_output_tokens = expected_output_tokens
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.enqueued_at = enqueued_at
+        self.admitted_at = None
+
+    def sort_key(self):
+        return (self.priority, self.finish_tag, self.seq)
+
+    def __lt__(self, other):
+        return self.sort_key() < other.sort_key()
+
+
+# --- Quota-Aware Fair Scheduler ---
+# Every upstream request (each retry attempt included) is admitted here first. Per model
+# there is one RPM and one TPM token bucket and one queue ordered by (priority, virtual
+# finish tag): strict priority between action classes and start-time fair queuing
+# between sessions within a class, so a session firing long generations back to back
+# only advances its own virtual clock. Token costs are estimated before sending and
+# settled against usage metadata (or an estimate of the generated output) afterwards.
+class QuotaScheduler:
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+                 max_wait_seconds=DEFAULT_MAX_WAIT_SECONDS, clock=time.monotonic):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_wait_seconds = max_wait_seconds
+        self.session_weights = {}
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._seq = itertools.count()
+        self._queues = {}
+        self._buckets = {}
+        self._virtual_time = {}
+        self._session_finish = {}
+        self._output_estimates = {}
+        self._metrics = {}
+
+    def _model_state(self, model_name):
+        if model_name not in self._buckets:
+            self._buckets[model_name] = (
+                TokenBucket(self.requests_per_minute, self.requests_per_minute / 60.0, self._clock),
+                TokenBucket(self.tokens_per_minute, self.tokens_per_minute / 60.0, self._clock),
+            )
+            self._queues[model_name] = []
+            self._virtual_time[model_name] = 0.0
+            self._metrics[model_name] = {"admitted": 0, "timed_out": 0, "cancelled": 0, "queue_depth": 0, "peak_queue_depth": 0,
+                                         "wait_seconds_total": 0.0, "max_wait_seconds": 0.0, "tokens_estimated": 0, "tokens_settled": 0}
+        return self._buckets[model_name]
+
+    # Expected output length of a model, learned from settled calls.
+    def expected_output_tokens(self, model_label, max_output_tokens):
+        with self._lock:
+            return int(self._output_estimates.get(model_label, max_output_tokens / 4))
+
+    def _enqueue(self, model_name, priority, estimated_tokens, session_id, expected_output_tokens=0):
+        with self._lock:
+            self._model_state(model_name)
+            cost = max(1, min(int(estimated_tokens), self.tokens_per_minute))  # Never more than a full bucket.
+            weight = self.session_weights.get(session_id, 1.0)
+            start_tag = max(self._virtual_time[model_name], self._session_finish.get((model_name, session_id), 0.0))
+            finish_tag = start_tag + cost / weight
+            self._session_finish[(model_name, session_id)] = finish_tag
+            if len(self._session_finish) > MAX_TRACKED_SESSIONS: self._prune_sessions()
+            ticket = AdmissionTicket(next(self._seq), model_name, session_id, priority, cost, start_tag, finish_tag, self._clock(), expected_output_tokens)
+            heapq.heappush(self._queues[model_name], ticket)
+            metrics = self._metrics[model_name]
+            metrics["queue_depth"] = len(self._queues[model_name])
+            metrics["peak_queue_depth"] = max(metrics["peak_queue_depth"], metrics["queue_depth"])
+        shared_tracer.metrics.set_gauge("scheduler_queue_depth", metrics["queue_depth"], model=model_name)
+        return ticket
+
+    # Sessions whose finish tag the virtual clock has passed would start at the clock anyway.
+    def _prune_sessions(self):
+        self._session_finish = {
+            (model_name, session_id): finish_tag for (model_name, session_id), finish_tag in self._session_finish.items()
+            if finish_tag > self._virtual_time[model_name]
+        }
+
+    # Returns 0.0 once the ticket is admitted, else how long to wait before trying again
+    # (None: not at the head of its queue, wait to be notified).
+    def _try_admit(self, ticket):
+        with self._lock:
+            queue = self._queues[ticket.model_name]
+            if queue[0] is not ticket:
+                return None
+            request_bucket, token_bucket = self._buckets[ticket.model_name]
+            wait = max(request_bucket.wait_time(1), token_bucket.wait_time(ticket.cost))
+            if wait > 0:
+                return wait
+            request_bucket.take(1)
+            token_bucket.take(ticket.cost)
+            heapq.heappop(queue)
+            self._virtual_time[ticket.model_name] = max(self._virtual_time[ticket.model_name], ticket.start_tag)
+            ticket.admitted_at = self._clock()
+            waited = ticket.admitted_at - ticket.enqueued_at
+            metrics = self._metrics[ticket.model_name]
+            metrics["admitted"] += 1
+            metrics["queue_depth"] = len(queue)
+            metrics["wait_seconds_total"] += waited
+            metrics["max_wait_seconds"] = max(metrics["max_wait_seconds"], waited)
+            metrics["tokens_estimated"] += ticket.cost
+            self._condition.notify_all()
+        shared_tracer.metrics.observe("scheduler_wait_seconds", waited, model=ticket.model_name, priority=ticket.priority)
+        shared_tracer.metrics.set_gauge("scheduler_queue_depth", metrics["queue_depth"], model=ticket.model_name)
+        return 0.0
+
+    def _abandon(self, ticket, reason):
+        with self._lock:
+            queue = self._queues[ticket.model_name]
+            if ticket in queue:
+                queue.remove(ticket)
+                heapq.heapify(queue)
+            self._metrics[ticket.model_name][reason] += 1
+            self._metrics[ticket.model_name]["queue_depth"] = len(queue)
+            self._condition.notify_all()
+
+    def _timeout_error(self, ticket):
+        self._abandon(ticket, "timed_out")
+        return SchedulerTimeoutError(f"Upstream quota for '{ticket.model_name}' is saturated; request waited over {self.max_wait_seconds:.0f}s. Please retry shortly.")
+
+    def admit(self, model_name, priority, estimated_tokens, session_id=None, expected_output_tokens=0):
+        ticket = self._enqueue(model_name, priority, estimated_tokens, session_id or current_session(), expected_output_tokens)
+        deadline = ticket.enqueued_at + self.max_wait_seconds
+        try:
+            while True:
+                wait = self._try_admit(ticket)
+                if wait == 0.0:
+                    return ticket
+                remaining = deadline - self._clock()
+                if remaining <= 0:
+                    raise self._timeout_error(ticket)
+                with self._condition:
+                    self._condition.wait(timeout=min(wait if wait is not None else remaining, remaining))
+        except BaseException:
+            if ticket.admitted_at is None: self._abandon(ticket, "cancelled")
+            raise
+
+    async def aadmit(self, model_name, priority, estimated_tokens, session_id=None, expected_output_tokens=0):
+        ticket = self._enqueue(model_name, priority, estimated_tokens, session_id or current_session(), expected_output_tokens)
+        deadline = ticket.enqueued_at + self.max_wait_seconds
+        try:
+            while True:
+                wait = self._try_admit(ticket)
+                if wait == 0.0:
+                    return ticket
+                remaining = deadline - self._clock()
+                if remaining <= 0:
+                    raise self._timeout_error(ticket)
+                # No cross-thread notification on the event loop; poll briefly when queued behind others.
+                await asyncio.sleep(min(wait if wait is not None else 0.01, remaining))
+        except BaseException:
+            if ticket.admitted_at is None: self._abandon(ticket, "cancelled")
+            raise
+
+    # Settles the TPM bucket once the real token count is known (None keeps the estimate).
+    # Without a reported total, output_tokens replaces the ticket's expected output.
+    def complete(self, ticket, actual_tokens=None, model_label=None, output_tokens=None):
+        if ticket is None:
+            return
+        if actual_tokens is None and output_tokens is not None:
+            actual_tokens = max(0, ticket.cost - ticket.expected_output_tokens) + output_tokens
+        with self._lock:
+            if actual_tokens is not None:
+                self._buckets[ticket.model_name][1].adjust(ticket.cost - actual_tokens)
+                self._metrics[ticket.model_name]["tokens_settled"] += actual_tokens
+            if model_label is not None and output_tokens is not None:
+                previous = self._output_estimates.get(model_label)
+                self._output_estimates[model_label] = output_tokens if previous is None else 0.8 * previous + 0.2 * output_tokens
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for model_name, metrics in self._metrics.items():
+                request_bucket, token_bucket = self._buckets[model_name]
+                stats[model_name] = dict(
+                    metrics, wait_seconds_total=round(metrics["wait_seconds_total"], 3), max_wait_seconds=round(metrics["max_wait_seconds"], 3),
+                    mean_wait_ms=round(metrics["wait_seconds_total"] / metrics["admitted"] * 1000, 1) if metrics["admitted"] else 0.0,
+                    requests_available=int(request_bucket.tokens), tokens_available=int(token_bucket.tokens),
+                )
+            return stats
+
+
+# SCHEDULER_DISABLED=1 sends upstream calls immediately, without quota accounting.
+shared_scheduler = None if os.getenv("SCHEDULER_DISABLED") else QuotaScheduler()
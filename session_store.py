@@ -0,0 +1,179 @@
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from message_store import decode_parts, encode_parts
+
+DEFAULT_SESSION_STORE_PATH = Path(__file__).resolve().parent / ".cache" / "sessions.sqlite3"
+SESSION_RECORD_VERSION = 1
+SNAPSHOT_EVERY = 32  # Deltas between snapshots; bounds how much a cold replica replays.
+
+
+class SessionConflictError(RuntimeError):
+    pass
+
+
+# --- Session State Stores ---
+# Model1's conversation state (its ConversationContextManager) as an append-only log per
+# session: one "delta" record per committed turn, and every SNAPSHOT_EVERY records a full
+# "snapshot" that supersedes (and lets us delete) everything before it. Records are
+# (seq, kind, version, payload); payloads use the message store's compact encoding.
+# append() takes the seq the writer expects to write, so two replicas racing on one
+# session cannot both extend it from the same state: the loser gets SessionConflictError.
+# The chat messages themselves already live in the message store.
+class InMemorySessionStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = {}
+        self.counters = {"appends": 0, "snapshots": 0, "reads": 0, "conflicts": 0, "stored_bytes": 0}
+
+    def append(self, session_id, kind, payload, expected_seq):
+        blob = encode_parts(payload)
+        with self._lock:
+            records = self._records.setdefault(session_id, [])
+            last_seq = records[-1][0] if records else -1
+            if expected_seq != last_seq + 1:
+                self.counters["conflicts"] += 1
+                raise SessionConflictError(f"session {session_id}: expected seq {expected_seq}, store is at {last_seq}")
+            records.append((expected_seq, kind, SESSION_RECORD_VERSION, blob))
+            self.counters["appends"] += 1
+            self.counters["snapshots"] += int(kind == "snapshot")
+            self.counters["stored_bytes"] += len(blob)
+        return expected_seq
+
+    def records(self, session_id, after_seq=-1):
+        with self._lock:
+            self.counters["reads"] += 1
+            rows = [record for record in self._records.get(session_id, []) if record[0] > after_seq]
+        return [(seq, kind, version, decode_parts(blob)) for seq, kind, version, blob in rows]
+
+    def compact(self, session_id, before_seq):
+        with self._lock:
+            self._records[session_id] = [record for record in self._records.get(session_id, []) if record[0] >= before_seq]
+
+    def delete_session(self, session_id):
+        with self._lock:
+            self._records.pop(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, sessions=len(self._records), records=sum(len(records) for records in self._records.values()))
+
+
+class SQLiteSessionStore:
+    def __init__(self, db_path=DEFAULT_SESSION_STORE_PATH, max_age_seconds=7 * 24 * 3600):
+        self._lock = threading.Lock()
+        self.counters = {"appends": 0, "snapshots": 0, "reads": 0, "conflicts": 0, "stored_bytes": 0}
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, timeout=10.0)
+        # Shared by every replica on the host: WAL lets readers run alongside a writer.
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_records (session_id TEXT NOT NULL, seq INTEGER NOT NULL, kind TEXT NOT NULL, "
+            "version INTEGER NOT NULL, payload BLOB NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (session_id, seq))"
+        )
+        self._conn.execute("DELETE FROM session_records WHERE session_id IN (SELECT session_id FROM session_records GROUP BY session_id HAVING MAX(created_at) < ?)",
+                           (time.time() - max_age_seconds,))
+        self._conn.commit()
+
+    # The seq check and the insert share one write transaction, so (as in memory) a stale
+    # replica cannot write below the head, even at seqs compact() has already deleted.
+    def append(self, session_id, kind, payload, expected_seq):
+        blob = encode_parts(payload)
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                last_seq = self._conn.execute("SELECT COALESCE(MAX(seq), -1) FROM session_records WHERE session_id = ?", (session_id,)).fetchone()[0]
+                if expected_seq != last_seq + 1:
+                    raise SessionConflictError(f"session {session_id}: expected seq {expected_seq}, store is at {last_seq}")
+                self._conn.execute("INSERT INTO session_records (session_id, seq, kind, version, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                                   (session_id, expected_seq, kind, SESSION_RECORD_VERSION, blob, time.time()))
+                self._conn.commit()
+            except (SessionConflictError, sqlite3.IntegrityError) as e:
+                self._conn.rollback()
+                self.counters["conflicts"] += 1
+                raise e if isinstance(e, SessionConflictError) else SessionConflictError(f"session {session_id}: seq {expected_seq} was already written by another replica")
+            self.counters["appends"] += 1
+            self.counters["snapshots"] += int(kind == "snapshot")
+            self.counters["stored_bytes"] += len(blob)
+        return expected_seq
+
+    def records(self, session_id, after_seq=-1):
+        with self._lock:
+            self.counters["reads"] += 1
+            rows = self._conn.execute("SELECT seq, kind, version, payload FROM session_records WHERE session_id = ? AND seq > ? ORDER BY seq",
+                                      (session_id, after_seq)).fetchall()
+        return [(seq, kind, version, decode_parts(blob)) for seq, kind, version, blob in rows]
+
+    def compact(self, session_id, before_seq):
+        with self._lock:
+            self._conn.execute("DELETE FROM session_records WHERE session_id = ? AND seq < ?", (session_id, before_seq))
+            self._conn.commit()
+
+    def delete_session(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM session_records WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            sessions, records = self._conn.execute("SELECT COUNT(DISTINCT session_id), COUNT(*) FROM session_records").fetchone()
+            return dict(self.counters, sessions=sessions, records=records)
+
+
+# --- Binding a ConversationContextManager to the Store ---
+# sync() brings the manager up to date with whatever other replicas wrote (a snapshot
+# replaces the state, deltas are replayed on top); the manager's commits are appended
+# as they happen. On a conflict the local state is dropped and re-read from the store,
+# so the replica that lost the race continues from the winner's history.
+class PersistentContext:
+    def __init__(self, store, session_id, context_manager, snapshot_every=SNAPSHOT_EVERY):
+        self.store = store
+        self.session_id = session_id
+        self.context_manager = context_manager
+        self.snapshot_every = snapshot_every
+        self.seq = -1
+        context_manager.on_commit = self._persist
+
+    def sync(self):
+        started_at = time.perf_counter()
+        replayed = 0
+        for seq, kind, version, payload in self.store.records(self.session_id, self.seq):
+            if version > SESSION_RECORD_VERSION:
+                print(f"WARNING (PersistentContext): Session {self.session_id} record {seq} has newer version {version}; skipping it.")
+            elif kind == "snapshot":
+                self.context_manager.restore(payload)
+            elif kind == "delta":
+                self.context_manager.apply_delta(payload)
+            self.seq, replayed = seq, replayed + 1
+        return {"records": replayed, "seconds": time.perf_counter() - started_at}
+
+    def _persist(self, delta):
+        try:
+            self.seq = self.store.append(self.session_id, "delta", delta, self.seq + 1)
+            if (self.seq + 1) % self.snapshot_every == 0:
+                self.seq = self.store.append(self.session_id, "snapshot", self.context_manager.snapshot(), self.seq + 1)
+                self.store.compact(self.session_id, self.seq)
+        except SessionConflictError as e:
+            print(f"WARNING (PersistentContext): {e}; reloading the session.")
+            self.context_manager.restore(_EMPTY_STATE)
+            self.seq = -1
+            self.sync()
+
+
+_EMPTY_STATE = {"turns": [], "summary_lines": [], "fingerprints": [], "seen_texts": [], "unbounded_tokens": 0, "prompt_tokens": 0, "tokens_saved": 0}
+
+def open_session_store(path):
+    if path == ":memory:":
+        return InMemorySessionStore()
+    try:
+        return SQLiteSessionStore(path)
+    except sqlite3.Error as e:
+        print(f"WARNING (SQLiteSessionStore): Could not open '{path}', keeping session state in memory: {e}")
+        return InMemorySessionStore()
+
+
+# SESSION_STORE_PATH overrides the database file (":memory:" keeps it in this process);
+# SESSION_STORE_DISABLED=1 keeps Model1's state only in the process that built it.
+shared_session_store = None if os.getenv("SESSION_STORE_DISABLED") else open_session_store(os.getenv("SESSION_STORE_PATH") or DEFAULT_SESSION_STORE_PATH)
@@ -0,0 +1,139 @@
+import os
+import threading
+
+
+class _StreamFlight:
+    def __init__(self, key, upstream):
+        self.key = key
+        self.upstream = upstream
+        self.chunks = []
+        self.subscribers = 0
+        self.pulling = False
+        self.done = False
+        self.error = None
+        self.lock = threading.Lock()  # Plain lock: entered twice per chunk, RLock is measurably slower.
+        self.condition = threading.Condition(self.lock)
+
+
+# --- Single-Flight Request Coalescing ---
+# Concurrent identical requests share one upstream call. For streams, every subscriber
+# reads the same chunk buffer: whichever subscriber needs the next chunk pulls it from
+# the upstream generator (one puller at a time) and wakes the others, so no pump thread
+# is needed and a subscriber that stops early simply hands pulling to the next one. Late
+# joiners replay the buffered prefix first. The upstream is closed when the last
+# subscriber leaves. Finished flights are forgotten; the response cache covers repeats.
+class SingleFlight:
+    def __init__(self):
+        self._streams = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.counters = {"stream_leaders": 0, "stream_joins": 0, "call_leaders": 0, "call_joins": 0,
+                         "upstream_calls_saved": 0, "replayed_chunks": 0, "abandoned_streams": 0}
+
+    def stream(self, key, open_upstream):
+        with self._lock:
+            flight = self._streams.get(key)
+            if flight is None:
+                flight = self._streams[key] = _StreamFlight(key, open_upstream())
+                self.counters["stream_leaders"] += 1
+            else:
+                self.counters["stream_joins"] += 1
+                self.counters["upstream_calls_saved"] += 1
+                self.counters["replayed_chunks"] += len(flight.chunks)
+            flight.subscribers += 1
+        return self._subscribe(flight)
+
+    def _subscribe(self, flight):
+        index = 0
+        try:
+            while True:
+                must_pull = False
+                with flight.lock:
+                    while index >= len(flight.chunks) and not flight.done and flight.pulling:
+                        flight.condition.wait()
+                    if index < len(flight.chunks):
+                        chunk = flight.chunks[index]
+                        index += 1
+                    elif flight.done:
+                        if flight.error is not None: raise flight.error
+                        return
+                    else:
+                        flight.pulling = must_pull = True
+                if must_pull:
+                    has_chunk, chunk = self._pull(flight)
+                    if not has_chunk: continue
+                    index += 1  # The puller consumes its own chunk without re-reading the buffer.
+                yield chunk
+        finally:
+            self._leave(flight)
+
+    # Returns (got_chunk, chunk).
+    def _pull(self, flight):
+        chunk, finished, error = None, False, None
+        try:
+            chunk = next(flight.upstream)
+        except StopIteration:
+            finished = True
+        except BaseException as e:
+            finished, error = True, e
+        with flight.lock:
+            if finished:
+                flight.done, flight.error = True, error
+            else:
+                flight.chunks.append(chunk)
+            flight.pulling = False
+            if flight.subscribers > 1: flight.condition.notify_all()
+        if finished: self._forget(flight)
+        return not finished, chunk
+
+    def _leave(self, flight):
+        with flight.lock:
+            flight.subscribers -= 1
+            abandon = flight.subscribers == 0 and not flight.done
+            if abandon: flight.done = True
+            flight.condition.notify_all()
+        if abandon:
+            flight.upstream.close()
+            with self._lock:
+                self.counters["abandoned_streams"] += 1
+            self._forget(flight)
+
+    def _forget(self, flight):
+        with self._lock:
+            if self._streams.get(flight.key) is flight:
+                del self._streams[flight.key]
+
+    # One-shot variant: followers block until the leader's fn() returns and share its
+    # result (or its exception).
+    def call(self, key, fn):
+        with self._lock:
+            flight = self._calls.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._calls[key] = {"event": threading.Event(), "result": None, "error": None}
+                self.counters["call_leaders"] += 1
+            else:
+                self.counters["call_joins"] += 1
+                self.counters["upstream_calls_saved"] += 1
+        if not is_leader:
+            flight["event"].wait()
+            if flight["error"] is not None: raise flight["error"]
+            return flight["result"]
+        try:
+            flight["result"] = fn()
+            return flight["result"]
+        except BaseException as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            flight["event"].set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, in_flight_streams=len(self._streams), in_flight_calls=len(self._calls))
+
+
+# SINGLE_FLIGHT_DISABLED=1 gives every request its own upstream call.
+shared_single_flight = None if os.getenv("SINGLE_FLIGHT_DISABLED") else SingleFlight()
@@ -0,0 +1,165 @@
+import contextvars
+import queue
+import re
+import threading
+import time
+
+# --- Cheap Local Intent Prediction ---
+# Ordered: the first matching rule wins. Deliberately conservative; a miss only costs
+# a cancelled speculative stream, while a wrong "no prediction" costs nothing.
+_ACTION_RULES = [
+    ("fix_and_verify_code_m4", re.compile(r"\b(fix|bug|error|exception|traceback|importerror|doesn'?t work|not working|broken|crash)", re.I)),
+    ("iteratively_perfect_code_m5", re.compile(r"\b(perfect|refine|iterat\w*|polish|make (it|this) (run|work))\b", re.I)),
+    ("optimize_ml_solution_m_ml", re.compile(r"\b(classif\w*|regression|dataset|train(ing)?|model accuracy|imbalanced|overfit\w*|machine learning|\bml\b|xgboost|sklearn|neural)", re.I)),
+    ("generate_new_code_m3", re.compile(r"\b(write|generate|create|build|implement|script|function|program|class)\b", re.I)),
+]
+_SMALL_TALK = re.compile(r"^\s*(hi|hello|hey|thanks|thank you|ok(ay)?|bye|good (morning|evening))\b[\s!.]*$", re.I)
+_FOLLOW_UP = re.compile(r"^\s*(also|now|and|again|same|another|more|try|what about)\b", re.I)
+_CONTEXT_REFERENCE = re.compile(r"\b(above|previous|earlier|last (one|answer|version|script|code)|(that|the same) (code|script|function|class|file))\b", re.I)
+_PROMPT_TAG = re.compile(r"<[^>]+>")
+_PROMPT_WORD = re.compile(r"\w+")
+MIN_PROMPT_OVERLAP = 0.8
+
+def predict_action(user_input):
+    if _SMALL_TALK.match(user_input):
+        return None
+    for action, pattern in _ACTION_RULES:
+        if pattern.search(user_input):
+            return action
+    return None
+
+# Turns that lean on earlier ones ("also add logging", "fix the code above") need the
+# conversation Model1 sees; a prompt built from the raw input alone would lose it.
+def is_context_dependent(user_input):
+    return bool(_FOLLOW_UP.match(user_input) or _CONTEXT_REFERENCE.search(user_input))
+
+def _prompt_words(text):
+    return set(_PROMPT_WORD.findall(_PROMPT_TAG.sub(" ", text or "").lower()))
+
+# Share of the words in Model1's prompt (and constraints) that the speculative prompt also
+# has. Anything Model1 added, such as code from earlier turns, lowers it.
+def prompt_overlap(directive_text, speculative_prompt):
+    directive_words = _prompt_words(directive_text)
+    if not directive_words:
+        return 0.0
+    return len(directive_words & _prompt_words(speculative_prompt)) / len(directive_words)
+
+# Mirrors the prompt shapes Model1 is instructed to produce, filled from the raw user input.
+def build_speculative_prompt(action, user_input):
+    if action == "fix_and_verify_code_m4":
+        return f"<CodeToFix language='infer'>\n{user_input}\n</CodeToFix>\n<RequestDetails>User wants this code fixed/improved as described above.</RequestDetails><LibraryConstraints>Infer from the code.</LibraryConstraints>"
+    if action == "iteratively_perfect_code_m5":
+        return f"<CodeToPerfect>\n{user_input}\n</CodeToPerfect>\n<TaskGoal>As described by the user above.</TaskGoal><LibraryConstraints>Infer from the code.</LibraryConstraints><MaxIterations>10</MaxIterations>"
+    if action == "optimize_ml_solution_m_ml":
+        return f"<MLTaskDescription>{user_input}</MLTaskDescription><OriginalCodeContext></OriginalCodeContext><LibraryConstraints>scikit-learn, imblearn unless specified otherwise.</LibraryConstraints>"
+    return f"<RequestDetails>{user_input}</RequestDetails><LibraryConstraints>Python standard library only unless the request needs more.</LibraryConstraints>"
+
+
+# --- Background Speculative Stream ---
+# Pulls chunks from a specialized model on a daemon thread into a queue, so the
+# upstream request runs while the orchestrator call is still in flight.
+class SpeculativeStream:
+    _DONE = object()
+
+    def __init__(self, action, model_instance, prompt):
+        self.action = action
+        self.prompt = prompt
+        self.started_at = time.perf_counter()
+        self.first_chunk_at = None
+        self._chunks = queue.Queue()
+        self._cancelled = threading.Event()
+        # Run in a copy of the caller's context so the session's quota share and trace apply.
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(self._pump, model_instance, prompt), daemon=True)
+        self._thread.start()
+
+    def _pump(self, model_instance, prompt):
+        stream = model_instance(prompt)
+        try:
+            for chunk_text in stream:
+                if self.first_chunk_at is None: self.first_chunk_at = time.perf_counter()
+                if self._cancelled.is_set(): break
+                self._chunks.put(chunk_text)
+        except Exception as e:
+            self._chunks.put(f"\n\n--- ERROR in speculative stream: {e} ---\n\n")
+        finally:
+            stream.close()  # Stops the upstream generator (and its cache write) if cancelled mid-stream.
+            self._chunks.put(self._DONE)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def chunks(self):
+        while True:
+            chunk_text = self._chunks.get()
+            if chunk_text is self._DONE: return
+            yield chunk_text
+
+
+# A speculative answer is only kept when Model1 picked the same action and its prompt
+# asks for no more than the raw input did; follow-ups are never speculated on.
+class SpeculativeDispatcher:
+    def __init__(self, min_prompt_overlap=MIN_PROMPT_OVERLAP):
+        self.min_prompt_overlap = min_prompt_overlap
+        self._lock = threading.Lock()
+        self.counters = {"started": 0, "hits": 0, "misses": 0, "prompt_mismatches": 0, "not_predicted": 0,
+                         "context_dependent": 0, "ttft_saved_seconds": 0.0}
+
+    def begin(self, user_input, specialized_models_by_action):
+        if is_context_dependent(user_input):
+            with self._lock: self.counters["context_dependent"] += 1
+            return None
+        action = predict_action(user_input)
+        if action not in specialized_models_by_action:
+            with self._lock: self.counters["not_predicted"] += 1
+            return None
+        with self._lock: self.counters["started"] += 1
+        return SpeculativeStream(action, specialized_models_by_action[action], build_speculative_prompt(action, user_input))
+
+    # Returns the chunk iterator to use if the directive agrees, otherwise cancels and returns None.
+    def resolve(self, speculative_stream, model1_output_dict):
+        if speculative_stream is None:
+            return None
+        directive_action, directive_text = None, ""
+        if isinstance(model1_output_dict, dict) and model1_output_dict.get("is_code_related"):
+            directive_action = model1_output_dict.get("action_for_next_model")
+            directive_text = f"{model1_output_dict.get('prompt_for_next_model') or ''} {model1_output_dict.get('library_constraints_for_next_model') or ''}"
+        if directive_action != speculative_stream.action:
+            speculative_stream.cancel()
+            with self._lock: self.counters["misses"] += 1
+            return None
+        if prompt_overlap(directive_text, speculative_stream.prompt) < self.min_prompt_overlap:
+            speculative_stream.cancel()
+            with self._lock:
+                self.counters["misses"] += 1
+                self.counters["prompt_mismatches"] += 1
+            return None
+        with self._lock: self.counters["hits"] += 1
+        return self._timed_chunks(speculative_stream, time.perf_counter())
+
+    def _timed_chunks(self, speculative_stream, directive_at):
+        first = True
+        for chunk_text in speculative_stream.chunks():
+            if first:
+                first = False
+                # Serial dispatch would have shown the first token one TTFT after the directive.
+                spec_ttft = (speculative_stream.first_chunk_at or time.perf_counter()) - speculative_stream.started_at
+                serial_first_token_at = directive_at + spec_ttft
+                shown_at = max(speculative_stream.first_chunk_at or directive_at, directive_at)
+                with self._lock: self.counters["ttft_saved_seconds"] += max(0.0, serial_first_token_at - shown_at)
+            yield chunk_text
+
+    def cancel(self, speculative_stream):
+        if speculative_stream is not None:
+            speculative_stream.cancel()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        resolved = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / resolved, 4) if resolved else 0.0
+        stats["ttft_saved_seconds"] = round(stats["ttft_saved_seconds"], 3)
+        return stats
+
+
+shared_speculative_dispatcher = SpeculativeDispatcher()
@@ -0,0 +1,139 @@
+import json
+
+RAW_CODE_PREFIXES = ("# Required Libraries & Setup:", "// Required Libraries & Setup:", "# Standard Library Only")
+RAW_CODE_KEYWORDS = ["def ", "class ", "import ", "function ", "const ", "let "]
+
+# Model3 is told to emit raw code without fences; recognise it the way the original parser did.
+def guess_raw_code_language(text):
+    if not (text.startswith(RAW_CODE_PREFIXES) or any(kw in text for kw in RAW_CODE_KEYWORDS)):
+        return None
+    if "function " in text and "{" in text and not text.strip().startswith("def "): return "javascript"
+    if "public class" in text and "{" in text: return "java"
+    return "python"
+
+
+# --- Single-Pass Streaming Part Parser ---
+# Line-oriented state machine fed chunk by chunk. Emits typed parts as soon as they close:
+#   {"type": "text", "data": str}
+#   {"type": "json", "data": dict}                                 (```json fences)
+#   {"type": "code", "data": {"language": str, "code": str}}       (other ``` fences)
+# JSON is brace-matched while it streams, so the report part is emitted the moment its
+# closing brace arrives, before the fence (and any code after it) has finished.
+class StreamingPartParser:
+    def __init__(self):
+        self.warnings = []
+        self._partial_line = ""
+        self._open_lines = []
+        self._fence_language = None  # None outside fences.
+        self._json_done = False
+        self._json_depth = 0
+        self._json_in_string = False
+        self._json_escape = False
+        self._json_chars = []
+        self._emitted_structured = False
+
+    @property
+    def open_block(self):
+        if self._fence_language is None: kind = "text"
+        elif self._fence_language == "json": kind = "skip" if self._json_done else "json"
+        else: kind = "code"
+        return kind, self._fence_language, self._open_lines, self._partial_line
+
+    def feed(self, chunk_text):
+        completed_parts = []
+        lines = (self._partial_line + chunk_text).split("\n")
+        self._partial_line = lines.pop()
+        for line in lines:
+            self._consume_line(line, completed_parts)
+        return completed_parts
+
+    def close(self):
+        completed_parts = []
+        if self._partial_line:
+            self._consume_line(self._partial_line, completed_parts, at_end=True)
+            self._partial_line = ""
+        if self._fence_language is not None:
+            self._close_fence(completed_parts)  # Unterminated fence: keep what arrived.
+        else:
+            text = "\n".join(self._open_lines).strip()
+            self._open_lines = []
+            if text:
+                language = None if self._emitted_structured else guess_raw_code_language(text)
+                if language:
+                    completed_parts.append({"type": "code", "data": {"language": language, "code": text}})
+                else:
+                    completed_parts.append({"type": "text", "data": text})
+        return completed_parts
+
+    def _consume_line(self, line, completed_parts, at_end=False):
+        stripped = line.strip()
+        if self._fence_language is None:
+            if line.lstrip().startswith("```") and not at_end:
+                text = "\n".join(self._open_lines).strip()
+                self._open_lines = []
+                if text: completed_parts.append({"type": "text", "data": text})
+                self._fence_language = stripped[3:].strip().lower() or "plaintext"
+                self._json_done, self._json_depth, self._json_in_string, self._json_escape = False, 0, False, False
+                self._json_chars = []
+                return
+            self._open_lines.append(line)
+            return
+
+        if stripped == "```":
+            self._close_fence(completed_parts)
+            return
+        if self._fence_language == "json":
+            if not self._json_done:
+                self._open_lines.append(line)
+                self._scan_json(line + "\n", completed_parts)
+            return
+        self._open_lines.append(line)
+
+    def _scan_json(self, text, completed_parts):
+        for index, char in enumerate(text):
+            self._json_chars.append(char)
+            if self._json_in_string:
+                if self._json_escape: self._json_escape = False
+                elif char == "\\": self._json_escape = True
+                elif char == '"': self._json_in_string = False
+            elif char == '"': self._json_in_string = True
+            elif char in "{[": self._json_depth += 1
+            elif char in "}]":
+                self._json_depth -= 1
+                if self._json_depth == 0:
+                    self._emit_json("".join(self._json_chars), completed_parts)
+                    # The fence may close on the same line as the JSON: `}```.
+                    rest = text[index + 1:].strip()
+                    if rest.startswith("```"):
+                        self._close_fence(completed_parts)
+                        if rest[3:].strip(): self._open_lines.append(rest[3:].strip())
+                    return
+
+    def _emit_json(self, json_text, completed_parts):
+        self._json_done = True
+        self._open_lines = []
+        self._emitted_structured = True
+        try:
+            completed_parts.append({"type": "json", "data": json.loads(json_text)})
+        except json.JSONDecodeError as e:
+            self.warnings.append(f"Could not parse JSON block: {e}.")
+            completed_parts.append({"type": "code", "data": {"language": "json", "code": json_text.strip()}})
+
+    def _close_fence(self, completed_parts):
+        if self._fence_language == "json":
+            if not self._json_done and "".join(self._json_chars).strip():
+                self._emit_json("".join(self._json_chars), completed_parts)
+        else:
+            code = "\n".join(self._open_lines).strip()
+            if code:
+                completed_parts.append({"type": "code", "data": {"language": self._fence_language, "code": code}})
+                self._emitted_structured = True
+        self._open_lines = []
+        self._fence_language = None
+
+
+def parse_parts(full_response_string):
+    parser = StreamingPartParser()
+    parts = parser.feed(full_response_string)
+    parts.extend(parser.close())
+    return parts, parser.warnings
@@ -0,0 +1,168 @@
+import io
+import threading
+import time
+from collections import OrderedDict
+from stream_parser import StreamingPartParser, parse_parts
+from tracing import shared_tracer
+
+def render_part(part, placeholder):
+    if part["type"] == "json": placeholder.json(part["data"])
+    elif part["type"] == "code": placeholder.code(part["data"]["code"], language=part["data"]["language"])
+    else: placeholder.markdown(part["data"])
+
+
+# --- Helper Function to Parse and Display AI's Multi-Part Response ---
+# Non-streaming counterpart of IncrementalStreamRenderer: one pass of StreamingPartParser
+# over the whole string. Every ```json report and code fence becomes its own part, in order.
+def display_ai_parts_from_string(full_response_string, container_to_write_in):
+    if not full_response_string or not full_response_string.strip():
+        return [{"type": "text", "data": "*AI provided no output or only whitespace for this part.*"}]
+
+    with shared_tracer.span("display_parts", chars=len(full_response_string)) as span:
+        displayed_parts_for_history, parser_warnings = parse_parts(full_response_string)
+        for warning in parser_warnings:
+            container_to_write_in.warning(f"AI Warning: {warning}")
+        for part in displayed_parts_for_history:
+            render_part(part, container_to_write_in)
+        span.set(parts=len(displayed_parts_for_history), warnings=len(parser_warnings))
+
+    if not displayed_parts_for_history:
+         displayed_parts_for_history.append({"type": "text", "data": full_response_string}) # Fallback
+    return displayed_parts_for_history
+
+
+# --- Frozen History Fragments ---
+# Stored messages never change, so each is reduced once to as few Streamlit elements as
+# possible: consecutive text and code parts collapse into one markdown block (code as
+# fenced blocks, which Streamlit highlights like st.code) and JSON reports stay st.json.
+# A rerun then re-sends one or two cached elements per message instead of re-building
+# every part.
+MAX_CACHED_FRAGMENTS = 512
+_fragment_cache = OrderedDict()
+_fragment_cache_lock = threading.Lock()
+
+def _fenced(code, language):
+    fence = "```"
+    while fence in code: fence += "`"
+    return f"{fence}{language or ''}\n{code}\n{fence}"
+
+def message_fragments(message, cache_key=None):
+    if cache_key is not None:
+        with _fragment_cache_lock:
+            fragments = _fragment_cache.get(cache_key)
+            if fragments is not None:
+                _fragment_cache.move_to_end(cache_key)
+                return fragments
+    fragments, markdown_pieces = [], []
+    separator = "\n\n---\n\n" if message.get("role") == "assistant" else "\n\n"
+    for part in message.get("content_parts", []):
+        if part["type"] == "json":
+            if markdown_pieces: fragments.append(("markdown", separator.join(markdown_pieces)))
+            fragments.append(("json", part["data"]))
+            markdown_pieces = []
+        elif part["type"] == "code":
+            markdown_pieces.append(_fenced(part["data"]["code"], part["data"].get("language")))
+        else:
+            markdown_pieces.append(part["data"])
+    if markdown_pieces: fragments.append(("markdown", separator.join(markdown_pieces)))
+    if not message.get("content_parts") and "content" in message:
+        fragments.append(("markdown", message["content"]))
+    if cache_key is not None:
+        with _fragment_cache_lock:
+            _fragment_cache[cache_key] = fragments
+            while len(_fragment_cache) > MAX_CACHED_FRAGMENTS:
+                _fragment_cache.popitem(last=False)
+    return fragments
+
+def render_frozen_message(container, message, cache_key=None):
+    for index, (kind, data) in enumerate(message_fragments(message, cache_key)):
+        if index > 0 and message.get("role") == "assistant": container.markdown("---")
+        if kind == "json": container.json(data)
+        else: container.markdown(data)
+
+
+# --- Incremental Stream Renderer ---
+# Replaces "join everything and re-render on every chunk". A StreamingPartParser splits
+# the stream into typed parts; each completed part (JSON report, code block, text) is
+# rendered once in its final form and frozen. Only the open part is live, and of that
+# only the last max_open_block_lines lines are re-rendered, when min_flush_interval has
+# passed or max_unflushed_chars have arrived. Total rendering work is linear in the
+# response length.
+class IncrementalStreamRenderer:
+    def __init__(self, container, min_flush_interval=0.08, max_unflushed_chars=1024, max_open_block_lines=40, cursor=" ▌", clock=time.perf_counter):
+        self.min_flush_interval = min_flush_interval
+        self.max_unflushed_chars = max_unflushed_chars
+        self.max_open_block_lines = max_open_block_lines
+        self.cursor = cursor
+        self._clock = clock
+        self._container = container
+        self._parser = StreamingPartParser()
+        self._buffer = io.StringIO()
+        self._tail_placeholder = container.empty()
+        self._segment_placeholders = []  # Frozen display slices of the still-open part.
+        self._frozen_line_count = 0
+        self._unflushed_chars = 0
+        self._last_flush_at = self._clock()
+        self.parts = []
+        self.stats = {"chunks": 0, "chars": 0, "flushes": 0, "parts": 0}
+
+    def append(self, chunk_text):
+        if not chunk_text:
+            return
+        self._buffer.write(chunk_text)
+        self.stats["chunks"] += 1
+        self.stats["chars"] += len(chunk_text)
+        self._unflushed_chars += len(chunk_text)
+
+        for part in self._parser.feed(chunk_text):
+            self._commit_part(part)
+        self._freeze_long_open_block()
+        if self._unflushed_chars >= self.max_unflushed_chars or self._clock() - self._last_flush_at >= self.min_flush_interval:
+            self._flush_tail(with_cursor=True)
+
+    def _commit_part(self, part):
+        # The part's first display slot gets the final rendering; the other slots are cleared.
+        slots = self._segment_placeholders + [self._tail_placeholder]
+        render_part(part, slots[0])
+        for slot in slots[1:]: slot.empty()
+        self._segment_placeholders = []
+        self._frozen_line_count = 0
+        self._tail_placeholder = self._container.empty()
+        self.parts.append(part)
+        self.stats["parts"] += 1
+
+    def _render_open(self, placeholder, text, with_cursor):
+        kind, language, _, _ = self._parser.open_block
+        if kind == "skip":
+            placeholder.empty()
+        elif kind in ("code", "json"):
+            placeholder.code(text + (self.cursor if with_cursor else ""), language=language)
+        else:
+            placeholder.markdown(text + (self.cursor if with_cursor else ""))
+
+    def _freeze_long_open_block(self):
+        _, _, open_lines, _ = self._parser.open_block
+        while len(open_lines) - self._frozen_line_count >= self.max_open_block_lines:
+            segment_end = self._frozen_line_count + self.max_open_block_lines
+            self._render_open(self._tail_placeholder, "\n".join(open_lines[self._frozen_line_count:segment_end]), with_cursor=False)
+            self._segment_placeholders.append(self._tail_placeholder)
+            self._tail_placeholder = self._container.empty()
+            self._frozen_line_count = segment_end
+
+    def _flush_tail(self, with_cursor):
+        _, _, open_lines, partial_line = self._parser.open_block
+        tail_text = "\n".join(open_lines[self._frozen_line_count:] + [partial_line])
+        self._render_open(self._tail_placeholder, tail_text, with_cursor)
+        self._unflushed_chars = 0
+        self._last_flush_at = self._clock()
+        self.stats["flushes"] += 1
+
+    def finish(self):
+        for part in self._parser.close():
+            self._commit_part(part)
+        self._tail_placeholder.empty()
+        for warning in self._parser.warnings:
+            self._container.warning(f"AI Warning: {warning}")
+        if not self.parts:
+            self._commit_part({"type": "text", "data": "*AI provided no output or only whitespace for this part.*"})
+        return self._buffer.getvalue()
@@ -1,15 +1,48 @@
-import streamlit as st
-import json
+import hmac
+import os
 import re
-import time
-from model1 import (
-    make_model1,
-    # make_model2, # Decide if M2 is used directly or if M3 always supersedes it
-    make_model3,
-    make_model4,
-    make_model5,
-    make_model_ml_optimizer
-)
+import secrets
+import streamlit as st
+import uuid
+from candidate_verification import SandboxedVerifier
+from continuation import shared_output_budgets
+from intent_router import shared_intent_router
+from message_store import shared_message_store
+from model_registry import shared_model_registry
+from pipeline_engine import shared_pipeline_engine
+from pipeline_service import session_key
+from session_store import shared_session_store
+from resilience import shared_resilience
+from response_cache import shared_response_cache
+from scheduler import set_current_session, shared_scheduler
+from single_flight import shared_single_flight
+from speculative_dispatch import shared_speculative_dispatcher
+from stream_renderer import IncrementalStreamRenderer, render_frozen_message
+from token_accounting import shared_token_accounting
+from traffic_capture import shared_traffic_recorder
+from tracing import shared_tracer, start_metrics_server
+
+SESSION_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+# The URL carries "<session id>.<session key>", signed like the HTTP service's keys, so a
+# bare or guessed id cannot open someone else's stored conversation. Without
+# PIPELINE_SESSION_SECRET the secret is per process and links stop working on restart.
+@st.cache_resource
+def url_session_secret():
+    secret = os.getenv("PIPELINE_SESSION_SECRET")
+    if not secret:
+        print("WARNING (Streamlit): PIPELINE_SESSION_SECRET is not set; session links are only valid until the app restarts.")
+        secret = secrets.token_hex(32)
+    return secret.encode("utf-8")
+
+def session_from_url_token(token):
+    session_id, _, key = token.partition(".")
+    if not SESSION_ID_PATTERN.fullmatch(session_id):
+        return None
+    if not hmac.compare_digest(key.encode("utf-8"), session_key(url_session_secret(), session_id).encode("utf-8")):
+        print("WARNING (Streamlit): Ignoring a session link with an invalid key.")
+        return None
+    return session_id
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -61,15 +94,18 @@ st.markdown("""
 
 # --- Model Initialization ---
 if 'models_initialized_flag' not in st.session_state: st.session_state.models_initialized_flag = False
+# Upstream quota is shared fairly between browser sessions (see scheduler.QuotaScheduler).
+# The signed id is kept in the URL: after a restart, or on another replica sharing
+# PIPELINE_SESSION_SECRET, the conversation is rehydrated from the message and session stores.
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = session_from_url_token(st.query_params.get("session", "")) or uuid.uuid4().hex
+    st.query_params["session"] = f"{st.session_state.session_id}.{session_key(url_session_secret(), st.session_state.session_id)}"
+set_current_session(st.session_state.session_id)
 if not st.session_state.models_initialized_flag:
     with st.spinner("Initializing AI Cores... This might take a moment for the first time."): # CORRECTED
         try:
-            st.session_state.model1_instance = make_model1()
-            # st.session_state.model2_instance = make_model2() # Only if M1 routes to it
-            st.session_state.model3_instance = make_model3()
-            st.session_state.model4_instance = make_model4()
-            st.session_state.model5_instance = make_model5()
-            st.session_state.model_ml_optimizer_instance = make_model_ml_optimizer()
+            # Model1 keeps a per-session chat (held by the engine); the specialized models are stateless and shared process-wide.
+            shared_pipeline_engine.warm_up(st.session_state.session_id)
             st.session_state.models_initialized_flag = True
             print("INFO (Streamlit): All AI models initialized successfully.")
         except RuntimeError as e:
@@ -81,178 +117,161 @@ if not st.session_state.models_initialized_flag:
             import traceback; traceback.print_exc()
             st.session_state.models_initialized_flag = False
 
-# --- Helper Function to Parse and Display AI's Multi-Part Response ---
-def display_ai_parts_from_string(full_response_string, container_to_write_in):
-    # ... (The display_ai_parts_from_string function from the previous "Full Code" response - it was already quite robust) ...
-    # Key parts:
-    # - Parses for ```json block first, displays with container.json()
-    # - Parses for ```language block next, displays with container.code()
-    # - Checks for Model3-style raw code (setup comments + code), displays with container.code()
-    # - Displays any remaining text with container.markdown()
-    # - Returns a list of structured parts for history storage.
-    # For brevity, I'm not repeating the exact same code here, but ensure you have the robust version.
-    if not full_response_string or not full_response_string.strip():
-        return [{"type": "text", "data": "*AI provided no output or only whitespace for this part.*"}]
+# --- Streamlit UI Title ---
+st.title("✨ GenAI Super Coder ✨")
 
-    displayed_parts_for_history = []
-    remaining_text = full_response_string.strip() 
+with st.sidebar.expander("Model Registry"):
+    st.caption(f"Shared instances in this process: {shared_model_registry.instance_count()}")
+    st.json(shared_model_registry.stats())
 
-    json_match = re.search(r"```json\s*(\{.*?\})\s*```", remaining_text, re.DOTALL)
-    if json_match:
-        try:
-            json_data = json.loads(json_match.group(1))
-            displayed_parts_for_history.append({"type": "json", "data": json_data})
-            container_to_write_in.json(json_data)
-            remaining_text = remaining_text.replace(json_match.group(0), "", 1).strip()
-        except json.JSONDecodeError as e:
-            container_to_write_in.warning(f"AI Warning: Could not parse JSON block: {e}.")
+st.session_state.speculative_dispatch_enabled = st.sidebar.toggle(
+    "Speculative dispatch", value=st.session_state.get("speculative_dispatch_enabled", False),
+    help="Start the predicted specialized model while the orchestrator is still deciding."
+)
+with st.sidebar.expander("Speculative Dispatch"):
+    st.json(shared_speculative_dispatcher.stats())
 
-    code_match_md = re.search(r"```(\w*)\s*\n(.*?)\n```", remaining_text, re.DOTALL)
-    if code_match_md:
-        language = code_match_md.group(1).lower().strip() if code_match_md.group(1) else "plaintext"
-        code_content = code_match_md.group(2).strip()
-        displayed_parts_for_history.append({"type": "code", "data": {"language": language, "code": code_content}})
-        container_to_write_in.code(code_content, language=language)
-        remaining_text = remaining_text.replace(code_match_md.group(0), "", 1).strip()
-    
-    elif not json_match and remaining_text: 
-        is_likely_raw_code = remaining_text.startswith(("# Required Libraries & Setup:", "// Required Libraries & Setup:", "# Standard Library Only")) or \
-                             any(kw in remaining_text for kw in ["def ", "class ", "import ", "function ", "const ", "let "])
-        if is_likely_raw_code:
-            lang_guess = "python"
-            if "function " in remaining_text and "{" in remaining_text and not remaining_text.strip().startswith("def "): lang_guess = "javascript"
-            elif "public class" in remaining_text and "{" in remaining_text: lang_guess = "java"
-            
-            displayed_parts_for_history.append({"type": "code", "data": {"language": lang_guess, "code": remaining_text}})
-            container_to_write_in.code(remaining_text, language=lang_guess)
-            remaining_text = ""
+st.session_state.patch_mode_enabled = st.sidebar.toggle(
+    "Patch mode for fixes", value=st.session_state.get("patch_mode_enabled", False),
+    help="Fix/refine requests that include your code ask for edits instead of the whole program; edits are applied locally, with full regeneration as fallback. "
+         "The report streams as usual, but the fixed code only appears once the whole reply is in, and a fallback waits for a second generation."
+)
+with st.sidebar.expander("Patch Mode"):
+    for patch_model in list(shared_pipeline_engine.patch_models.values()):
+        st.caption(patch_model.model_label)
+        st.json(patch_model.stats())
 
-    if remaining_text.strip():
-        displayed_parts_for_history.append({"type": "text", "data": remaining_text})
-        container_to_write_in.markdown(remaining_text)
-        
-    if not displayed_parts_for_history and (full_response_string and full_response_string.strip()):
-         displayed_parts_for_history.append({"type": "text", "data": full_response_string}) # Fallback
-    return displayed_parts_for_history
+# Verification runs generated code on this host: only offered when the operator enabled
+# it, and typed-in tests only when every check runs in an isolating sandbox.
+if shared_pipeline_engine.verification_enabled:
+    st.session_state.verified_candidates_enabled = st.sidebar.toggle(
+        "Verify fixes locally", value=st.session_state.get("verified_candidates_enabled", False),
+        help="For fix/refine requests, generate several candidates in parallel and return the first that passes a local syntax, import and (optional) test check."
+    )
+    with st.sidebar.expander("Verified Candidates"):
+        st.session_state.verified_candidate_count = st.slider("Candidates", 2, 4, st.session_state.get("verified_candidate_count", 3))
+        if SandboxedVerifier().isolated:
+            st.session_state.verification_tests = st.text_area(
+                "Tests (optional)", value=st.session_state.get("verification_tests", ""),
+                help="Python run in the sandbox against the solution, importable as `candidate`; top-level asserts and test_* functions."
+            )
+        for runner in list(shared_pipeline_engine.verified_runners.values()):
+            st.caption(runner.model_label)
+            st.json(runner.stats())
 
-# --- Streamlit UI Title ---
-st.title("✨ GenAI Super Coder ✨")
+with st.sidebar.expander("Upstream Resilience"):
+    st.json(shared_resilience.stats() or {"info": "No upstream calls yet."})
+
+if shared_intent_router is not None:
+    with st.sidebar.expander("Local Intent Router"):
+        st.json(shared_intent_router.stats())
+
+if shared_response_cache is not None:
+    with st.sidebar.expander("Response Cache"):
+        st.json(shared_response_cache.stats())
+
+if shared_output_budgets is not None:
+    with st.sidebar.expander("Output Budgets"):
+        st.json(shared_output_budgets.stats() or {"info": "No specialized answers yet."})
+
+if shared_token_accounting is not None:
+    with st.sidebar.expander("Token Accounting"):
+        st.caption(f"This session: {shared_token_accounting.session_tokens(st.session_state.session_id):,} tokens")
+        st.json(shared_token_accounting.stats())
+
+if shared_scheduler is not None:
+    with st.sidebar.expander("Upstream Quota"):
+        st.json(shared_scheduler.stats() or {"info": "No upstream calls yet."})
+
+if shared_single_flight is not None:
+    with st.sidebar.expander("Request Coalescing"):
+        st.json(shared_single_flight.stats())
 
-if "messages" not in st.session_state:
-    st.session_state.messages = [
-        {"role": "assistant", "content_parts": [{"type": "text", "data": "Hello! I'm your AI Super Coder. How can I assist with your coding or machine learning projects today?"}]}
-    ]
+if shared_tracer.enabled:
+    if os.getenv("METRICS_PORT"):
+        start_metrics_server(shared_tracer, int(os.getenv("METRICS_PORT")))
+    with st.sidebar.expander("Metrics"):
+        st.code(shared_tracer.exposition(), language="text")
 
-for msg_data in st.session_state.messages:
-    with st.chat_message(msg_data["role"]):
-        if "content_parts" in msg_data:
-            for part_idx, part in enumerate(msg_data["content_parts"]):
-                if part_idx > 0 and msg_data["role"] == "assistant": st.markdown("---") 
-                if part["type"] == "text": st.markdown(part["data"])
-                elif part["type"] == "json": st.json(part["data"])
-                elif part["type"] == "code": st.code(part["data"]["code"], language=part["data"]["language"])
-        elif "content" in msg_data: st.markdown(msg_data["content"])
+with st.sidebar.expander("Pipeline Engine"):
+    st.json(shared_pipeline_engine.stats())
+
+if st.session_state.get("models_initialized_flag"):
+    model1_instance = shared_pipeline_engine.session(st.session_state.session_id)["model1"]
+    with st.sidebar.expander("Orchestrator Context"):
+        st.json(model1_instance.last_context_metrics or {"info": "No turns yet."})
+        st.caption(f"Prompt tokens saved this session: ~{model1_instance.context_manager.total_tokens_saved}")
+
+# --- Chat History (persistent, paginated) ---
+# Messages live in the message store, not in session_state; a rerun renders only the
+# newest history_limit messages, each from its cached fragments.
+HISTORY_PAGE_MESSAGES = 20
+session_id = st.session_state.session_id
+if shared_message_store.count(session_id) == 0:
+    shared_message_store.append(session_id, "assistant", [{"type": "text", "data": "Hello! I'm your AI Super Coder. How can I assist with your coding or machine learning projects today?"}])
+if "history_limit" not in st.session_state: st.session_state.history_limit = HISTORY_PAGE_MESSAGES
+
+with st.sidebar.expander("Message Store"):
+    st.json(shared_message_store.stats())
+
+if shared_session_store is not None:
+    with st.sidebar.expander("Session Store"):
+        st.json(shared_session_store.stats())
+
+if shared_traffic_recorder is not None:
+    with st.sidebar.expander("Traffic Capture"):
+        st.json(shared_traffic_recorder.stats())
+
+older_messages = shared_message_store.count(session_id) - st.session_state.history_limit
+# Constant label: the widget id is derived from it, and the hidden count changes every turn.
+if older_messages > 0 and st.button("Show older messages", key="show_older_messages"):
+    st.session_state.history_limit += HISTORY_PAGE_MESSAGES
+
+for msg_data in shared_message_store.page(session_id, st.session_state.history_limit):
+    render_frozen_message(st.chat_message(msg_data["role"]), msg_data, cache_key=(session_id, msg_data["seq"]))
 
 
 if user_input := st.chat_input("Describe your coding task or ask a question..."):
     if not st.session_state.get("models_initialized_flag", False):
         st.error("AI Models are not ready. Please check startup messages or console logs.")
     else:
-        st.session_state.messages.append({"role": "user", "content_parts": [{"type": "text", "data": user_input}]})
         with st.chat_message("user"):
             st.markdown(user_input)
 
+        # The turn itself (orchestration, dispatch, storing both messages) runs in the
+        # pipeline engine; this page only renders its events.
         with st.chat_message("assistant"):
             current_assistant_turn_container = st.container()
             thinking_placeholder = current_assistant_turn_container.empty()
             thinking_placeholder.markdown("<p class='thinking-placeholder'>🧠 Orchestrating AI response...</p>", unsafe_allow_html=True)
 
-            accumulated_final_parts_for_history = []
-
-            try:
-                model1_output_dict = st.session_state.model1_instance(user_input, st.session_state.messages)
-
-                if not isinstance(model1_output_dict, dict):
-                    raise ValueError(f"Model1 (Orchestrator) did not return a dictionary. Received: {type(model1_output_dict)}. Output: {model1_output_dict}")
-
-                is_code_related = model1_output_dict.get("is_code_related", False)
-                user_ack_from_model1 = model1_output_dict.get("user_facing_acknowledgement", "")
-                action_for_next = model1_output_dict.get("action_for_next_model")
-                prompt_for_next = model1_output_dict.get("prompt_for_next_model")
-
-                initial_ack_displayed_in_turn = False
-                if user_ack_from_model1:
-                    if len(user_ack_from_model1.strip()) > 3 :
-                        accumulated_final_parts_for_history.append({"type": "text", "data": user_ack_from_model1})
-                        current_assistant_turn_container.markdown(user_ack_from_model1)
-                        initial_ack_displayed_in_turn = True
-                    
-                    thinking_placeholder_text = user_ack_from_model1 if initial_ack_displayed_in_turn else "Processing..."
-                    if is_code_related:
+            turn_events = shared_pipeline_engine.turn(
+                session_id, user_input,
+                make_sink=lambda: IncrementalStreamRenderer(current_assistant_turn_container),
+                patch_mode=st.session_state.get("patch_mode_enabled", False),
+                verify_candidates=st.session_state.get("verified_candidate_count", 0) if st.session_state.get("verified_candidates_enabled") else 0,
+                tests=st.session_state.get("verification_tests", "").strip() or None,
+                speculative=st.session_state.get("speculative_dispatch_enabled", False),
+            )
+            for event, data in turn_events:
+                if event == "directive":
+                    user_ack_from_model1 = data.get("user_facing_acknowledgement", "")
+                    if data.get("is_code_related", False):
+                        thinking_placeholder_text = user_ack_from_model1 if user_ack_from_model1 and len(user_ack_from_model1.strip()) > 3 else "Processing..."
                         thinking_placeholder.markdown(f"<p class='thinking-placeholder'>{thinking_placeholder_text} Engaging specialized AI...</p>", unsafe_allow_html=True)
-                    else:
+                    elif user_ack_from_model1:
                         thinking_placeholder.empty()
-
-                if is_code_related and action_for_next and prompt_for_next:
-                    model_map = {
-                        "generate_new_code_m3": (st.session_state.model3_instance, "Synthesizing High-Quality Code (Model 3)..."),
-                        "fix_and_verify_code_m4": (st.session_state.model4_instance, "Diagnosing & Correcting Code (Model 4)..."),
-                        "iteratively_perfect_code_m5": (st.session_state.model5_instance, "Iteratively Perfecting Code (Model 5)..."),
-                        "optimize_ml_solution_m_ml": (st.session_state.model_ml_optimizer_instance, "Engineering Optimal ML Solution..."),
-                    }
-
-                    if action_for_next in model_map:
-                        target_model_instance, progress_message_template = model_map[action_for_next]
-                        
-                        stream_accumulator = []
-                        stream_display_area_in_container = current_assistant_turn_container.empty() 
-
-                        thinking_placeholder.markdown(f"<p class='thinking-placeholder'>{progress_message_template} Streaming output...</p>", unsafe_allow_html=True)
-                        
-                        for chunk_idx, chunk_text in enumerate(target_model_instance(prompt_for_next)):
-                            stream_accumulator.append(chunk_text)
-                            if chunk_idx % 3 == 0 or len(chunk_text) > 10:
-                                stream_display_area_in_container.markdown("".join(stream_accumulator) + " ▌")
-                        
-                        stream_display_area_in_container.empty()
-                        thinking_placeholder.empty()
-                        
-                        final_output_string_from_specialized_model = "".join(stream_accumulator)
-                        
-                        parsed_parts = display_ai_parts_from_string(final_output_string_from_specialized_model, current_assistant_turn_container)
-                        accumulated_final_parts_for_history.extend(parsed_parts)
-                    else:
-                        msg = f"Orchestrator (Model 1) requested an unhandled action: '{action_for_next}'."
-                        current_assistant_turn_container.warning(msg)
-                        accumulated_final_parts_for_history.append({"type": "text", "data": msg})
-                
-                elif not is_code_related and not user_ack_from_model1:
-                    fallback_msg = "I'm ready to assist. What can I do for you?"
-                    current_assistant_turn_container.markdown(fallback_msg)
-                    accumulated_final_parts_for_history.append({"type": "text", "data": fallback_msg})
-                
-                if not is_code_related and user_ack_from_model1 and not action_for_next and not initial_ack_displayed_in_turn:
-                     # This handles if M1 gave a simple ack that wasn't "substantial" enough to be displayed above,
-                     # but it was the only intended output for this turn.
-                     accumulated_final_parts_for_history.append({"type": "text", "data": user_ack_from_model1})
-                     current_assistant_turn_container.markdown(user_ack_from_model1)
-                     thinking_placeholder.empty()
-
-
-            except Exception as e:
-                thinking_placeholder.empty()
-                error_msg = f"An unexpected error occurred: {e}"
-                current_assistant_turn_container.error(error_msg)
-                accumulated_final_parts_for_history.append({"type": "text", "data": f"Sorry, I encountered an error: {e}"})
-                import traceback; traceback.print_exc()
-
-        if accumulated_final_parts_for_history:
-            # Prevent adding an empty assistant message if only an ack was processed and already stored
-            # or if only errors occurred that were displayed directly.
-            # Only add if there are actual new parts to log.
-            if not (len(accumulated_final_parts_for_history) == 1 and \
-                    accumulated_final_parts_for_history[0]["type"] == "text" and \
-                    initial_ack_displayed_in_turn and \
-                    accumulated_final_parts_for_history[0]["data"] == user_ack_from_model1 and \
-                    not (is_code_related and action_for_next and prompt_for_next) ): # ensure it's not just a simple chat ack
-                st.session_state.messages.append({"role": "assistant", "content_parts": accumulated_final_parts_for_history})
+                elif event == "ack":
+                    current_assistant_turn_container.markdown(data)
+                elif event == "progress":
+                    thinking_placeholder.markdown(f"<p class='thinking-placeholder'>{data}</p>", unsafe_allow_html=True)
+                elif event == "text":
+                    current_assistant_turn_container.markdown(data)
+                    thinking_placeholder.empty()
+                elif event == "warning":
+                    current_assistant_turn_container.warning(data)
+                elif event == "error":
+                    thinking_placeholder.empty()
+                    current_assistant_turn_container.error(data)
+                elif event == "done":
+                    thinking_placeholder.empty()
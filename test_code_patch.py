@@ -0,0 +1,131 @@
+import pytest
+from code_patch import PatchError, PatchModeModel, apply_edits, has_code_part, parse_edits, parse_unified_diff
+
+ORIGINAL = """import json
+
+def load_users(path):
+    with open(path) as handle:
+        rows = json.load(handle)
+    return [row for row in rows if row["active"]]
+
+def load_groups(path):
+    with open(path) as handle:
+        rows = json.load(handle)
+    return [row for row in rows if row["enabled"]]
+"""
+
+REPORT = '```json\n{"report": {"summary": "fixed"}}\n```\n'
+
+
+# --- apply_edits ---
+def test_exact_edit_replaces_only_its_block():
+    patched, kinds = apply_edits(ORIGINAL, [('    return [row for row in rows if row["active"]]', '    return [row for row in rows if row.get("active")]')])
+    assert kinds == ["exact"]
+    assert 'row.get("active")' in patched and 'row["enabled"]' in patched
+
+def test_whitespace_insensitive_match_keeps_file_indentation():
+    patched, kinds = apply_edits(ORIGINAL, [("with open(path) as handle:\n    rows = json.load(handle)\nreturn [row for row in rows if row[\"enabled\"]]",
+                                             "with open(path, encoding='utf-8') as handle:\n    rows = json.load(handle)\nreturn [row for row in rows if row[\"enabled\"]]")])
+    assert kinds == ["whitespace"]
+    assert "    with open(path, encoding='utf-8') as handle:" in patched.split("def load_groups")[1]
+    assert "encoding" not in patched.split("def load_groups")[0]
+
+def test_empty_search_appends():
+    patched, kinds = apply_edits(ORIGINAL, [("", "\nprint(load_users('users.json'))")])
+    assert kinds == ["append"]
+    assert patched.endswith("print(load_users('users.json'))")
+
+def test_missing_search_block_raises():
+    with pytest.raises(PatchError, match="not found"):
+        apply_edits(ORIGINAL, [("def save_users(path, users):\n    json.dump(users, open(path, 'w'))", "pass")])
+
+def test_fuzzy_match_prefers_the_clearly_closer_near_duplicate():
+    search = 'def load_groups(path):\n    with open(path) as fh:\n        rows = json.load(fh)\n    return [row for row in rows if row["enabled"]]'
+    replace = 'def load_groups(path):\n    with open(path) as fh:\n        rows = json.load(fh)\n    return [row for row in rows if row.get("enabled")]'
+    patched, kinds = apply_edits(ORIGINAL, [(search, replace)])
+    assert kinds == ["fuzzy"]
+    assert 'row.get("enabled")' in patched.split("def load_groups")[1]
+    assert 'row["active"]' in patched.split("def load_groups")[0]
+
+def test_fuzzy_match_between_near_duplicates_is_refused():
+    # Mixes the first block's name with the second block's condition: it fuzzy-matches
+    # both, the second slightly better, and guessing would patch the wrong function half the time.
+    search = 'def load_users(path):\n    with open(path) as fh:\n        rows = json.load(fh)\n    return [row for row in rows if row["enabled"]]'
+    with pytest.raises(PatchError, match="more than one place"):
+        apply_edits(ORIGINAL, [(search, "pass")])
+
+
+# --- parse_unified_diff / parse_edits ---
+def test_unified_diff_hunks_become_search_replace_pairs():
+    diff = """--- original
++++ patched
+@@ -3,4 +3,4 @@
+ def load_users(path):
+-    with open(path) as handle:
++    with open(path, encoding="utf-8") as handle:
+         rows = json.load(handle)
+@@ -9,2 +9,2 @@
+         rows = json.load(handle)
+-    return [row for row in rows if row["enabled"]]
++    return [row for row in rows if row.get("enabled")]
+\\ No newline at end of file
+"""
+    edits = parse_unified_diff(diff)
+    assert edits == [
+        ('def load_users(path):\n    with open(path) as handle:\n        rows = json.load(handle)',
+         'def load_users(path):\n    with open(path, encoding="utf-8") as handle:\n        rows = json.load(handle)'),
+        ('        rows = json.load(handle)\n    return [row for row in rows if row["enabled"]]',
+         '        rows = json.load(handle)\n    return [row for row in rows if row.get("enabled")]'),
+    ]
+    patched, kinds = apply_edits(ORIGINAL, edits)
+    assert kinds == ["exact", "exact"]
+    assert 'encoding="utf-8"' in patched and 'row.get("enabled")' in patched
+
+def test_parse_edits_reads_search_replace_blocks_before_diff_fences():
+    response = REPORT + "```diff\n<<<<<<< SEARCH\n    return 1\n=======\n    return 2\n>>>>>>> REPLACE\n```\n"
+    assert parse_edits(response) == [("    return 1", "    return 2")]
+
+def test_parse_edits_falls_back_to_unified_diff_fence():
+    response = REPORT + "```diff\n@@ -1 +1 @@\n-x = 1\n+x = 2\n```\n"
+    assert parse_edits(response) == [("x = 1", "x = 2")]
+
+
+# --- PatchModeModel fallback ---
+class _Model:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.prompts = []
+
+    def __call__(self, prompt):
+        self.prompts.append(prompt)
+        yield self.responses.pop(0)
+
+def _prompt(code):
+    return f"<CodeToFix language='python'>\n{code}\n</CodeToFix>\n<RequestDetails>Fix it.</RequestDetails>"
+
+def test_report_only_reply_falls_back_to_full_regeneration():
+    assert not has_code_part(REPORT, "python")
+    code = "\n".join(f"value_{i} = {i}" for i in range(40))
+    model = _Model(REPORT + "No changes needed.", REPORT + "```python\nvalue = 1\n```")
+    output = "".join(PatchModeModel(model)(_prompt(code)))
+    assert "regenerating the full program" in output and "value = 1" in output
+    assert len(model.prompts) == 2
+
+def test_full_program_reply_is_accepted_without_edits():
+    code = "\n".join(f"value_{i} = {i}" for i in range(40))
+    model = _Model(REPORT + "```python\nvalue = 1\n```")
+    output = "".join(PatchModeModel(model)(_prompt(code)))
+    assert "value = 1" in output and "regenerating" not in output
+    assert len(model.prompts) == 1
+
+def test_report_streams_before_the_edits_arrive():
+    code = "\n".join(f"value_{i} = {i}" for i in range(40))
+    generated = []
+    def model(prompt):
+        for piece in [REPORT, "```diff\n<<<<<<< SEARCH\nvalue_3 = 3\n=======\nvalue_3 = 30\n>>>>>>> REPLACE\n```\n"]:
+            generated.append(piece)
+            yield piece
+    chunks = PatchModeModel(model)(_prompt(code))
+    assert next(chunks) == REPORT and len(generated) == 1
+    rest = "".join(chunks)
+    assert "<<<<<<< SEARCH" not in rest and "value_3 = 30" in rest and rest.count("```json") == 0
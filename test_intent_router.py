@@ -0,0 +1,35 @@
+import pytest
+from intent_router import SEED_EXAMPLES, IntentRouter, is_small_talk
+
+MIXED_INPUTS = [
+    "thanks! can you also add type hints?",
+    "thanks, but it still fails",
+    "hi! can you write fizzbuzz",
+    "nice, can you add a CLI",
+    "hello, please fix the import error",
+    "ok now make it faster",
+    "great. why does it crash?",
+]
+
+
+@pytest.fixture(scope="module")
+def router():
+    return IntentRouter(log_path="/nonexistent/directives.jsonl").train(SEED_EXAMPLES)
+
+
+@pytest.mark.parametrize("user_input", ["hi", "hello!", "thanks", "Thank you so much!", "ok cool", "thanks, that worked", "bye", "how are you?"])
+def test_whole_small_talk_is_answered_locally(router, user_input):
+    assert is_small_talk(user_input)
+    directive = router.route(user_input)
+    assert directive is not None and directive["routed_locally"] and not directive["is_code_related"]
+
+@pytest.mark.parametrize("user_input", MIXED_INPUTS)
+def test_small_talk_with_a_request_goes_to_model1(router, user_input):
+    assert not is_small_talk(user_input)
+    assert router.route(user_input) is None
+
+def test_follow_up_goes_to_model1(router):
+    assert router.route("now add logging to it") is None
+
+def test_code_route_is_off_by_default(router):
+    assert router.route("write a python script that renames files in a folder") is None
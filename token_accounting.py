@@ -0,0 +1,149 @@
+import os
+import re
+import threading
+from collections import OrderedDict, deque
+from functools import lru_cache
+from scheduler import ANONYMOUS_SESSION
+from tracing import shared_tracer
+
+DEFAULT_MAX_REQUEST_TOKENS = 30000
+DEFAULT_MAX_SESSION_TOKENS = 2000000
+MIN_CALIBRATION, MAX_CALIBRATION = 0.5, 2.0
+
+
+class TokenBudgetExceeded(RuntimeError):
+    def __init__(self, message, budget):
+        super().__init__(message)
+        self.budget = budget  # "request" or "session"
+
+
+# Words cost about one token per five letters, every digit and symbol one token. Cached,
+# because the same system instructions and history turns are estimated on every call.
+_TOKEN_PIECES = re.compile(r"[^\W\d_]+|\d|[^\w\s]|_")
+
+@lru_cache(maxsize=1024)
+def raw_token_estimate(text):
+    if not text:
+        return 0
+    return sum((len(piece) + 4) // 5 if piece.isalpha() else 1 for piece in _TOKEN_PIECES.findall(text))
+
+
+# --- Pre-flight Token Accounting ---
+# Estimates a request's prompt tokens before it is sent, per model label: the raw
+# estimate times a calibration factor, an EWMA of the actual/estimated ratio from the
+# usage_metadata of earlier responses. preflight() raises TokenBudgetExceeded when one
+# request, or the session's running total, would go over budget; record() settles each
+# upstream attempt (actual tokens when reported, else the prompt estimate plus an estimate
+# of the generated output; calibration needs reported usage) and keeps per-model
+# token and latency totals for capacity planning. Calls made outside any session only
+# count against the per-request budget.
+class TokenAccountant:
+    def __init__(self, max_request_tokens=DEFAULT_MAX_REQUEST_TOKENS, max_session_tokens=DEFAULT_MAX_SESSION_TOKENS,
+                 max_sessions=10000, latency_window=200, calibration_alpha=0.2):
+        self.max_request_tokens = max_request_tokens
+        self.max_session_tokens = max_session_tokens
+        self.max_sessions = max_sessions
+        self.latency_window = latency_window
+        self.calibration_alpha = calibration_alpha
+        self._lock = threading.Lock()
+        self._calibration = {}
+        self._session_tokens = OrderedDict()
+        self._latencies = {}
+        self._metrics = {}
+
+    def _model_metrics(self, model_label):
+        if model_label not in self._metrics:
+            self._metrics[model_label] = {"calls": 0, "estimated_calls": 0, "prompt_tokens": 0, "output_tokens": 0, "cached_tokens": 0,
+                                          "estimated_prompt_tokens": 0, "seconds": 0.0, "rejected": 0, "trimmed_requests": 0, "trimmed_tokens": 0}
+        return self._metrics[model_label]
+
+    def estimate(self, model_label, texts):
+        raw = sum(raw_token_estimate(text) for text in texts if text)
+        with self._lock:
+            return int(round(raw * self._calibration.get(model_label, 1.0)))
+
+    def session_tokens(self, session_id):
+        with self._lock:
+            return self._session_tokens.get(session_id, 0)
+
+    # Returns the estimate; raises TokenBudgetExceeded (with a message fit for the user)
+    # without sending anything. Nothing is charged until record().
+    def preflight(self, model_label, texts, session_id=None):
+        estimate = self.estimate(model_label, texts)
+        if self.max_request_tokens and estimate > self.max_request_tokens:
+            self._reject(model_label, "request")
+            raise TokenBudgetExceeded(f"This request is about {estimate:,} tokens, over the {self.max_request_tokens:,}-token limit for a "
+                                      "single request. Please send a smaller piece of code or text.", "request")
+        used = self.session_tokens(session_id) if session_id not in (None, ANONYMOUS_SESSION) else 0
+        if self.max_session_tokens and used + estimate > self.max_session_tokens:
+            self._reject(model_label, "session")
+            raise TokenBudgetExceeded(f"This conversation has used {used:,} of its {self.max_session_tokens:,}-token budget and the "
+                                      f"next request (~{estimate:,} tokens) would exceed it. Please start a new conversation.", "session")
+        return estimate
+
+    def _reject(self, model_label, budget):
+        with self._lock:
+            self._model_metrics(model_label)["rejected"] += 1
+        shared_tracer.count("token_budget_rejections_total", model=model_label, budget=budget)
+        print(f"WARNING (TokenAccountant): {model_label} request over the {budget} token budget; not sent.")
+
+    def note_trim(self, model_label, tokens_trimmed):
+        with self._lock:
+            metrics = self._model_metrics(model_label)
+            metrics["trimmed_requests"] += 1
+            metrics["trimmed_tokens"] += tokens_trimmed
+
+    def record(self, model_label, estimated_prompt_tokens, usage_metadata=None, seconds=None, session_id=None, estimated_output_tokens=0):
+        with self._lock:
+            metrics = self._model_metrics(model_label)
+            metrics["calls"] += 1
+            metrics["estimated_prompt_tokens"] += estimated_prompt_tokens
+            if usage_metadata is None:
+                metrics["estimated_calls"] += 1
+                metrics["prompt_tokens"] += estimated_prompt_tokens
+                metrics["output_tokens"] += estimated_output_tokens
+                total_tokens = estimated_prompt_tokens + estimated_output_tokens
+            else:
+                metrics["prompt_tokens"] += usage_metadata.prompt_token_count
+                metrics["output_tokens"] += usage_metadata.candidates_token_count
+                metrics["cached_tokens"] += getattr(usage_metadata, "cached_content_token_count", 0) or 0
+                total_tokens = usage_metadata.total_token_count
+                if estimated_prompt_tokens > 0 and usage_metadata.prompt_token_count > 0:
+                    # The estimate already includes the current factor, so the observed ratio compounds onto it.
+                    current = self._calibration.get(model_label, 1.0)
+                    observed = current * usage_metadata.prompt_token_count / estimated_prompt_tokens
+                    updated = (1 - self.calibration_alpha) * current + self.calibration_alpha * observed
+                    self._calibration[model_label] = min(MAX_CALIBRATION, max(MIN_CALIBRATION, updated))
+            if seconds is not None:
+                metrics["seconds"] += seconds
+                self._latencies.setdefault(model_label, deque(maxlen=self.latency_window)).append(seconds)
+            if session_id not in (None, ANONYMOUS_SESSION):
+                self._session_tokens[session_id] = self._session_tokens.get(session_id, 0) + total_tokens
+                self._session_tokens.move_to_end(session_id)
+                while len(self._session_tokens) > self.max_sessions:
+                    self._session_tokens.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            models = {}
+            for model_label, metrics in self._metrics.items():
+                latencies = sorted(self._latencies.get(model_label) or ())
+                reported = metrics["calls"] - metrics["estimated_calls"]
+                models[model_label] = dict(
+                    metrics, seconds=round(metrics["seconds"], 3),
+                    calibration=round(self._calibration.get(model_label, 1.0), 3),
+                    mean_prompt_tokens=round(metrics["prompt_tokens"] / metrics["calls"]) if metrics["calls"] else None,
+                    latency_p50=round(latencies[len(latencies) // 2], 3) if latencies else None,
+                    latency_p95=round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 3) if latencies else None,
+                    reported_calls=reported,
+                )
+            return {"max_request_tokens": self.max_request_tokens, "max_session_tokens": self.max_session_tokens,
+                    "sessions_tracked": len(self._session_tokens), "estimator_cache": raw_token_estimate.cache_info()._asdict(), "models": models}
+
+
+# TOKEN_BUDGET_REQUEST_TOKENS / TOKEN_BUDGET_SESSION_TOKENS override the budgets (0 means
+# unlimited); TOKEN_ACCOUNTING_DISABLED=1 sends every request unchecked and untracked.
+shared_token_accounting = None if os.getenv("TOKEN_ACCOUNTING_DISABLED") else TokenAccountant(
+    max_request_tokens=int(os.getenv("TOKEN_BUDGET_REQUEST_TOKENS") or DEFAULT_MAX_REQUEST_TOKENS),
+    max_session_tokens=int(os.getenv("TOKEN_BUDGET_SESSION_TOKENS") or DEFAULT_MAX_SESSION_TOKENS),
+)
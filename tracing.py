@@ -0,0 +1,342 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+GAP_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+TOKENS_PER_SECOND_BUCKETS = (10, 25, 50, 100, 200, 400, 800, 1600, 3200, 6400)
+# Gemini FinishReason values, plus the pseudo-reasons recorded by the stream observer.
+FINISH_REASON_NAMES = {0: "UNSPECIFIED", 1: "STOP", 2: "MAX_TOKENS", 3: "SAFETY", 4: "RECITATION", 5: "OTHER"}
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels) + "}"
+
+
+# --- Metrics Registry (Prometheus text exposition) ---
+class MetricsRegistry:
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        self.observe_many(name, (value,), buckets, **labels)
+
+    # One lock acquisition for a batch of samples (e.g. all chunk gaps of a stream).
+    def observe_many(self, name, values, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+            counts, bounds = histogram["counts"], histogram["buckets"]
+            for value in values:
+                index = bisect.bisect_left(bounds, value)
+                if index < len(bounds): counts[index] += 1
+                histogram["sum"] += value
+                histogram["count"] += 1
+
+    def counter_value(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def exposition(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted((key, dict(value, counts=list(value["counts"]))) for key, value in self._histograms.items())
+        lines, declared = [], set()
+
+        def declare(name, metric_type):
+            if name not in declared:
+                declared.add(name)
+                if name in self._help: lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append(f"{name}{_label_text(labels)} {value}")
+        for (name, labels), value in gauges:
+            declare(name, "gauge")
+            lines.append(f"{name}{_label_text(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{_label_text(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{name}_sum{_label_text(labels)} {round(histogram['sum'], 6)}")
+            lines.append(f"{name}_count{_label_text(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+# --- JSONL Trace Sink ---
+# One line per finished turn trace, appended under a lock.
+class JsonlTraceSink:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as handle:
+                handle.write(line + "\n")
+
+
+class Span:
+    def __init__(self, trace, name, attributes):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.start = None
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None: self.attributes["error"] = f"{exc_type.__name__}: {exc}"
+        self.trace._finish_span(self)
+        return False
+
+
+class Trace:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.attributes = attributes
+        self.spans = []
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._context_token = None
+
+    def span(self, name, **attributes):
+        return Span(self, name, attributes)
+
+    # For stages whose time is spread over many small calls (e.g. per-chunk rendering).
+    def add_span(self, name, duration, **attributes):
+        span = Span(self, name, attributes)
+        span.start, span.duration = time.perf_counter() - duration, duration
+        self._finish_span(span)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def _finish_span(self, span):
+        self.spans.append({"name": span.name, "offset_ms": round((span.start - self._start) * 1000, 3),
+                           "duration_ms": round(span.duration * 1000, 3), **span.attributes})
+        self.tracer.metrics.observe("pipeline_stage_seconds", span.duration, stage=span.name)
+
+    # begin()/end() for callers that cannot wrap the turn in a with-block.
+    def begin(self):
+        self._context_token = _current_trace.set(self)
+        return self
+
+    def end(self, error=None):
+        if self._context_token is None:
+            return
+        _current_trace.reset(self._context_token)
+        self._context_token = None
+        duration = time.perf_counter() - self._start
+        if error is not None: self.attributes["error"] = error
+        self.tracer.metrics.observe("pipeline_stage_seconds", duration, stage=self.name)
+        self.tracer._export({"trace_id": self.trace_id, "name": self.name, "started_at": self.started_at,
+                             "duration_ms": round(duration * 1000, 3), "attributes": self.attributes, "spans": self.spans})
+
+    def __enter__(self):
+        return self.begin()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end(f"{exc_type.__name__}: {exc}" if exc_type is not None else None)
+        return False
+
+
+# --- Chunk-Level Stream Observer ---
+# Times first token, inter-chunk gaps and throughput of one model stream and counts how
+# it finished. Attaches a span to the turn trace active in this context, if any.
+class StreamObserver:
+    def __init__(self, tracer, model_label):
+        self.tracer = tracer
+        self.model_label = model_label
+        self.trace = _current_trace.get()
+        self._start = time.perf_counter()
+        self._first_at = None
+        self._last_at = None
+        self._gaps = []
+        self._chunks = 0
+        self._chars = 0
+        self._finished = False
+
+    def chunk(self, text_length):
+        now = time.perf_counter()
+        if self._first_at is None:
+            self._first_at = now
+            self.tracer.metrics.observe("llm_time_to_first_token_seconds", now - self._start, model=self.model_label)
+        else:
+            self._gaps.append(now - self._last_at)
+        self._last_at = now
+        self._chunks += 1
+        self._chars += text_length
+
+    def finish(self, reason):
+        if self._finished:
+            return
+        self._finished = True
+        now = time.perf_counter()
+        metrics = self.tracer.metrics
+        metrics.inc("llm_stream_finish_total", model=self.model_label, reason=reason)
+        if self._gaps: metrics.observe_many("llm_inter_chunk_gap_seconds", self._gaps, buckets=GAP_BUCKETS, model=self.model_label)
+        tokens = self._chars / 4
+        tokens_per_second = None
+        if self._first_at is not None and now > self._first_at and self._chunks > 1:
+            tokens_per_second = tokens / (now - self._first_at)
+            metrics.observe("llm_stream_tokens_per_second", tokens_per_second, buckets=TOKENS_PER_SECOND_BUCKETS, model=self.model_label)
+        metrics.inc("llm_stream_output_tokens_total", round(tokens), model=self.model_label)
+        if self.trace is not None:
+            self.trace.add_span(f"stream.{self.model_label}", now - self._start, finish_reason=reason, chunks=self._chunks,
+                                ttft_ms=round((self._first_at - self._start) * 1000, 3) if self._first_at else None,
+                                max_gap_ms=round(max(self._gaps, default=0.0) * 1000, 3),
+                                tokens_per_second=round(tokens_per_second, 1) if tokens_per_second else None)
+
+
+class _NullSpan:
+    def set(self, **attributes): pass
+    def __enter__(self): return self
+    def __exit__(self, exc_type, exc, tb): return False
+
+class _NullTrace(_NullSpan):
+    trace_id = None
+    def begin(self): return self
+    def end(self, error=None): pass
+    def span(self, name, **attributes): return _NULL_SPAN
+    def add_span(self, name, duration, **attributes): pass
+
+class _NullStreamObserver:
+    def chunk(self, text_length): pass
+    def finish(self, reason): pass
+
+_NULL_SPAN = _NullSpan()
+_NULL_TRACE = _NullTrace()
+_NULL_STREAM_OBSERVER = _NullStreamObserver()
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+# --- Tracer ---
+# When disabled every entry point returns a shared no-op object, so instrumented code
+# pays one attribute check per call.
+class Tracer:
+    def __init__(self, enabled=True, sink=None):
+        self.enabled = enabled
+        self.sink = sink
+        self.metrics = MetricsRegistry()
+        self.metrics.describe("pipeline_stage_seconds", "Wall time of each turn stage.")
+        self.metrics.describe("llm_time_to_first_token_seconds", "Time from request to first streamed chunk.")
+        self.metrics.describe("llm_inter_chunk_gap_seconds", "Time between consecutive streamed chunks.")
+        self.metrics.describe("llm_stream_tokens_per_second", "Estimated output tokens per second after the first chunk.")
+        self.metrics.describe("llm_stream_finish_total", "Streams by finish reason (STOP, MAX_TOKENS, SAFETY, BLOCKED, ERROR, CANCELLED, ...).")
+        self.metrics.describe("llm_stream_output_tokens_total", "Estimated streamed output tokens.")
+
+    def start_trace(self, name, **attributes):
+        if not self.enabled:
+            return _NULL_TRACE
+        return Trace(self, name, attributes)
+
+    def span(self, name, **attributes):
+        if not self.enabled:
+            return _NULL_SPAN
+        trace = _current_trace.get()
+        return trace.span(name, **attributes) if trace is not None else _NULL_SPAN
+
+    def observe_stream(self, model_label):
+        if not self.enabled:
+            return _NULL_STREAM_OBSERVER
+        return StreamObserver(self, model_label)
+
+    def count(self, name, amount=1, **labels):
+        if self.enabled:
+            self.metrics.inc(name, amount, **labels)
+
+    def exposition(self):
+        return self.metrics.exposition()
+
+    def _export(self, record):
+        if self.sink is None:
+            return
+        try:
+            self.sink.write(record)
+        except OSError as e:
+            print(f"WARNING (Tracer): Could not write trace: {e}")
+
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+# Serves GET /metrics from a daemon thread; idempotent per process.
+def start_metrics_server(tracer, port, host="127.0.0.1"):
+    global _metrics_server
+    with _metrics_server_lock:
+        if _metrics_server is not None:
+            return _metrics_server
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = tracer.exposition().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        _metrics_server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+        print(f"INFO (Tracer): Serving metrics on http://{host}:{port}/metrics")
+        return _metrics_server
+
+
+# TRACING_DISABLED=1 turns all spans and metrics into no-ops; TRACE_JSONL_PATH enables the
+# JSONL sink; METRICS_PORT makes the Streamlit app serve /metrics.
+shared_tracer = Tracer(
+    enabled=not os.getenv("TRACING_DISABLED"),
+    sink=JsonlTraceSink(os.getenv("TRACE_JSONL_PATH")) if os.getenv("TRACE_JSONL_PATH") else None,
+)
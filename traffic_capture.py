@@ -0,0 +1,478 @@
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import aclosing, closing
+from pathlib import Path
+from llm_backends import FINISH_STOP, FakeBackend, FakeChunk, FakeUsageMetadata, contents_to_text, last_user_text
+from scheduler import current_session
+
+CAPTURE_RECORD_VERSION = 1
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_MAX_FILES = 8
+DEFAULT_CAPTURE_DIR = os.getenv("TRAFFIC_CAPTURE_DIR") or str(Path(__file__).resolve().parent / ".cache" / "traffic")
+REPLAY_SESSION_SEPARATOR = "~"  # Replayed copies of a captured session run as "<session>~<user>".
+UNREDACTED_DIRECTIVE_KEYS = ("action_for_next_model",)  # Routing, not content; replays dispatch on it.
+_CURRENT_REQUEST = re.compile(r'Current user request: "(.*?)"\n\n', re.S)
+
+
+# --- Redaction Hooks ---
+# Every captured text (user input, directive fields, prompts) passes through the
+# recorder's redactors, in order. redact_secrets is the default; mask_text keeps only
+# the length and layout of the text, for deployments that must not store content.
+_SECRET_PATTERNS = [
+    (re.compile(r"AIza[0-9A-Za-z_\-]{35,}"), "[REDACTED_API_KEY]"),
+    (re.compile(r"\b(?:sk|pk|rk)-[A-Za-z0-9_\-]{16,}"), "[REDACTED_API_KEY]"),
+    (re.compile(r"(?i)\b(api[_-]?key|secret|token|password|passwd)(\s*[:=]\s*)(['\"]?)[^\s'\"]{4,}\3"), r"\1\2\3[REDACTED]\3"),
+    (re.compile(r"[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,}"), "[REDACTED_EMAIL]"),
+]
+
+def redact_secrets(text):
+    for pattern, replacement in _SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+def mask_text(text):
+    return re.sub(r"[^\W\d_]", "x", re.sub(r"\d", "0", text))
+
+def prompt_key(prompt_content):
+    return hashlib.sha1(contents_to_text(prompt_content).encode("utf-8")).hexdigest()[:16]
+
+
+# --- Traffic Recorder ---
+# Appends one compact JSON line per Model1 directive and per specialized-model stream
+# to capture-<pid>.jsonl in capture_dir (one file per process, so service workers never
+# interleave). Streams keep chunk timings and sizes, not the answer text. Past max_bytes
+# the file is rotated and gzipped in the background; only the newest max_files rotated
+# files are kept.
+class TrafficRecorder:
+    def __init__(self, capture_dir, max_bytes=DEFAULT_MAX_BYTES, max_files=DEFAULT_MAX_FILES, redactors=None):
+        self.capture_dir = Path(capture_dir)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.redactors = list(redactors) if redactors is not None else [redact_secrets]
+        self._path = self.capture_dir / f"capture-{os.getpid()}.jsonl"
+        self._handle = None
+        self._lock = threading.Lock()
+        self.counters = {"directives": 0, "streams": 0, "bytes": 0, "rotations": 0, "write_errors": 0}
+
+    def add_redactor(self, redactor):
+        self.redactors.append(redactor)
+
+    def redact(self, value):
+        if isinstance(value, str):
+            for redactor in self.redactors:
+                value = redactor(value)
+            return value
+        if isinstance(value, dict):
+            return {key: self.redact(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.redact(item) for item in value]
+        return value
+
+    # `seconds` is the whole turn (local context work included); `upstream_seconds` only the
+    # Model1 call, which is what the replay backend reproduces (0 when cached or routed locally).
+    def record_directive(self, model_label, user_input, directive, seconds, upstream_seconds=0.0):
+        self._write("directives", {
+            "v": CAPTURE_RECORD_VERSION, "type": "directive", "session": current_session(), "model": model_label,
+            "at": round(time.time() - seconds, 3), "seconds": round(seconds, 4), "upstream_seconds": round(upstream_seconds, 4),
+            "user_input": self.redact(user_input),
+            "directive": {key: value if key in UNREDACTED_DIRECTIVE_KEYS else self.redact(value) for key, value in directive.items()},
+            "routed_locally": "router_confidence" in directive,
+        })
+
+    def start_stream(self, model_label, prompt_content_for_model):
+        return StreamCapture(self, model_label, prompt_content_for_model)
+
+    # Wraps a specialized model's chunk generator; respond(outcome) starts it, and the
+    # model may set outcome["finish_reason"] on the way.
+    def capture_stream(self, model_label, prompt_content_for_model, respond):
+        capture, outcome = self.start_stream(model_label, prompt_content_for_model), {}
+        try:
+            with closing(respond(outcome)) as chunks:
+                for chunk_text in chunks:
+                    capture.chunk(chunk_text)
+                    yield chunk_text
+        except GeneratorExit:
+            capture.finish("CANCELLED")
+            raise
+        except Exception:
+            capture.finish("ERROR")
+            raise
+        capture.finish(outcome.get("finish_reason", "COALESCED"))
+
+    async def capture_stream_async(self, model_label, prompt_content_for_model, respond):
+        capture, outcome = self.start_stream(model_label, prompt_content_for_model), {}
+        try:
+            async with aclosing(respond(outcome)) as chunks:
+                async for chunk_text in chunks:
+                    capture.chunk(chunk_text)
+                    yield chunk_text
+        except (asyncio.CancelledError, GeneratorExit):
+            capture.finish("CANCELLED")
+            raise
+        except Exception:
+            capture.finish("ERROR")
+            raise
+        capture.finish(outcome.get("finish_reason", "COALESCED"))
+
+    def _write(self, counter, record):
+        line = (json.dumps(record, separators=(",", ":"), ensure_ascii=False, default=str) + "\n").encode("utf-8")
+        with self._lock:
+            try:
+                if self._handle is None:
+                    self.capture_dir.mkdir(parents=True, exist_ok=True)
+                    self._handle = open(self._path, "ab")
+                self._handle.write(line)
+                self._handle.flush()
+                self.counters[counter] += 1
+                self.counters["bytes"] += len(line)
+                if self._handle.tell() >= self.max_bytes:
+                    self._rotate()
+            except OSError as e:
+                self.counters["write_errors"] += 1
+                print(f"WARNING (TrafficRecorder): Could not write capture record: {e}")
+
+    def _rotate(self):
+        self._handle.close()
+        self._handle = None
+        rotated = self._path.with_name(f"{self._path.stem}-{time.time_ns()}.jsonl")
+        os.replace(self._path, rotated)
+        self.counters["rotations"] += 1
+        threading.Thread(target=self._compress, args=(rotated,), daemon=True).start()
+
+    def _compress(self, rotated):
+        try:
+            with open(rotated, "rb") as source, gzip.open(f"{rotated}.gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            rotated.unlink()
+            for stale in sorted(self.capture_dir.glob(f"{self._path.stem}-*.jsonl.gz"))[:-self.max_files]:
+                stale.unlink()
+        except OSError as e:
+            print(f"WARNING (TrafficRecorder): Could not compress '{rotated}': {e}")
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, path=str(self._path))
+
+
+# Chunk offsets are milliseconds since the call started. The prompt is redacted when the
+# stream ends, off the first-token path.
+class StreamCapture:
+    def __init__(self, recorder, model_label, prompt_content_for_model):
+        self.recorder = recorder
+        self.model_label = model_label
+        self.prompt_content_for_model = prompt_content_for_model
+        self.session_id = current_session()
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.chunks = []
+        self._finished = False
+
+    def chunk(self, chunk_text):
+        self.chunks.append([int((time.perf_counter() - self._started) * 1000), len(chunk_text)])
+
+    def finish(self, finish_reason):
+        if self._finished:
+            return
+        self._finished = True
+        prompt = self.recorder.redact(self.prompt_content_for_model)
+        self.recorder._write("streams", {
+            "v": CAPTURE_RECORD_VERSION, "type": "stream", "session": self.session_id, "model": self.model_label,
+            "at": round(self.started_at, 3), "seconds": round(time.perf_counter() - self._started, 4),
+            "prompt": prompt, "prompt_key": prompt_key(prompt), "chunks": self.chunks,
+            "chars": sum(size for _, size in self.chunks), "finish_reason": finish_reason,
+        })
+
+
+# --- Loading a Capture ---
+def load_capture_records(capture_dir):
+    records = []
+    for path in sorted(Path(capture_dir).glob("capture-*.jsonl*")):
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rt", encoding="utf-8") as handle:
+            for line in handle:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short by a crash.
+                if record.get("v", 0) <= CAPTURE_RECORD_VERSION:
+                    records.append(record)
+    records.sort(key=lambda record: record["at"])
+    return records
+
+# Per captured session, in time order: its turns (one per directive, with the pause
+# before the next turn) and its streams, plus lookups for the replay backend.
+class CapturedTraffic:
+    def __init__(self, records):
+        self.sessions = OrderedDict()
+        for record in records:
+            session = self.sessions.setdefault(record["session"], {"turns": [], "streams": [], "directives_by_input": {}, "streams_by_key": {}})
+            if record["type"] == "directive":
+                session["turns"].append({"user_input": record["user_input"], "at": record["at"], "ends_at": record["at"] + record["seconds"]})
+                session["directives_by_input"].setdefault(record["user_input"], record)
+            elif record["type"] == "stream":
+                session["streams"].append(record)
+                session["streams_by_key"].setdefault(record["prompt_key"], record)
+                if session["turns"]:
+                    session["turns"][-1]["ends_at"] = max(session["turns"][-1]["ends_at"], record["at"] + record["seconds"])
+        for session in self.sessions.values():
+            turns = session["turns"]
+            for turn, next_turn in zip(turns, turns[1:] + [None]):
+                turn["think_seconds"] = max(0.0, next_turn["at"] - turn["ends_at"]) if next_turn else 0.0
+        self.sessions = OrderedDict((session_id, session) for session_id, session in self.sessions.items() if session["turns"])
+        self.started_at = min((session["turns"][0]["at"] for session in self.sessions.values()), default=0.0)
+
+    def summary(self):
+        streams = [stream for session in self.sessions.values() for stream in session["streams"]]
+        by_model, finish_reasons = {}, {}
+        for stream in streams:
+            by_model[stream["model"]] = by_model.get(stream["model"], 0) + 1
+            finish_reasons[stream["finish_reason"]] = finish_reasons.get(stream["finish_reason"], 0) + 1
+        ends = [turn["ends_at"] for session in self.sessions.values() for turn in session["turns"]]
+        return {"sessions": len(self.sessions), "turns": sum(len(session["turns"]) for session in self.sessions.values()),
+                "streams": len(streams), "streamed_chars": sum(stream["chars"] for stream in streams),
+                "span_seconds": round(max(ends, default=self.started_at) - self.started_at, 1),
+                "streams_by_model": by_model, "finish_reasons": finish_reasons}
+
+
+# --- Replay Backend ---
+# Answers each call from the capture of the session being replayed: Model1 with the
+# recorded directive after the recorded upstream latency, specialized models with filler text cut
+# to the recorded chunk sizes at the recorded offsets, all divided by `speed`. Calls are
+# matched by user input / prompt key, else by their order in the session; anything not
+# captured falls back to FakeBackend's synthetic answers.
+class ReplayBackend(FakeBackend):
+    name = "replay"
+
+    def __init__(self, captured, speed=1.0, **fake_backend_options):
+        super().__init__(**fake_backend_options)
+        self.captured = captured
+        self.speed = speed
+        self._call_counts = {}
+        self.counters.update(matched_by_key=0, matched_by_order=0, unmatched=0)
+
+    # Order-based matching starts over for every replay run.
+    def reset_call_order(self):
+        with self._rng_lock:
+            self._call_counts.clear()
+
+    def _captured_session(self):
+        replay_session_id = current_session()
+        return replay_session_id, self.captured.sessions.get(replay_session_id.split(REPLAY_SESSION_SEPARATOR)[0])
+
+    def _nth_call(self, replay_session_id, kind):
+        with self._rng_lock:
+            count = self._call_counts.get((replay_session_id, kind), 0)
+            self._call_counts[(replay_session_id, kind)] = count + 1
+            return count
+
+    def _match(self, model_handle, contents):
+        replay_session_id, session = self._captured_session()
+        if session is None:
+            return None, None
+        if "AI Orchestrator" in model_handle.system_instruction:
+            request_match = _CURRENT_REQUEST.search(last_user_text(contents))
+            record = session["directives_by_input"].get(request_match.group(1)) if request_match else None
+            ordered, kind = [turn["user_input"] for turn in session["turns"]], "directive"
+            if record is None:
+                index = self._nth_call(replay_session_id, kind)
+                record = session["directives_by_input"].get(ordered[index]) if index < len(ordered) else None
+                return record, "matched_by_order" if record else None
+            return record, "matched_by_key"
+        record = session["streams_by_key"].get(prompt_key(last_user_text(contents)))
+        if record is not None:
+            return record, "matched_by_key"
+        index = self._nth_call(replay_session_id, "stream")
+        record = session["streams"][index] if index < len(session["streams"]) else None
+        return record, "matched_by_order" if record else None
+
+    # Returns (text, [(delay seconds, piece)], usage) or None when nothing matches.
+    def _replay_plan(self, model_handle, contents):
+        record, how = self._match(model_handle, contents)
+        with self._rng_lock:
+            self.counters[how or "unmatched"] += 1
+        if record is None:
+            return None
+        if record["type"] == "directive":
+            text = json.dumps(record["directive"])
+            # The replay redoes the local work itself; only the upstream wait is simulated.
+            timed_pieces = [(record.get("upstream_seconds", record["seconds"]) / self.speed, text)]
+        else:
+            text = _filler_text(record["chars"])
+            timed_pieces, position, previous_ms = [], 0, 0
+            for offset_ms, size in record["chunks"]:
+                timed_pieces.append(((offset_ms - previous_ms) / 1000.0 / self.speed, text[position:position + size]))
+                position, previous_ms = position + size, offset_ms
+        return text, timed_pieces or [(0.0, "")], FakeUsageMetadata(self._prompt_tokens(model_handle, contents), len(text) // 4 + 1)
+
+    def generate_content(self, model_handle, contents):
+        plan = self._replay_plan(model_handle, contents)
+        if plan is None:
+            return super().generate_content(model_handle, contents)
+        text, timed_pieces, usage = plan
+        self._pause(sum(delay for delay, _ in timed_pieces))
+        return FakeChunk(text, FINISH_STOP, usage)
+
+    async def generate_content_async(self, model_handle, contents):
+        plan = self._replay_plan(model_handle, contents)
+        if plan is None:
+            return await super().generate_content_async(model_handle, contents)
+        text, timed_pieces, usage = plan
+        await asyncio.sleep(sum(delay for delay, _ in timed_pieces))
+        return FakeChunk(text, FINISH_STOP, usage)
+
+    # Recorded streams already include any continuation, so every replay finishes with STOP.
+    def stream_content(self, model_handle, contents, generation_config=None):
+        plan = self._replay_plan(model_handle, contents)
+        if plan is None:
+            return super().stream_content(model_handle, contents, generation_config)
+        _, timed_pieces, usage = plan
+
+        def chunks():
+            for index, (delay, piece) in enumerate(timed_pieces):
+                self._pause(delay)
+                is_last = index == len(timed_pieces) - 1
+                yield FakeChunk(piece, FINISH_STOP if is_last else None, usage if is_last else None)
+        return chunks()
+
+    async def stream_content_async(self, model_handle, contents, generation_config=None):
+        plan = self._replay_plan(model_handle, contents)
+        if plan is None:
+            return await super().stream_content_async(model_handle, contents, generation_config)
+        _, timed_pieces, usage = plan
+
+        async def chunks():
+            for index, (delay, piece) in enumerate(timed_pieces):
+                await asyncio.sleep(delay)
+                is_last = index == len(timed_pieces) - 1
+                yield FakeChunk(piece, FINISH_STOP if is_last else None, usage if is_last else None)
+        return chunks()
+
+# Code-shaped text, so replayed answers go through the same parsing as real ones.
+def _filler_text(chars):
+    lines, size = ["```python"], 10
+    while size < chars:
+        line = f"    value_{len(lines)} = compute_step({len(lines)})  # replayed"
+        lines.append(line)
+        size += len(line) + 1
+    return ("\n".join(lines) + "\n```")[:chars] if chars else ""
+
+
+# --- Replay Driver ---
+# Each simulated user replays one captured session (cycling through them when there are
+# more users than sessions): it starts at the session's recorded offset and keeps the
+# recorded pauses between turns, both divided by `speed`. At most `concurrency` turns run
+# at once; the wait for a slot is reported as queueing.
+async def _replay_user(engine, session_id, session, user_index, start_delay, speed, slots, results):
+    await asyncio.sleep(start_delay)
+    replay_session_id = f"{session_id}{REPLAY_SESSION_SEPARATOR}{user_index}"
+    for turn in session["turns"]:
+        ready_at = time.perf_counter()
+        async with slots:
+            started_at = time.perf_counter()
+            result = {"queue": started_at - ready_at, "first_output": None, "chars": 0, "error": None}
+            async with aclosing(engine.aturn(replay_session_id, turn["user_input"])) as events:
+                async for event, data in events:
+                    if event in ("ack", "chunk", "text") and result["first_output"] is None:
+                        result["first_output"] = time.perf_counter() - started_at
+                    if event == "chunk": result["chars"] += len(data)
+                    if event == "error": result["error"] = data
+            result["total"] = time.perf_counter() - started_at
+            if result["first_output"] is None: result["first_output"] = result["total"]
+        results.append(result)
+        if turn["think_seconds"]: await asyncio.sleep(turn["think_seconds"] / speed)
+
+# Every run gets a fresh engine (no conversation state carried over) on the same backend,
+# so prefix caches stay warm across runs as they would in a long-lived deployment.
+async def run_replay(captured, users, concurrency=None, speed=1.0, backend=None):
+    from message_store import MessageStore
+    from pipeline_engine import PipelineEngine
+    from session_store import InMemorySessionStore
+    backend = backend or ReplayBackend(captured, speed=speed)
+    backend.reset_call_order()
+    engine = PipelineEngine(backend=backend, message_store=MessageStore(None), session_store=InMemorySessionStore())
+    engine.warm_up()
+    sessions = list(captured.sessions.items())
+    slots = asyncio.Semaphore(concurrency or users)
+    results = []
+    started_at = time.perf_counter()
+    await asyncio.gather(*(
+        _replay_user(engine, session_id, session, index, (session["turns"][0]["at"] - captured.started_at) / speed, speed, slots, results)
+        for index, (session_id, session) in ((index, sessions[index % len(sessions)]) for index in range(users))
+    ))
+    return results, time.perf_counter() - started_at
+
+def summarise_replay(users, results, elapsed):
+    from benchmark import summarise
+    completed = [result for result in results if result["error"] is None]
+    row = {"users": users, "turns": len(results), "errors": len(results) - len(completed),
+           "turns_per_second": round(len(results) / elapsed, 2) if elapsed else 0.0,
+           "kb_per_second": round(sum(result["chars"] for result in results) / elapsed / 1024, 1) if elapsed else 0.0}
+    for name in ("queue", "first_output", "total"):
+        values = summarise([result[name] * 1000 for result in results])
+        row[name] = {key: round(values[key], 1) for key in ("p50", "p95", "p99")}
+    return row
+
+def print_replay_table(rows):
+    print(f"{'users':>6}{'turns':>7}{'errors':>7}{'turns/s':>9}{'KB/s':>8}   {'queue p50/p95':>15}   {'first output p50/p95/p99':>26}   {'total p50/p95/p99':>22}")
+    for row in rows:
+        queue, first_output, total = row["queue"], row["first_output"], row["total"]
+        print(f"{row['users']:>6}{row['turns']:>7}{row['errors']:>7}{row['turns_per_second']:>9.1f}{row['kb_per_second']:>8.1f}"
+              f"   {queue['p50']:>7.0f}/{queue['p95']:<7.0f}   {first_output['p50']:>8.0f}/{first_output['p95']:.0f}/{first_output['p99']:<8.0f}"
+              f"   {total['p50']:>7.0f}/{total['p95']:.0f}/{total['p99']:.0f}")
+    print("(milliseconds)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect captured traffic, or replay it against the pipeline with the recorded backend timings.")
+    parser.add_argument("command", choices=("stats", "replay"))
+    parser.add_argument("--capture-dir", default=DEFAULT_CAPTURE_DIR)
+    parser.add_argument("--speed", type=float, default=10.0, help="replay: time compression (1 = real time, 100 = 100x faster).")
+    parser.add_argument("--users", default="1,8,32", help="replay: comma-separated simulated user counts, one run each.")
+    parser.add_argument("--concurrency", type=int, default=0, help="replay: max turns in flight (0 = one per user).")
+    parser.add_argument("--output", help="replay: write the result rows as JSON.")
+    args = parser.parse_args(argv)
+
+    captured = CapturedTraffic(load_capture_records(args.capture_dir))
+    if args.command == "stats" or not captured.sessions:
+        print(json.dumps(captured.summary(), indent=2))
+        return 0 if captured.sessions else 1
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+    backend, rows = ReplayBackend(captured, speed=args.speed), []
+    for users in [int(count) for count in args.users.split(",") if count.strip()]:
+        counters_before = dict(backend.counters)
+        results, elapsed = asyncio.run(run_replay(captured, users, args.concurrency or None, args.speed, backend))
+        rows.append(dict(summarise_replay(users, results, elapsed), backend={key: value - counters_before[key] for key, value in backend.counters.items()}))
+    print_replay_table(rows)
+    if args.output:
+        Path(args.output).write_text(json.dumps(rows, indent=2), encoding="utf-8")
+    return 0
+
+
+# TRAFFIC_CAPTURE_DIR turns capture on (off by default); TRAFFIC_CAPTURE_MASK_TEXT=1 keeps
+# only the shape of captured text, TRAFFIC_CAPTURE_MAX_MB sizes each file before rotation.
+shared_traffic_recorder = None if not os.getenv("TRAFFIC_CAPTURE_DIR") else TrafficRecorder(
+    os.getenv("TRAFFIC_CAPTURE_DIR"),
+    max_bytes=int(float(os.getenv("TRAFFIC_CAPTURE_MAX_MB") or DEFAULT_MAX_BYTES / 1024 / 1024) * 1024 * 1024),
+    redactors=[redact_secrets, mask_text] if os.getenv("TRAFFIC_CAPTURE_MASK_TEXT") else None,
+)
+
+
+if __name__ == "__main__":
+    # A replay must not be captured again, nor read or write the real caches and stores.
+    os.environ.pop("TRAFFIC_CAPTURE_DIR", None)
+    for flag in ("RESPONSE_CACHE_DISABLED", "DIRECTIVE_LOG_DISABLED"):
+        os.environ.setdefault(flag, "1")
+    os.environ.setdefault("MESSAGE_STORE_PATH", ":memory:")
+    os.environ.setdefault("SESSION_STORE_PATH", ":memory:")
+    sys.exit(main())